@@ -0,0 +1,270 @@
+"""チャットサーバーの負荷試験
+
+使い方:
+    python -m benchmarks.load_test [--clients 50] [--rate 1.0] [--duration 30]
+
+一時ディレクトリで src.main:app を uvicorn で起動し、N個のWebSocketクライアントを
+同じセッションに参加させて、それぞれ rate 件/秒でメッセージを送信する。
+--url を指定した場合はサーバーを起動せず、起動済みのサーバーに接続する（管理者パスワードは --admin-password）。
+
+結果として以下を表示する。
+- 送信から各クライアントが受信するまでの時間（ブロードキャストの遅延）のパーセンタイル
+- 送信・配信のスループット
+- サーバー側の書き込み時間（/api/storage/metrics）と送信キュー（/api/connections/metrics）
+- サーバープロセスのメモリ使用量（RSS）
+
+クライアントはすべてこのプロセス内で動くため、クライアント数が多い場合は
+こちら側のCPUが先に頭打ちになることがある（受信の遅れも遅延として計測される）。
+"""
+import argparse
+import asyncio
+import http.cookiejar
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import websockets
+
+from .storage import percentile
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+
+
+class Server:
+    """一時ディレクトリで起動したサーバー（データは終了時に削除する）"""
+
+    def __init__(self, port: int, admin_password: str, storage_backend: str, workers: int):
+        self.port = port
+        self.workers = workers
+        self.work_dir = Path(tempfile.mkdtemp(prefix="bench_server_"))
+        # アプリは作業ディレクトリからの相対パス（src/static, data/...）を使う
+        os.symlink(PROJECT_ROOT / "src", self.work_dir / "src")
+        self.env = dict(os.environ, ADMIN_PASSWORD=admin_password, STORAGE_BACKEND=storage_backend)
+        self.processes: List[subprocess.Popen] = []
+
+    def start(self):
+        if self.workers > 1:
+            socket_path = str(self.work_dir / "data" / "pubsub.sock")
+            self.env.update(PUBSUB_BACKEND="unix", PUBSUB_SOCKET=socket_path)
+            self.processes.append(subprocess.Popen(
+                [sys.executable, "-m", "src.tools.pubsub_broker", "--socket", socket_path],
+                cwd=self.work_dir, env=self.env, stdout=subprocess.DEVNULL
+            ))
+        self.processes.append(subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "src.main:app", "--host", "127.0.0.1",
+             "--port", str(self.port), "--workers", str(self.workers), "--log-level", "warning"],
+            cwd=self.work_dir, env=self.env, stdout=subprocess.DEVNULL
+        ))
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                # 起動が完了するまでは 503 が返る
+                urllib.request.urlopen(f"http://127.0.0.1:{self.port}/health", timeout=1)
+                return
+            except OSError:
+                time.sleep(0.2)
+        self.stop()
+        raise RuntimeError("Server did not start within 30 seconds")
+
+    def rss_mb(self) -> Optional[float]:
+        """サーバープロセス（子プロセスを含む）のRSS合計（MB）"""
+        pids = [str(p.pid) for p in self.processes]
+        try:
+            # ワーカーを複数起動した場合は uvicorn の子プロセスも含める
+            children = subprocess.run(
+                ["pgrep", "-P", ",".join(pids)], capture_output=True, text=True
+            ).stdout.split()
+            output = subprocess.run(
+                ["ps", "-o", "rss=", "-p", ",".join(pids + children)], capture_output=True, text=True
+            ).stdout
+        except OSError:
+            return None
+        values = [int(v) for v in output.split() if v.isdigit()]
+        return sum(values) / 1024 if values else None
+
+    def stop(self):
+        for process in reversed(self.processes):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+class AdminClient:
+    """管理APIの呼び出し（ログインのCookieを保持する）"""
+
+    def __init__(self, base_url: str, password: str):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar())
+        )
+        data = urllib.parse.urlencode({"password": password}).encode()
+        self.opener.open(f"{base_url}/admin/auth", data=data)
+
+    def request(self, method: str, path: str) -> Dict:
+        request = urllib.request.Request(f"{self.base_url}{path}", method=method)
+        with self.opener.open(request) as response:
+            return json.loads(response.read())
+
+
+class LoadTest:
+    """WebSocketクライアントを動かして遅延を集計する"""
+
+    def __init__(self, ws_url: str, session_id: str, clients: int, rate: float,
+                 duration: float, ramp: float, message_size: int):
+        self.ws_url = ws_url
+        self.session_id = session_id
+        self.clients = clients
+        self.rate = rate
+        self.duration = duration
+        self.ramp = ramp
+        self.message_size = message_size
+        # key: メッセージ本文の先頭（送信者と番号）, value: 送信時刻
+        self.sent_at: Dict[str, float] = {}
+        self.latencies: List[float] = []
+        self.sent = 0
+        self.received = 0
+        self.connected = 0
+        self.errors = 0
+
+    async def run(self):
+        # 全員が接続し終えてから送信を始める（接続前のメッセージは受信できないため）
+        start_at = time.perf_counter() + self.ramp
+        stop_at = start_at + self.duration
+        tasks = []
+        for i in range(self.clients):
+            tasks.append(asyncio.create_task(self._client(i, start_at, stop_at)))
+            if self.ramp:
+                await asyncio.sleep(self.ramp / self.clients)
+        await asyncio.gather(*tasks)
+
+    async def _client(self, index: int, start_at: float, stop_at: float):
+        client_id = f"bench{index}"
+        try:
+            async with websockets.connect(
+                f"{self.ws_url}/ws?session_id={self.session_id}", max_size=None
+            ) as ws:
+                await ws.send(json.dumps({
+                    "type": "join", "client_id": client_id, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")
+                }))
+                self.connected += 1
+                receiver = asyncio.create_task(self._receive(ws))
+                await asyncio.sleep(max(0.0, start_at - time.perf_counter()))
+                await self._send_loop(ws, client_id, stop_at)
+                # 最後に送ったメッセージが届くまで少し待つ
+                await asyncio.sleep(1.0)
+                receiver.cancel()
+        except (OSError, websockets.WebSocketException) as e:
+            self.errors += 1
+            print(f"{client_id}: {e}")
+
+    async def _send_loop(self, ws, client_id: str, stop_at: float):
+        padding = "x" * max(0, self.message_size - 20)
+        count = 0
+        while True:
+            # ポアソン到着（平均 rate 件/秒）
+            await asyncio.sleep(random.expovariate(self.rate))
+            if time.perf_counter() >= stop_at:
+                return
+            key = f"{client_id}:{count}"
+            count += 1
+            self.sent_at[key] = time.perf_counter()
+            await ws.send(json.dumps({
+                "type": "message", "message": f"{key} {padding}",
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")
+            }))
+            self.sent += 1
+
+    async def _receive(self, ws):
+        async for frame in ws:
+            now = time.perf_counter()
+            data = json.loads(frame)
+            if data.get("type") != "message":
+                continue
+            sent_at = self.sent_at.get(data["message"].split(" ", 1)[0])
+            if sent_at is not None:
+                self.latencies.append(now - sent_at)
+                self.received += 1
+
+
+def print_report(test: LoadTest, elapsed: float, metrics: Dict, rss_before, rss_after):
+    print(f"clients connected      {test.connected}/{test.clients} (errors: {test.errors})")
+    print(f"messages sent          {test.sent}  ({test.sent / elapsed:,.1f} msg/s)")
+    expected = test.sent * test.connected
+    print(f"deliveries             {test.received}/{expected}  ({test.received / elapsed:,.1f} frames/s)")
+    if test.latencies:
+        print("broadcast latency      " + "  ".join(
+            f"p{p}={percentile(test.latencies, p) * 1000:.1f}ms" for p in (50, 90, 99)
+        ) + f"  max={max(test.latencies) * 1000:.1f}ms")
+    writer = metrics.get("storage", {}).get("batch_writer")
+    if writer:
+        print(f"storage writes         batches={writer['batches']} avg_batch={writer['avg_batch_size']:.1f}"
+              f"  avg={writer['avg_flush_latency_ms']:.2f}ms  max={writer['max_flush_latency_ms']:.2f}ms")
+    connections = metrics.get("connections")
+    if connections:
+        print(f"outbound queues        dropped={connections['dropped']} evicted={connections['evicted']}")
+    if rss_before is not None and rss_after is not None:
+        print(f"server RSS             {rss_before:.1f} MB -> {rss_after:.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="チャットサーバーの負荷試験")
+    parser.add_argument("--clients", type=int, default=50, help="同時接続数（既定: 50）")
+    parser.add_argument("--rate", type=float, default=1.0, help="クライアントごとの送信レート（件/秒、既定: 1.0）")
+    parser.add_argument("--duration", type=float, default=30, help="送信を続ける秒数（既定: 30）")
+    parser.add_argument("--ramp", type=float, default=5, help="全クライアントを接続する秒数（送信はその後に開始、既定: 5）")
+    parser.add_argument("--message-size", type=int, default=100, help="メッセージ本文の文字数（既定: 100）")
+    parser.add_argument("--port", type=int, default=8765, help="起動するサーバーのポート（既定: 8765）")
+    parser.add_argument("--storage", choices=("json", "sqlite"), default="json", help="起動するサーバーの保存先")
+    parser.add_argument("--workers", type=int, default=1, help="起動するサーバーのワーカー数（既定: 1）")
+    parser.add_argument("--url", help="起動済みのサーバーに接続する場合のURL（例: http://localhost:8000）")
+    parser.add_argument("--admin-password", default="bench-password", help="管理者パスワード")
+    args = parser.parse_args()
+
+    server = None
+    if args.url:
+        base_url = args.url.rstrip("/")
+    else:
+        server = Server(args.port, args.admin_password, args.storage, args.workers)
+        server.start()
+        base_url = f"http://127.0.0.1:{args.port}"
+
+    try:
+        admin = AdminClient(base_url, args.admin_password)
+        session_id = admin.request("POST", "/api/sessions/new?end_previous=false")["session"]["session_id"]
+        rss_before = server.rss_mb() if server else None
+
+        test = LoadTest(
+            base_url.replace("http", "ws", 1), session_id, args.clients, args.rate,
+            args.duration, args.ramp, args.message_size
+        )
+        start = time.perf_counter()
+        asyncio.run(test.run())
+        elapsed = time.perf_counter() - start
+
+        metrics = {}
+        try:
+            metrics["storage"] = admin.request("GET", "/api/storage/metrics")
+            metrics["connections"] = admin.request("GET", "/api/connections/metrics")
+        except OSError as e:
+            print(f"Could not read server metrics: {e}")
+        rss_after = server.rss_mb() if server else None
+        print_report(test, elapsed, metrics, rss_before, rss_after)
+    finally:
+        if server:
+            server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""保存済みメッセージの一括読み込みの比較（Message と MessageRecord）
+
+使い方:
+    python -m benchmarks.message_records [--messages 100000]
+
+同じ JSON Lines ログを読み、pydanticの Message で復元する場合と
+MessageRecord で復元する場合の時間を比較する。
+"""
+import argparse
+import shutil
+import tempfile
+import time
+
+from src.managers.message_store import MessageStore
+from src.models.message import Message, MessageRecord
+
+
+def populate(message_store: MessageStore, session_id: str, count: int):
+    """ベンチマーク用のセッションを作成"""
+    batch = []
+    for i in range(count):
+        batch.append(Message(
+            session_id=session_id,
+            client_id=f"user{i % 20}",
+            content=f"テストメッセージ {i} これは読み込み速度を測るための本文です",
+        ))
+        if len(batch) >= 10000:
+            message_store.save_messages(batch)
+            batch = []
+    message_store.save_messages(batch)
+    message_store.flush()
+
+
+def measure(label: str, func, repeat: int) -> float:
+    """repeat 回実行して最短時間を返す"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    print(f"{label:<28} {best * 1000:9.1f} ms  ({len(result)} messages)")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="メッセージ一括読み込みのベンチマーク")
+    parser.add_argument("--messages", type=int, default=100000, help="メッセージ数（既定: 100000）")
+    parser.add_argument("--repeat", type=int, default=3, help="繰り返し回数（既定: 3）")
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix="bench_messages_")
+    try:
+        message_store = MessageStore(data_dir)
+        session_id = "session_bench"
+        populate(message_store, session_id, args.messages)
+
+        log = message_store.log
+        raw = measure("json decode only", lambda: list(log.iter_records(session_id)), args.repeat)
+        pydantic = measure(
+            "Message.from_dict",
+            lambda: [Message.from_dict(r) for r in log.iter_records(session_id)], args.repeat
+        )
+        fast = measure(
+            "MessageRecord.from_dict",
+            lambda: [MessageRecord.from_dict(r) for r in log.iter_records(session_id)], args.repeat
+        )
+        print(f"model construction: {(pydantic - raw) * 1000:.1f} ms -> {(fast - raw) * 1000:.1f} ms")
+        print(f"speed-up (end to end): {pydantic / fast:.1f}x")
+        message_store.close()
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
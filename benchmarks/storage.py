@@ -0,0 +1,158 @@
+"""ストレージとエクスポートのマイクロベンチマーク
+
+使い方:
+    python -m benchmarks.storage [--sizes 1000,10000,100000] [--backend json|sqlite]
+
+メッセージ数ごとに新しいデータディレクトリを作り、以下を測定する。
+- MessageStore: 1件ずつの save_message のレイテンシ（セッションが大きくなると遅くなるか）、
+  一括保存・ページ取得・統計・全件読み込み・検索、開き直した直後の件数とページ取得
+- SessionManager: メッセージ数の加算と書き出し、セッション一覧
+- DataExporter: CSV / JSON / NDJSON（gzip）のストリーミング出力、Parquet（pyarrow がある場合）
+"""
+import argparse
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from src.exporters.data_exporter import DataExporter
+from src.managers.message_store import MessageStore
+from src.managers.session_manager import SessionManager
+from src.managers.sqlite_store import SQLiteMessageLog, SQLiteSessionManager
+from src.models.message import Message
+
+from .message_records import populate
+
+
+def percentile(samples, p: float) -> float:
+    """p パーセンタイル（0〜100）"""
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def timed(func):
+    """func を1回実行して (結果, 秒) を返す"""
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def report(label: str, seconds: float, detail: str = ""):
+    print(f"  {label:<34} {seconds * 1000:10.2f} ms  {detail}")
+
+
+def open_message_store(data_dir: Path, backend: str) -> MessageStore:
+    """バックエンドに応じた MessageStore を開く"""
+    if backend == "sqlite":
+        return MessageStore(str(data_dir / "messages"), log=SQLiteMessageLog(data_dir / "chat.db"))
+    return MessageStore(str(data_dir / "messages"))
+
+
+def create_stores(data_dir: Path, backend: str):
+    """バックエンドに応じた MessageStore と SessionManager を作成"""
+    if backend == "sqlite":
+        session_manager = SQLiteSessionManager(db_path=str(data_dir / "chat.db"), data_dir=str(data_dir / "sessions"))
+    else:
+        session_manager = SessionManager(str(data_dir / "sessions"))
+    return open_message_store(data_dir, backend), session_manager
+
+
+def bench_message_store(message_store: MessageStore, session_id: str, size: int, samples: int):
+    print("MessageStore")
+    _, elapsed = timed(lambda: populate(message_store, session_id, size))
+    report("save_messages (bulk)", elapsed, f"{size / elapsed:,.0f} msg/s")
+
+    latencies = []
+    for i in range(samples):
+        message = Message(session_id=session_id, client_id=f"user{i % 20}", content=f"追加のメッセージ {i}")
+        _, elapsed = timed(lambda: message_store.save_message(message))
+        latencies.append(elapsed)
+    report("save_message p50", percentile(latencies, 50))
+    report("save_message p99", percentile(latencies, 99))
+
+    _, elapsed = timed(lambda: message_store.get_message_page(session_id, limit=50))
+    report("get_message_page (latest 50)", elapsed)
+    _, elapsed = timed(lambda: message_store.get_message_page(session_id, limit=50, after=size // 2))
+    report("get_message_page (middle 50)", elapsed)
+    _, elapsed = timed(lambda: message_store.get_session_statistics(session_id))
+    report("get_session_statistics", elapsed)
+    result, elapsed = timed(lambda: sum(1 for _ in message_store.iter_messages(session_id)))
+    report("iter_messages (all)", elapsed, f"{result / elapsed:,.0f} msg/s")
+    result, elapsed = timed(lambda: message_store.search(session_id, "メッセージ", limit=20))
+    report("search (1 term)", elapsed, f"{result['total']} hits")
+    result, elapsed = timed(lambda: message_store.search(session_id, "速度を測る", limit=20))
+    report("search (phrase)", elapsed, f"{result['total']} hits")
+
+
+def bench_reopened(message_store: MessageStore, session_id: str):
+    print("MessageStore (reopened: first reads after restart)")
+    count, elapsed = timed(lambda: message_store.get_messages_count(session_id))
+    report("get_messages_count", elapsed, f"{count:,} messages")
+    _, elapsed = timed(lambda: message_store.get_message_page(session_id, limit=50))
+    report("get_message_page (latest 50)", elapsed)
+    _, elapsed = timed(lambda: message_store.get_message_page(session_id, limit=50, after=count // 2))
+    report("get_message_page (middle 50)", elapsed)
+
+
+def bench_session_manager(session_manager: SessionManager, size: int):
+    print("SessionManager")
+    session = session_manager.create_session()
+    session_id = session.session_id
+    _, elapsed = timed(lambda: [session_manager.increment_message_count(session_id) for _ in range(size)])
+    report(f"increment_message_count x{size}", elapsed, f"{size / elapsed:,.0f} ops/s")
+    _, elapsed = timed(session_manager.flush)
+    report("flush", elapsed)
+    for i in range(99):
+        session_manager.create_session(session_id=f"{session_id}_{i}")
+    _, elapsed = timed(lambda: session_manager.list_session_entries())
+    report("list_session_entries (100)", elapsed)
+    _, elapsed = timed(lambda: session_manager.get_all_sessions())
+    report("get_all_sessions (100)", elapsed)
+
+
+def bench_exporter(message_store: MessageStore, session_id: str, export_dir: Path):
+    print("DataExporter")
+    exporter = DataExporter(str(export_dir))
+    count = message_store.get_messages_count(session_id)
+    for format, compress in (("csv", None), ("json", None), ("ndjson", None), ("ndjson", "gzip")):
+        chunks = exporter.stream_messages(session_id, message_store, format, compress)
+        size, elapsed = timed(lambda: sum(len(chunk) for chunk in chunks))
+        label = f"stream {format}" + (f" ({compress})" if compress else "")
+        report(label, elapsed, f"{size / 1024 / 1024:.1f} MB, {count / elapsed:,.0f} msg/s")
+    if DataExporter.columnar_available():
+        _, elapsed = timed(lambda: exporter.export_messages_columnar(session_id, message_store, "parquet"))
+        report("parquet", elapsed)
+    else:
+        print("  parquet                            (pyarrow がないためスキップ)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ストレージとエクスポートのマイクロベンチマーク")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="メッセージ数（カンマ区切り、既定: 1000,10000,100000）")
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json", help="ストレージ（既定: json）")
+    parser.add_argument("--samples", type=int, default=200, help="save_message のレイテンシの測定回数（既定: 200）")
+    args = parser.parse_args()
+
+    for size in (int(s) for s in args.sizes.split(",")):
+        data_dir = Path(tempfile.mkdtemp(prefix="bench_storage_"))
+        try:
+            print(f"=== {size:,} messages ({args.backend}) ===")
+            message_store, session_manager = create_stores(data_dir, args.backend)
+            session_id = "session_bench"
+            bench_message_store(message_store, session_id, size, args.samples)
+            bench_session_manager(session_manager, size)
+            bench_exporter(message_store, session_id, data_dir / "exports")
+            message_store.close()
+            reopened = open_message_store(data_dir, args.backend)
+            bench_reopened(reopened, session_id)
+            reopened.close()
+            session_manager.close()
+        finally:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
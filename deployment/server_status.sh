@@ -28,6 +28,15 @@ else
     echo "ポート8000は使用されていません"
 fi
 
+echo ""
+echo "【ヘルスチェック】"
+HEALTH=$(curl -s --max-time 2 http://localhost:8000/health)
+if [ -n "$HEALTH" ]; then
+    echo "$HEALTH"
+else
+    echo "応答がありません"
+fi
+
 echo ""
 echo "【IPアドレス】"
 LOCAL_IP=$(ifconfig en0 2>/dev/null | grep "inet " | awk '{print $2}')
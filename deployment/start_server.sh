@@ -39,6 +39,24 @@ echo "停止するには Ctrl+C を押してください"
 echo "=========================================="
 echo ""
 
-# サーバーを起動
-uvicorn src.main:app --host 0.0.0.0 --port 8000
+# 管理者パスワードが未設定なら最初に決めておく（サーバーは起動時に入力を求めない）
+if [ ! -f "data/admin_password.txt" ] && [ -z "$ADMIN_PASSWORD" ]; then
+    python -m src.tools.set_admin_password
+fi
+
+# ワーカー数（WORKERS=4 ./deployment/start_server.sh のように指定）
+WORKERS=${WORKERS:-1}
+
+if [ "$WORKERS" -gt 1 ]; then
+    # ワーカー間でメッセージを中継するブローカーを起動
+    export PUBSUB_BACKEND=unix
+    python -m src.tools.pubsub_broker &
+    BROKER_PID=$!
+    trap "kill $BROKER_PID 2>/dev/null" EXIT INT TERM
+
+    uvicorn src.main:app --host 0.0.0.0 --port 8000 --workers "$WORKERS"
+else
+    # サーバーを起動
+    uvicorn src.main:app --host 0.0.0.0 --port 8000
+fi
 
@@ -29,6 +29,11 @@ echo "停止するには Ctrl+C を押してください"
 echo "=========================================="
 echo ""
 
+# 管理者パスワードが未設定なら最初に決めておく（サーバーは起動時に入力を求めない）
+if [ ! -f "data/admin_password.txt" ] && [ -z "$ADMIN_PASSWORD" ]; then
+    python -m src.tools.set_admin_password
+fi
+
 # 開発サーバーを起動（自動リロード有効）
 uvicorn src.main:app --reload --host 127.0.0.1 --port 8000
 
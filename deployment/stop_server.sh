@@ -15,3 +15,6 @@ else
     echo "実行中のサーバーが見つかりませんでした"
 fi
 
+# 複数ワーカーで起動した場合のブローカーも停止
+pkill -f "src.tools.pubsub_broker" && echo "✓ ブローカーが停止されました"
+
@@ -0,0 +1,34 @@
+"""管理者パスワードの保存と検証（サーバーと管理用スクリプトで共通）"""
+import hashlib
+import os
+from pathlib import Path
+from typing import Optional
+from .fileio import atomic_write
+
+ADMIN_PASSWORD_FILE = "data/admin_password.txt"
+MIN_PASSWORD_LENGTH = 4
+
+
+def get_admin_password_hash() -> Optional[str]:
+    """管理者パスワードハッシュを取得"""
+    if os.path.exists(ADMIN_PASSWORD_FILE):
+        with open(ADMIN_PASSWORD_FILE, 'r') as f:
+            return f.read().strip()
+    return None
+
+
+def set_admin_password(password: str):
+    """管理者パスワードを設定"""
+    password_hash = hashlib.sha256(password.encode()).hexdigest()
+    Path(ADMIN_PASSWORD_FILE).parent.mkdir(parents=True, exist_ok=True)
+    atomic_write(ADMIN_PASSWORD_FILE, password_hash)
+    print(f"Admin password set successfully.")
+
+
+def verify_admin_password(password: str) -> bool:
+    """管理者パスワードを検証"""
+    stored_hash = get_admin_password_hash()
+    if not stored_hash:
+        return False
+    password_hash = hashlib.sha256(password.encode()).hexdigest()
+    return password_hash == stored_hash
@@ -0,0 +1,38 @@
+"""JSONのエンコード・デコード
+
+orjson がインストールされていればそれを使い、なければ標準の json を使う。
+どちらも非ASCII文字をそのまま、区切りの空白なしのUTF-8で出力する。
+"""
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:  # 任意の依存（高速化のみ）
+    orjson = None
+
+# デコード失敗時の例外（orjson.JSONDecodeError は json.JSONDecodeError のサブクラス）
+JSONDecodeError = json.JSONDecodeError
+
+
+if orjson is not None:
+    def dumps(obj: Any) -> bytes:
+        """UTF-8のバイト列にエンコード"""
+        return orjson.dumps(obj)
+
+    def loads(data: Union[bytes, str]) -> Any:
+        """バイト列または文字列からデコード"""
+        return orjson.loads(data)
+else:
+    def dumps(obj: Any) -> bytes:
+        """UTF-8のバイト列にエンコード"""
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def loads(data: Union[bytes, str]) -> Any:
+        """バイト列または文字列からデコード"""
+        return json.loads(data)
+
+
+def dumps_str(obj: Any) -> str:
+    """文字列にエンコード（WebSocketのテキストフレーム用）"""
+    return dumps(obj).decode("utf-8")
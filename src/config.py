@@ -0,0 +1,52 @@
+import os
+
+# アプリケーション設定（環境変数で上書き可能）
+
+# ストレージのバックエンド: json（セッションごとのファイル） | sqlite（SQLite, WALモード）
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "json")
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "data/chat.db")
+
+# メッセージログの形式: jsonl（追記専用, 推奨） | json（旧形式: セッションごとのJSON配列）
+MESSAGE_LOG_FORMAT = os.environ.get("MESSAGE_LOG_FORMAT", "jsonl")
+
+# fsyncポリシー: always（毎回） | interval（一定間隔） | never（OSに任せる）
+MESSAGE_LOG_FSYNC = os.environ.get("MESSAGE_LOG_FSYNC", "interval")
+MESSAGE_LOG_FSYNC_INTERVAL = float(os.environ.get("MESSAGE_LOG_FSYNC_INTERVAL", "1.0"))
+
+# セッションファイル・カタログの置き換え時の fsync: always（毎回） | batch（定期書き出しの分をまとめて） | never
+SESSION_FSYNC = os.environ.get("SESSION_FSYNC", "batch")
+
+# 起動時にバックグラウンドで data/ を検査・修復するスレッド数（0 で無効）
+RECOVERY_SCAN_WORKERS = int(os.environ.get("RECOVERY_SCAN_WORKERS", "4"))
+
+# 終了したセッションのメッセージの圧縮アーカイブ (data/messages/archive/): off | gzip | zstd（zstandard が必要）
+MESSAGE_ARCHIVE = os.environ.get("MESSAGE_ARCHIVE", "off")
+# アーカイブの1セグメント（まとめて圧縮・展開する単位）のメッセージ数
+MESSAGE_ARCHIVE_SEGMENT_SIZE = int(os.environ.get("MESSAGE_ARCHIVE_SEGMENT_SIZE", "1000"))
+
+# WebSocket送信のタイムアウト（秒）。超えた接続はルームから外す
+WS_SEND_TIMEOUT = float(os.environ.get("WS_SEND_TIMEOUT", "5.0"))
+
+# 接続ごとの送信キューの長さと、溢れたときの動作: disconnect（切断） | drop_oldest（古いものから捨てる） | coalesce
+WS_QUEUE_SIZE = int(os.environ.get("WS_QUEUE_SIZE", "256"))
+WS_OVERFLOW_POLICY = os.environ.get("WS_OVERFLOW_POLICY", "disconnect")
+
+# 再接続時の再送用に、セッションごとにメモリ上に残す直近のメッセージ数（超えた分は保存済みのログから読み込む）
+WS_REPLAY_BUFFER_SIZE = int(os.environ.get("WS_REPLAY_BUFFER_SIZE", "500"))
+
+# メモリ上のセッション情報（参加者・メッセージ数など）をディスクに書き出す間隔（秒）
+SESSION_FLUSH_INTERVAL = float(os.environ.get("SESSION_FLUSH_INTERVAL", "2.0"))
+
+# ストレージ操作用のワーカースレッド数（同じセッションの操作は同じスレッドで順番に実行）
+STORAGE_WORKERS = int(os.environ.get("STORAGE_WORKERS", "4"))
+
+# メッセージ書き込みのグループコミット: この時間（ミリ秒）内またはこの件数までをまとめて書き込む
+WRITE_BATCH_WINDOW_MS = float(os.environ.get("WRITE_BATCH_WINDOW_MS", "10"))
+WRITE_BATCH_MAX = int(os.environ.get("WRITE_BATCH_MAX", "100"))
+
+# ワーカー間のpub/sub: memory（ワーカー1つ） | unix（複数ワーカー, src.tools.pubsub_broker に接続）
+# unix の場合はセッション情報などを他のワーカーと共有する前提で読み書きする
+PUBSUB_BACKEND = os.environ.get("PUBSUB_BACKEND", "memory")
+PUBSUB_SOCKET = os.environ.get("PUBSUB_SOCKET", "data/pubsub.sock")
+# ブローカーとの接続の回復・応答を待つ上限（秒）。超えた操作はエラーにする
+PUBSUB_TIMEOUT = float(os.environ.get("PUBSUB_TIMEOUT", "5"))
@@ -1,71 +1,298 @@
+import io
 import csv
 import json
-from typing import List, Dict
+import time
+import zlib
+import textwrap
+from typing import Dict, Iterable, Iterator, List, Optional
 from pathlib import Path
 from datetime import datetime
-from ..models.message import Message
+from ..models.message import MessageRecord
 from ..models.session import Session
 from ..managers.session_manager import SessionManager
 from ..managers.message_store import MessageStore
+from .. import metrics
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # 列指向形式（Parquet / Arrow）でのエクスポートにのみ必要
+    pa = None
+    pq = None
+
+# エクスポートにかかった時間（最後まで出力したもののみ）
+EXPORT_SECONDS = metrics.histogram(
+    "chat_export_duration_seconds", "Duration of completed message exports", ("format",),
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+)
+
+MESSAGE_CSV_HEADER = [
+    'message_id',
+    'session_id',
+    'client_id',
+    'message_type',
+    'content',
+    'timestamp',
+    'char_count',
+    'word_count',
+    'client_color'
+]
 
 
 class DataExporter:
     """データエクスポートクラス"""
     
+    # ストリーミングでエクスポートできる形式と Content-Type
+    STREAM_FORMATS = {
+        "csv": "text/csv",
+        "json": "application/json",
+        "ndjson": "application/x-ndjson",
+    }
+    COMPRESSIONS = (None, "gzip")
+    CHUNK_SIZE = 64 * 1024
+    # 列指向形式（pyarrow が必要）
+    COLUMNAR_FORMATS = ("parquet", "arrow")
+    # pyarrow がない場合のエラーメッセージ（APIのエラーにもそのまま使う）
+    COLUMNAR_UNAVAILABLE = (
+        "Parquet/Arrow export requires pyarrow: "
+        "pip install pyarrow (or pip install -r requirements-optional.txt)"
+    )
+    # 列指向形式で1回に書き出す行数（row group / record batch の大きさ）
+    COLUMNAR_BATCH_SIZE = 10000
+    
     def __init__(self, export_dir: str = "exports"):
         self.export_dir = Path(export_dir)
         self.export_dir.mkdir(parents=True, exist_ok=True)
     
     def export_messages_to_csv(self, session_id: str, message_store: MessageStore) -> str:
         """メッセージをCSV形式でエクスポート"""
-        messages = message_store.get_messages_by_session(session_id)
-        
+        return self.export_messages(session_id, message_store, "csv")
+    
+    def export_messages_to_json(self, session_id: str, message_store: MessageStore) -> str:
+        """メッセージをJSON形式でエクスポート"""
+        return self.export_messages(session_id, message_store, "json")
+    
+    def export_messages(self, session_id: str, message_store: MessageStore, format: str,
+                        compress: Optional[str] = None) -> str:
+        """メッセージを指定した形式でファイルに書き出す（1件ずつ書き込む）"""
+        # ファイルを作る前に確認する（stream_messages は最初の next() まで何もしない）
+        self._check_stream_format(format, compress, self.STREAM_FORMATS)
+        filepath = self.export_dir / self.export_filename(session_id, format, compress)
+        with open(filepath, 'wb') as f:
+            for chunk in self.stream_messages(session_id, message_store, format, compress):
+                f.write(chunk)
+        return str(filepath)
+    
+    @classmethod
+    def _check_stream_format(cls, format: str, compress: Optional[str], formats):
+        if format not in formats:
+            raise ValueError(f"Unknown export format: {format}")
+        if compress not in cls.COMPRESSIONS:
+            raise ValueError(f"Unknown compression: {compress}")
+    
+    @classmethod
+    def export_filename(cls, session_id: str, format: str, compress: Optional[str] = None) -> str:
+        """エクスポートファイル名"""
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"messages_{session_id}_{timestamp}.csv"
-        filepath = self.export_dir / filename
+        filename = f"messages_{session_id}_{timestamp}.{format}"
+        return filename + ".gz" if compress == "gzip" else filename
+    
+    def stream_messages(self, session_id: str, message_store: MessageStore, format: str = "json",
+                        compress: Optional[str] = None) -> Iterator[bytes]:
+        """メッセージをエクスポート形式のバイト列として少しずつ返す
         
-        with open(filepath, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            
-            # ヘッダー
-            writer.writerow([
-                'message_id',
-                'session_id',
-                'client_id',
-                'message_type',
-                'content',
-                'timestamp',
-                'char_count',
-                'word_count',
-                'client_color'
-            ])
-            
-            # データ行
-            for msg in messages:
-                writer.writerow(msg.to_csv_row())
+        ストレージから1件ずつ読みながら変換するため、セッションの大きさによらずメモリ使用量は一定。
+        エクスポート開始時点のメッセージまでを出力する。
+        ジェネレーターなので、件数の取得などのストレージへのアクセスは最初の next() で行う。
+        """
+        self._check_stream_format(format, compress, self.STREAM_FORMATS)
         
-        return str(filepath)
+        total = message_store.get_messages_count(session_id)
+        messages = message_store.iter_messages(session_id, limit=total)
+        if format == "csv":
+            chunks = self._csv_chunks(messages)
+        elif format == "json":
+            chunks = self._json_chunks(session_id, total, messages)
+        else:
+            chunks = self._ndjson_chunks(messages)
+        
+        chunks = self._buffered(chunks)
+        if compress == "gzip":
+            chunks = self._gzipped(chunks)
+        yield from self._timed(chunks, format)
     
-    def export_messages_to_json(self, session_id: str, message_store: MessageStore) -> str:
-        """メッセージをJSON形式でエクスポート"""
-        messages = message_store.get_messages_by_session(session_id)
+    # 全セッションをまとめてストリーミングできる形式
+    MERGED_STREAM_FORMATS = ("csv", "ndjson")
+    
+    def stream_all_messages(self, message_store: MessageStore, format: str = "ndjson",
+                            compress: Optional[str] = None, since: Optional[str] = None,
+                            until: Optional[str] = None, client_id: Optional[str] = None,
+                            session_ids: Optional[List[str]] = None) -> Iterator[bytes]:
+        """全セッションのメッセージをタイムスタンプ順に1つのストリームとして返す
         
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"messages_{session_id}_{timestamp}.json"
-        filepath = self.export_dir / filename
+        セッションごとのログをマージしながら出力するため、データ全体の大きさによらずメモリ使用量は一定。
+        ジェネレーターなので、セッション一覧の取得などは最初の next() で行う。
+        """
+        self._check_stream_format(format, compress, self.MERGED_STREAM_FORMATS)
         
-        data = {
+        messages = message_store.iter_all_messages(
+            since=since, until=until, client_id=client_id, session_ids=session_ids
+        )
+        chunks = self._csv_chunks(messages) if format == "csv" else self._ndjson_chunks(messages)
+        chunks = self._buffered(chunks)
+        if compress == "gzip":
+            chunks = self._gzipped(chunks)
+        yield from self._timed(chunks, format)
+    
+    @staticmethod
+    def _timed(chunks: Iterable[bytes], format: str) -> Iterator[bytes]:
+        """最後まで出力し終えたらかかった時間を記録"""
+        start = time.perf_counter()
+        yield from chunks
+        EXPORT_SECONDS.labels(format).observe(time.perf_counter() - start)
+    
+    @staticmethod
+    def _csv_chunks(messages: Iterable[MessageRecord]) -> Iterator[bytes]:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        # ヘッダー
+        writer.writerow(MESSAGE_CSV_HEADER)
+        # データ行
+        for msg in messages:
+            writer.writerow(msg.to_csv_row())
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue().encode("utf-8")
+    
+    @staticmethod
+    def _json_chunks(session_id: str, total: int, messages: Iterable[MessageRecord]) -> Iterator[bytes]:
+        # json.dump(indent=2) と同じ形になるように、メッセージ部分だけを1件ずつ書き出す
+        header = json.dumps({
             "session_id": session_id,
             "exported_at": datetime.now().isoformat(),
-            "total_messages": len(messages),
-            "messages": [msg.to_dict() for msg in messages]
-        }
+            "total_messages": total,
+        }, ensure_ascii=False, indent=2)
+        yield (header[:-2] + ',\n  "messages": [').encode("utf-8")
+        separator = "\n"
+        for msg in messages:
+            body = json.dumps(msg.to_dict(), ensure_ascii=False, indent=2)
+            yield (separator + textwrap.indent(body, "    ")).encode("utf-8")
+            separator = ",\n"
+        yield ("\n  ]\n}" if separator == ",\n" else "]\n}").encode("utf-8")
+    
+    @staticmethod
+    def _ndjson_chunks(messages: Iterable[MessageRecord]) -> Iterator[bytes]:
+        for msg in messages:
+            yield json.dumps(msg.to_dict(), ensure_ascii=False).encode("utf-8") + b"\n"
+    
+    @classmethod
+    def _buffered(cls, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """小さな断片をまとめて CHUNK_SIZE 程度のブロックにする"""
+        buffer = bytearray()
+        for chunk in chunks:
+            buffer += chunk
+            if len(buffer) >= cls.CHUNK_SIZE:
+                yield bytes(buffer)
+                buffer.clear()
+        if buffer:
+            yield bytes(buffer)
+    
+    @staticmethod
+    def _gzipped(chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """gzip形式で逐次圧縮"""
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    
+    @staticmethod
+    def columnar_available() -> bool:
+        """列指向形式でのエクスポートが使えるか（pyarrow がインストールされているか）"""
+        return pa is not None
+    
+    @staticmethod
+    def message_schema():
+        """列指向形式でのメッセージのスキーマ"""
+        return pa.schema([
+            ("session_id", pa.string()),
+            ("seq", pa.int64()),
+            ("message_id", pa.string()),
+            ("client_id", pa.string()),
+            ("message_type", pa.string()),
+            ("content", pa.string()),
+            ("timestamp", pa.timestamp("us")),
+            ("char_count", pa.int32()),
+            ("word_count", pa.int32()),
+            ("client_color", pa.string()),
+        ])
+    
+    def export_messages_columnar(self, session_id: str, message_store: MessageStore,
+                                 format: str = "parquet") -> str:
+        """セッションのメッセージを列指向形式（Parquet / Arrow IPC）でエクスポート"""
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        filename = f"messages_{session_id}_{timestamp}.{format}"
+        return self._write_columnar(self.export_dir / filename, format, message_store, [session_id])
+    
+    def export_all_messages_columnar(self, message_store: MessageStore, format: str = "parquet",
+                                     session_ids: Optional[List[str]] = None) -> str:
+        """全セッション（または指定したセッション）のメッセージを1つのデータセットとしてエクスポート"""
+        if session_ids is None:
+            session_ids = sorted(message_store.log.session_ids())
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        filename = f"all_messages_{timestamp}.{format}"
+        return self._write_columnar(self.export_dir / filename, format, message_store, session_ids)
+    
+    def _write_columnar(self, filepath: Path, format: str, message_store: MessageStore,
+                        session_ids: List[str]) -> str:
+        """セッションのメッセージを COLUMNAR_BATCH_SIZE 行ずつ列指向形式で書き出す"""
+        if format not in self.COLUMNAR_FORMATS:
+            raise ValueError(f"Unknown columnar format: {format}")
+        if not self.columnar_available():
+            raise RuntimeError(self.COLUMNAR_UNAVAILABLE)
         
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        start = time.perf_counter()
+        schema = self.message_schema()
+        if format == "parquet":
+            writer = pq.ParquetWriter(str(filepath), schema, compression="zstd")
+        else:
+            # Arrow IPC（Feather v2）ファイル: 読み込み側でメモリマップしてそのまま使える
+            writer = pa.ipc.new_file(str(filepath), schema)
         
+        try:
+            rows = []
+            for session_id in session_ids:
+                total = message_store.get_messages_count(session_id)
+                for seq, msg in enumerate(message_store.iter_messages(session_id, limit=total), start=1):
+                    rows.append((seq, msg))
+                    if len(rows) >= self.COLUMNAR_BATCH_SIZE:
+                        writer.write_batch(self._record_batch(schema, rows))
+                        rows = []
+            if rows:
+                writer.write_batch(self._record_batch(schema, rows))
+        finally:
+            writer.close()
+        EXPORT_SECONDS.labels(format).observe(time.perf_counter() - start)
         return str(filepath)
     
+    @staticmethod
+    def _record_batch(schema, rows: List) -> "pa.RecordBatch":
+        """(seq, MessageRecord) の一覧から列ごとの配列を作る"""
+        return pa.RecordBatch.from_arrays([
+            pa.array([msg.session_id for _, msg in rows], pa.string()),
+            pa.array([seq for seq, _ in rows], pa.int64()),
+            pa.array([msg.message_id for _, msg in rows], pa.string()),
+            pa.array([msg.client_id for _, msg in rows], pa.string()),
+            pa.array([msg.message_type for _, msg in rows], pa.string()),
+            pa.array([msg.content for _, msg in rows], pa.string()),
+            pa.array([_parse_timestamp(msg.timestamp) for _, msg in rows], pa.timestamp("us")),
+            pa.array([msg.char_count for _, msg in rows], pa.int32()),
+            pa.array([msg.word_count for _, msg in rows], pa.int32()),
+            pa.array([msg.client_color for _, msg in rows], pa.string()),
+        ], schema=schema)
+    
     def export_session_summary(self, session_id: str, session_manager: SessionManager, 
                               message_store: MessageStore) -> str:
         """セッションサマリーをエクスポート"""
@@ -152,3 +379,14 @@ class DataExporter:
         
         return str(filepath)
 
+
+
+def _parse_timestamp(value: str) -> Optional[datetime]:
+    """ISO 8601 の文字列を日時に変換（タイムゾーン付きはローカル時刻に揃える、解釈できなければ None）"""
+    try:
+        parsed = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed
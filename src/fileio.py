@@ -0,0 +1,116 @@
+"""ファイルの安全な書き込み
+
+ファイルは同じディレクトリの一時ファイル（*.tmp）に書いてから os.replace で置き換えるため、
+書き込みの途中で落ちても元のファイルか新しいファイルのどちらかが残り、中途半端な内容にはならない。
+置き換えをディスクまで反映するには、ファイルとディレクトリの両方を fsync する。
+"""
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Union
+
+# 書き込み途中の一時ファイルの拡張子（回復処理で古いものを削除する）
+TMP_SUFFIX = ".tmp"
+
+# always（書き込みごとに fsync） | batch（batch() の中の書き込みをまとめて fsync） | never（OSに任せる）
+FSYNC_POLICIES = ("always", "batch", "never")
+
+
+def tmp_path(path: Path) -> Path:
+    """path を置き換えるための一時ファイルのパス
+
+    プロセスIDとスレッドIDを含め、複数のワーカーやスレッドが同じファイルを同時に置き換えても
+    互いの一時ファイルを上書きしないようにする（<name>.<pid>.<thread>.tmp）。
+    """
+    return path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}{TMP_SUFFIX}")
+
+
+def fsync_directory(directory: Path):
+    """ディレクトリを fsync（ファイルの作成・置き換えを反映する）"""
+    if os.name != "posix":
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_tmp(path: Path, data: Union[bytes, str], fsync: bool) -> Path:
+    tmp_file = tmp_path(path)
+    with open(tmp_file, 'wb') as f:
+        f.write(data.encode("utf-8") if isinstance(data, str) else data)
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+    return tmp_file
+
+
+def atomic_write(path: Union[str, Path], data: Union[bytes, str], fsync: bool = True):
+    """ファイルを data で置き換える（fsync=False の場合は置き換えの原子性だけを保証する）"""
+    path = Path(path)
+    tmp_file = _write_tmp(path, data, fsync)
+    try:
+        os.replace(tmp_file, path)
+    except OSError:
+        tmp_file.unlink(missing_ok=True)
+        raise
+    if fsync:
+        fsync_directory(path.parent)
+
+
+class AtomicWriter:
+    """fsync ポリシーに従ってファイルを置き換える
+
+    batch ポリシーでは、batch() の中の書き込みは一時ファイルに書くだけにしておき、
+    抜けるときにまとめて fsync してから置き換え、ディレクトリの fsync はディレクトリごとに1回にする。
+    batch() の外の書き込みと always ポリシーでは、書き込みごとにファイルとディレクトリを fsync する。
+    途中で例外が起きた場合はどのファイルも置き換えない。
+    """
+
+    def __init__(self, fsync_policy: str = "batch"):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync_policy}")
+        self.fsync_policy = fsync_policy
+        # batch() の中で書いた {置き換え先: 一時ファイル}（スレッドごと）
+        self._local = threading.local()
+
+    def _pending(self) -> Dict[Path, Path]:
+        return getattr(self._local, "pending", None)
+
+    def write(self, path: Union[str, Path], data: Union[bytes, str]):
+        """ファイルを data で置き換える（batch() の中では抜けるときに置き換える）"""
+        path = Path(path)
+        pending = self._pending()
+        if pending is None or self.fsync_policy == "always":
+            atomic_write(path, data, fsync=self.fsync_policy != "never")
+            return
+        # 同じファイルへの2回目以降の書き込みは（同じスレッドなので）同じ一時ファイルを上書きする
+        pending.pop(path, None)
+        pending[path] = _write_tmp(path, data, fsync=False)
+
+    @contextmanager
+    def batch(self):
+        """中で書いたファイルをまとめて fsync して置き換える（入れ子の場合は一番外側で置き換える）"""
+        if self._pending() is not None:
+            yield
+            return
+        pending = self._local.pending = {}
+        try:
+            yield
+            fsync = self.fsync_policy != "never"
+            if fsync:
+                for tmp_file in pending.values():
+                    with open(tmp_file, 'rb') as f:
+                        os.fsync(f.fileno())
+            for path, tmp_file in pending.items():
+                os.replace(tmp_file, path)
+            if fsync:
+                for directory in {path.parent for path in pending}:
+                    fsync_directory(directory)
+            pending.clear()
+        finally:
+            self._local.pending = None
+            for tmp_file in pending.values():
+                tmp_file.unlink(missing_ok=True)
@@ -1,21 +1,29 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Form, Cookie
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Form, Cookie, Query
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from fastapi import Request
-from fastapi.responses import FileResponse, JSONResponse, RedirectResponse, Response
-from typing import Dict, Optional
+from fastapi.responses import FileResponse, JSONResponse, RedirectResponse, Response, StreamingResponse
+from typing import Dict, List, Optional
 import json
+import asyncio
+import time
 import random
 import os
-import hashlib
 import secrets
 from datetime import datetime
-from pathlib import Path
 
+from . import config, metrics
+from .admin_auth import get_admin_password_hash, set_admin_password, verify_admin_password
 from .models.session import Session
 from .models.message import Message
 from .managers.session_manager import SessionManager
 from .managers.message_store import MessageStore
+from .managers.sqlite_store import SQLiteMessageLog, SQLiteSessionManager
+from .managers.connection_manager import ConnectionManager
+from .managers.pubsub import create_pubsub
+from .managers.async_storage import AsyncStorage
+from .managers.batch_writer import BatchWriter
+from .managers.data_recovery import RecoveryScanner
 from .exporters.data_exporter import DataExporter
 
 def generate_random_color():
@@ -27,106 +35,287 @@ app = FastAPI()
 app.mount("/static", StaticFiles(directory="src/static"), name="static")
 templates = Jinja2Templates(directory="src/templates")
 
-# 接続中のクライアントを保持する辞書
-# key: クライアントID, value: WebSocket接続
-active_connections: Dict[str, WebSocket] = {}
+# ワーカー間でブロードキャスト・クライアントID・管理者トークンを共有する（ワーカー1つならプロセス内）
+pubsub = create_pubsub(config.PUBSUB_BACKEND, config.PUBSUB_SOCKET, timeout=config.PUBSUB_TIMEOUT)
+# 複数ワーカーの場合は保存先も他のワーカーと共有する前提で読み書きする
+shared_storage = config.PUBSUB_BACKEND != "memory"
+
+# 接続中のクライアントとセッションごとのルームを管理
+connection_manager = ConnectionManager(
+    send_timeout=config.WS_SEND_TIMEOUT,
+    pubsub=pubsub,
+    queue_size=config.WS_QUEUE_SIZE,
+    overflow_policy=config.WS_OVERFLOW_POLICY,
+    replay_size=config.WS_REPLAY_BUFFER_SIZE
+)
 client_colors: Dict[str, str] = {} # クライアントIDと色の対応を保持
-client_sessions: Dict[str, str] = {} # クライアントIDとセッションIDの対応を保持
+
+# /metrics で公開する値（出力時に集計するもの）
+metrics.gauge(
+    "chat_connected_clients", "Clients connected to each session on this worker", ("session_id",),
+    collect=lambda: {(session_id,): len(room) for session_id, room in connection_manager.rooms.items()}
+)
+metrics.gauge(
+    "chat_websocket_connections", "Open WebSocket connections on this worker", ("kind",),
+    collect=lambda: {("chat",): len(connection_manager.active_connections),
+                     ("admin",): len(connection_manager.admin_connections)}
+)
+metrics.gauge(
+    "chat_outbound_queue_depth", "Frames waiting in outbound queues on this worker",
+    collect=lambda: {(): connection_manager.metrics()["total_depth"]}
+)
+EVENT_LOOP_LAG = metrics.histogram(
+    "chat_event_loop_lag_seconds", "Delay between a scheduled wake-up and when the event loop ran it"
+)
+EVENT_LOOP_LAG_INTERVAL = 0.5
+
+# セッションを終了したストレージのスレッドからイベントループに処理を頼むため、起動時にループを記録する
+main_loop: Optional[asyncio.AbstractEventLoop] = None
+
+def on_session_ended(session: Session):
+    """セッションの終了時に（ストレージのスレッドで）呼ばれ、メッセージのアーカイブをバックグラウンドで始める"""
+    if main_loop is not None:
+        main_loop.call_soon_threadsafe(
+            lambda: start_background_task(archive_session_messages(session.session_id))
+        )
 
 # データ管理のインスタンス
-session_manager = SessionManager()
-message_store = MessageStore()
+message_archive = None if config.MESSAGE_ARCHIVE == "off" else config.MESSAGE_ARCHIVE
+session_ended_listener = on_session_ended if message_archive else None
+if config.STORAGE_BACKEND == "sqlite":
+    session_manager = SQLiteSessionManager(db_path=config.SQLITE_PATH, shared=shared_storage,
+                                           on_session_ended=session_ended_listener)
+    message_store = MessageStore(log=SQLiteMessageLog(
+        config.SQLITE_PATH,
+        fsync_policy=config.MESSAGE_LOG_FSYNC,
+        fsync_interval=config.MESSAGE_LOG_FSYNC_INTERVAL
+    ), shared=shared_storage, archive=message_archive, archive_segment_size=config.MESSAGE_ARCHIVE_SEGMENT_SIZE)
+elif config.STORAGE_BACKEND == "json":
+    session_manager = SessionManager(shared=shared_storage, fsync_policy=config.SESSION_FSYNC,
+                                     on_session_ended=session_ended_listener)
+    message_store = MessageStore(
+        log_format=config.MESSAGE_LOG_FORMAT,
+        fsync_policy=config.MESSAGE_LOG_FSYNC,
+        fsync_interval=config.MESSAGE_LOG_FSYNC_INTERVAL,
+        shared=shared_storage,
+        archive=message_archive,
+        archive_segment_size=config.MESSAGE_ARCHIVE_SEGMENT_SIZE
+    )
+else:
+    raise ValueError(f"Unknown storage backend: {config.STORAGE_BACKEND}")
 data_exporter = DataExporter()
+# 起動時のデータディレクトリの検査・修復（結果は /api/storage/recovery で確認できる）
+recovery_scanner = RecoveryScanner(session_manager, message_store, workers=config.RECOVERY_SCAN_WORKERS)
+# ファイルI/Oはイベントループの外で実行する（セッションごとに順序を保証）
+storage = AsyncStorage(workers=config.STORAGE_WORKERS)
+
+def message_event(message_type: str, client_id: str, content: str, timestamp: str, seq: int) -> dict:
+    """保存したメッセージをクライアントに送るイベントに変換"""
+    if message_type == "message":
+        return {"type": "message", "client_id": client_id, "message": content, "timestamp": timestamp, "seq": seq}
+    return {"type": message_type, "message": content, "timestamp": timestamp, "seq": seq}
+
+async def publish_committed_messages(session_id: str, messages, first_seq: int, totals: Dict):
+    """書き込んだメッセージをメッセージ番号（seq）付きでルームに配信し、統計の変化を管理画面に通知
+    
+    書き込みと同じ順に呼ばれるため、ルームにも seq 順に届く。
+    """
+    for seq, m in enumerate(messages, start=first_seq):
+        await connection_manager.broadcast(
+            session_id, message_event(m.message_type, m.client_id, m.content, m.timestamp, seq)
+        )
+    
+    added = sum(1 for m in messages if m.message_type == "message")
+    if added:
+        await connection_manager.notify_admins({
+            "type": "messages",
+            "session_id": session_id,
+            "added": added,
+            **totals
+        }, key=f"messages:{session_id}")
+
+# メッセージの書き込みを短い時間窓でまとめる（グループコミット）
+batch_writer = BatchWriter(
+    storage, message_store, session_manager,
+    window=config.WRITE_BATCH_WINDOW_MS / 1000,
+    max_batch=config.WRITE_BATCH_MAX,
+    listener=publish_committed_messages
+)
+
+# 圧縮中にメッセージが届いてアーカイブに移せなかった場合にやり直すまでの間隔（秒）
+ARCHIVE_RETRY_DELAYS = (1, 5, 30)
+
+async def archive_session_messages(session_id: str):
+    """終了したセッションのメッセージを圧縮アーカイブに移す（バックグラウンドで実行）
+    
+    移せなかったメッセージが残っていれば、間隔を空けてやり直す。
+    """
+    for delay in (0,) + ARCHIVE_RETRY_DELAYS:
+        await asyncio.sleep(delay)
+        try:
+            if await storage.run_unordered(message_store.archive_session, session_id):
+                print(f"Archived messages of session: {session_id}")
+            if not await storage.run_unordered(message_store.unarchived_count, session_id):
+                return
+        except Exception as e:
+            print(f"Error archiving messages of session {session_id}: {e}")
+            return
+    print(f"Gave up archiving messages of session {session_id}: messages kept arriving")
+
+async def load_missed_messages(session_id: str, last_seq: int) -> List[str]:
+    """last_seq より後のメッセージを保存済みのログから読み込む（リングバッファにない場合の再送用）"""
+    page = await storage.run(session_id, message_store.get_message_page, session_id, after=last_seq)
+    return [
+        connection_manager.encode(message_event(
+            m["message_type"], m["client_id"], m["content"], m["timestamp"], m["seq"]
+        ))
+        for m in page["messages"]
+    ]
+
+async def notify_session_changed(event_type: str, session: Session):
+    """セッションの作成・更新・終了を管理画面に通知"""
+    current = await storage.run_unordered(session_manager.get_current_session)
+    await connection_manager.notify_admins({
+        "type": event_type,
+        "session": session.to_dict(),
+        "current_session_id": current.session_id if current else None
+    })
 
-# 管理者認証用
-ADMIN_PASSWORD_FILE = "data/admin_password.txt"
-admin_tokens: Dict[str, bool] = {}  # トークン: 認証済みフラグ
-
-def get_admin_password_hash() -> Optional[str]:
-    """管理者パスワードハッシュを取得"""
-    if os.path.exists(ADMIN_PASSWORD_FILE):
-        with open(ADMIN_PASSWORD_FILE, 'r') as f:
-            return f.read().strip()
-    return None
-
-def set_admin_password(password: str):
-    """管理者パスワードを設定"""
-    password_hash = hashlib.sha256(password.encode()).hexdigest()
-    Path(ADMIN_PASSWORD_FILE).parent.mkdir(parents=True, exist_ok=True)
-    with open(ADMIN_PASSWORD_FILE, 'w') as f:
-        f.write(password_hash)
-    print(f"Admin password set successfully.")
-
-def verify_admin_password(password: str) -> bool:
-    """管理者パスワードを検証"""
-    stored_hash = get_admin_password_hash()
-    if not stored_hash:
-        return False
-    password_hash = hashlib.sha256(password.encode()).hexdigest()
-    return password_hash == stored_hash
+async def notify_participants_changed(session: Session):
+    """参加者の変化を管理画面に通知"""
+    await connection_manager.notify_admins({
+        "type": "participants",
+        "session_id": session.session_id,
+        "participants": session.participants
+    }, key=f"participants:{session.session_id}")
 
-def generate_admin_token() -> str:
+# 管理者認証用（発行したトークンは pubsub で全ワーカーと共有する）
+async def generate_admin_token() -> str:
     """管理者認証トークンを生成"""
     token = secrets.token_urlsafe(32)
-    admin_tokens[token] = True
+    await pubsub.set(f"admin_token:{token}", "1")
     return token
 
-def verify_admin_token(token: Optional[str]) -> bool:
+async def verify_admin_token(token: Optional[str]) -> bool:
     """管理者トークンを検証"""
     if not token:
         return False
-    return admin_tokens.get(token, False)
+    return await pubsub.get(f"admin_token:{token}") is not None
+
+# 実行中のバックグラウンドタスク（完了するまで参照を持ち、途中でガベージコレクトされないようにする）
+background_tasks: set = set()
+
+def start_background_task(coro) -> asyncio.Task:
+    """バックグラウンドでコルーチンを実行（例外はログに出す）"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    task.add_done_callback(log_background_task_error)
+    return task
+
+def log_background_task_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Background task {task.get_coro().__qualname__} failed: {task.exception()!r}")
+
+# 起動の状態（/health で返す）
+server_state = {"ready": False, "started": time.monotonic(), "startup_seconds": None}
 
 # アプリケーション起動時の処理
 @app.on_event("startup")
 async def startup_event():
-    global session_manager
-    
-    # 管理者パスワードのチェック
-    stored_password = get_admin_password_hash()
-    if not stored_password:
-        print("\n" + "="*60)
-        print("ADMIN PASSWORD SETUP")
-        print("="*60)
-        print("No admin password found. Please set an admin password.")
-        print("You can set it via environment variable or enter it now:")
-        print()
-        
-        # 環境変数からパスワードを取得
+    global session_manager, main_loop
+    main_loop = asyncio.get_running_loop()
+    
+    # 他のワーカーとのブロードキャストの送受信を開始
+    await connection_manager.start()
+    
+    # 管理者パスワードのチェック（起動を止めないよう、標準入力からは読まない）
+    if not get_admin_password_hash():
         env_password = os.environ.get('ADMIN_PASSWORD')
         if env_password:
             set_admin_password(env_password)
             print("Admin password set from environment variable.")
         else:
-            # 標準入力からパスワードを取得
-            import getpass
-            while True:
-                password = getpass.getpass("Enter admin password: ")
-                if len(password) < 4:
-                    print("Password must be at least 4 characters long.")
-                    continue
-                confirm = getpass.getpass("Confirm admin password: ")
-                if password != confirm:
-                    print("Passwords do not match. Please try again.")
-                    continue
-                set_admin_password(password)
-                break
-        print("="*60 + "\n")
-    
-    # 既存のアクティブなセッションをチェック
-    active_sessions = session_manager.get_active_sessions()
-    
-    if active_sessions:
-        print(f"Found {len(active_sessions)} active session(s):")
-        for session in active_sessions:
-            print(f"  - {session.session_id}")
+            print("No admin password is set. The admin panel stays locked until one is set with:")
+            print("  python -m src.tools.set_admin_password  (or the ADMIN_PASSWORD environment variable)")
+    
+    # メッセージの書き込みタスクを開始
+    batch_writer.start()
+    
+    # セッションと統計情報のメモリ上の変更を定期的にディスクへ書き出す
+    start_background_task(flush_storage_periodically())
+    
+    # イベントループの遅れを計測
+    start_background_task(monitor_event_loop_lag())
+    
+    # データディレクトリの検査・修復（終わるのを待たずに接続を受け付ける）
+    if config.RECOVERY_SCAN_WORKERS > 0:
+        start_background_task(run_recovery_scan())
+    
+    # セッション一覧と現在のセッションの読み込み（終わるまで /health は 503 を返す）
+    start_background_task(load_sessions())
+
+async def load_sessions():
+    """セッション一覧のインデックス（なければ全セッションを走査して作る）と現在のセッションを読み込み、準備完了にする"""
+    try:
+        count = await storage.run_unordered(session_manager.load_catalog)
+        current_session = await storage.run_unordered(session_manager.get_current_session)
+    except Exception as e:
+        print(f"Error loading sessions: {e}")
+        return
+    print(f"Loaded {count} session(s)")
+    if current_session:
+        print(f"Current session: {current_session.session_id}")
     else:
-        print("No active sessions found. Please create a session from the admin panel.")
+        print("No active session found. Please create a session from the admin panel.")
+    
+    server_state["ready"] = True
+    server_state["startup_seconds"] = time.monotonic() - server_state["started"]
+    print(f"Server ready in {server_state['startup_seconds']:.2f}s")
+
+async def run_recovery_scan():
+    """書き込み途中で落ちたファイルなどをバックグラウンドで検査・修復"""
+    try:
+        await storage.run_unordered(recovery_scanner.scan)
+    except Exception as e:
+        print(f"Error running recovery scan: {e}")
+
+async def flush_storage_periodically():
+    """未保存のセッションと統計情報を一定間隔でディスクに書き出す"""
+    while True:
+        await asyncio.sleep(config.SESSION_FLUSH_INTERVAL)
+        try:
+            await storage.run_unordered(session_manager.flush)
+            await storage.run_unordered(message_store.flush)
+        except Exception as e:
+            print(f"Error flushing storage: {e}")
+
+async def monitor_event_loop_lag():
+    """一定間隔で起きるはずの時刻からの遅れ（重い同期処理などでループが止まっていた時間）を記録"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        EVENT_LOOP_LAG.observe(max(0.0, loop.time() - start - EVENT_LOOP_LAG_INTERVAL))
+
+# アプリケーション終了時の処理
+@app.on_event("shutdown")
+async def shutdown_event():
+    # 定期的な書き出しなどのバックグラウンドタスクを止める（未保存の分はこの後で書き出す）
+    for task in list(background_tasks):
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    # 実行中の書き込みを待ってから、未保存のセッションと未同期のメッセージログをディスクに反映
+    await batch_writer.stop()
+    await connection_manager.close()
+    storage.shutdown()
+    session_manager.close()
+    message_store.close()
 
 @app.get("/")
 async def get(request: Request):
     # アクティブなセッションがあるかチェック
-    active_sessions = session_manager.get_active_sessions()
+    active_sessions = await storage.run_unordered(session_manager.get_active_sessions)
     
     if not active_sessions:
         # アクティブなセッションがない場合は管理画面にリダイレクト
@@ -138,11 +327,11 @@ async def get(request: Request):
 async def viewer(request: Request, session_id: str, admin_token: Optional[str] = Cookie(None)):
     """管理者用のセッションビューワー（読み取り専用）"""
     # 認証チェック
-    if not verify_admin_token(admin_token):
+    if not await verify_admin_token(admin_token):
         return RedirectResponse(url="/admin/login", status_code=302)
     
     # セッションが存在するか確認
-    session = session_manager.load_session(session_id)
+    session = await storage.run(session_id, session_manager.load_session, session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     
@@ -156,15 +345,15 @@ async def chat(request: Request, client_id: str, session_id: str = None,
                session_password: str = None, user_password: str = None):
     # session_idが指定されていない場合は、現在のセッションを使用
     if not session_id:
-        current_session = session_manager.get_current_session()
+        current_session = await storage.run_unordered(session_manager.get_current_session)
         session_id = current_session.session_id if current_session else "no_session"
         session = current_session
     else:
         # 指定されたセッションが存在するか確認
-        session = session_manager.load_session(session_id)
+        session = await storage.run(session_id, session_manager.load_session, session_id)
         if not session or session.status != "active":
             # セッションが存在しないか終了している場合は、現在のセッションを使用
-            current_session = session_manager.get_current_session()
+            current_session = await storage.run_unordered(session_manager.get_current_session)
             session_id = current_session.session_id if current_session else "no_session"
             session = current_session
     
@@ -206,7 +395,7 @@ async def websocket_viewer_endpoint(websocket: WebSocket, session_id: str):
     
     # セッションが存在するか確認
     if session_id:
-        session = session_manager.load_session(session_id)
+        session = await storage.run(session_id, session_manager.load_session, session_id)
         if not session:
             await websocket.close(code=1000, reason="Session not found")
             return
@@ -214,10 +403,9 @@ async def websocket_viewer_endpoint(websocket: WebSocket, session_id: str):
         await websocket.close(code=1000, reason="Session ID required")
         return
     
-    # 管理者ID（特殊なID）
-    viewer_id = f"admin_viewer_{id(websocket)}"
-    active_connections[viewer_id] = websocket
-    client_sessions[viewer_id] = session_id
+    # 管理者ID（特殊なID、ワーカーをまたいで重ならないようにランダムにする）
+    viewer_id = f"admin_viewer_{secrets.token_hex(8)}"
+    await connection_manager.connect(viewer_id, session_id, websocket)
     
     print(f"[Viewer] Admin connected to session: {session_id}")
     
@@ -229,10 +417,10 @@ async def websocket_viewer_endpoint(websocket: WebSocket, session_id: str):
             # 管理者からのメッセージは無視
             pass
     except WebSocketDisconnect:
-        if viewer_id in active_connections:
-            del active_connections[viewer_id]
-        if viewer_id in client_sessions:
-            del client_sessions[viewer_id]
+        pass
+    finally:
+        # 切断以外の例外で抜けた場合もルームから外し、IDを解放する
+        await connection_manager.disconnect(viewer_id, websocket)
         print(f"[Viewer] Admin disconnected from session: {session_id}")
 
 @app.websocket("/ws")
@@ -242,18 +430,20 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str = None):
     
     # session_idが指定されている場合は、そのセッションを使用
     if session_id:
-        session = session_manager.load_session(session_id)
+        session = await storage.run(session_id, session_manager.load_session, session_id)
         if not session or session.status != "active":
             await websocket.close(code=1000, reason="Invalid or inactive session")
             return
     else:
         # 指定されていない場合は現在のセッションを使用
-        current_session = session_manager.get_current_session()
+        current_session = await storage.run_unordered(session_manager.get_current_session)
         if not current_session:
             await websocket.close(code=1000, reason="No active session")
             return
         session_id = current_session.session_id
     
+    # ルームに登録できたか（登録した接続だけ後片付けする）
+    joined = False
     try:
         while True:
             data = await websocket.receive_json()
@@ -261,19 +451,28 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str = None):
                 # クライアントIDがまだ設定されていない場合、初期メッセージから取得
                 if "client_id" in data:
                     client_id = data["client_id"]
-                    if client_id in active_connections:
-                        # 同じクライアントIDが既に接続されている場合は拒否
+                    # セッションのルームに登録（同じクライアントIDがいずれかのワーカーで接続中なら拒否）
+                    if not await connection_manager.connect(client_id, session_id, websocket):
                         print(f"Client ID {client_id} already in use.")
                         await websocket.close(code=1000, reason="Client ID already in use")
                         return
+                    joined = True
                     
-                    active_connections[client_id] = websocket
-                    client_sessions[client_id] = session_id  # セッションIDを記録
+                    # 再接続の場合は、最後に受信したメッセージ番号より後を再送
+                    last_seq = data.get("last_seq")
+                    if isinstance(last_seq, int) and last_seq >= 0:
+                        replayed = await connection_manager.resume(
+                            client_id, session_id, last_seq,
+                            lambda after: load_missed_messages(session_id, after)
+                        )
+                        print(f"Resumed {client_id} after seq {last_seq} ({replayed} messages)")
                     
                     # セッションに参加者を追加
-                    session_manager.add_participant(session_id, client_id)
+                    session = await storage.run(session_id, session_manager.add_participant, session_id, client_id)
+                    if session:
+                        await notify_participants_changed(session)
                     
-                    # システムメッセージを作成・保存
+                    # システムメッセージを作成・保存（書き込み後にルームへ配信される）
                     join_message = Message(
                         session_id=session_id,
                         client_id=client_id,
@@ -281,14 +480,7 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str = None):
                         content=f"Client {client_id} has joined the room",
                         timestamp=data["timestamp"]
                     )
-                    message_store.save_message(join_message)
-                    
-                    message = {
-                        "type": "system",
-                        "message": f"Client {client_id} has joined the room",
-                        "timestamp": data["timestamp"]
-                    }
-                    await broadcast_message(message)
+                    await batch_writer.submit(join_message)
                 else:
                     print("No client_id provided in initial message")
                     await websocket.close(code=1000, reason="client_id required")
@@ -302,31 +494,24 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str = None):
                     content=data["message"],
                     timestamp=data["timestamp"]
                 )
-                message_store.save_message(user_message)
-                
-                # セッションのメッセージ数をインクリメント
-                session_manager.increment_message_count(session_id)
-                
-                message = {
-                    "type": "message",
-                    "client_id": client_id,
-                    "message": data["message"],
-                    "timestamp": data["timestamp"],
-                }
-                await broadcast_message(message)
+                # （セッションのメッセージ数も書き込み時にまとめてインクリメントされ、
+                # 書き込み後にメッセージ番号付きでルームへ配信される）
+                await batch_writer.submit(user_message)
             elif data["type"] == "join":
                 # 新規参加者の通知（既に上で処理済み）
                 pass
 
     except WebSocketDisconnect:
-        if client_id:
-            if client_id in active_connections:
-                del active_connections[client_id]
-            if client_id in client_sessions:
-                del client_sessions[client_id]
+        pass
+    finally:
+        # 切断以外の例外（不正なメッセージなど）で抜けた場合も、IDの解放とルームからの退出を行う
+        if joined:
+            await connection_manager.disconnect(client_id, websocket)
             
             # セッションから参加者を削除
-            session_manager.remove_participant(session_id, client_id)
+            session = await storage.run(session_id, session_manager.remove_participant, session_id, client_id)
+            if session:
+                await notify_participants_changed(session)
             
             # 切断メッセージを保存
             leave_message = Message(
@@ -336,19 +521,7 @@ async def websocket_endpoint(websocket: WebSocket, session_id: str = None):
                 content=f"Client {client_id} has left the room",
                 timestamp=datetime.now().isoformat()
             )
-            message_store.save_message(leave_message)
-            
-            message = {
-                "type": "system",
-                "message": f"Client {client_id} has left the room",
-                "timestamp": datetime.now().isoformat()
-            }
-            await broadcast_message(message)
-
-async def broadcast_message(message: dict):
-    """全ての接続中のクライアントにメッセージをブロードキャストする"""
-    for connection in active_connections.values():
-        await connection.send_json(message)
+            await batch_writer.submit(leave_message)
 
 # ========== 管理API エンドポイント ==========
 
@@ -361,7 +534,7 @@ async def admin_login_page(request: Request):
 async def admin_authenticate(password: str = Form(...)):
     """管理者認証"""
     if verify_admin_password(password):
-        token = generate_admin_token()
+        token = await generate_admin_token()
         response = RedirectResponse(url="/admin", status_code=302)
         response.set_cookie(key="admin_token", value=token, httponly=True, max_age=86400)  # 24時間有効
         return response
@@ -370,8 +543,10 @@ async def admin_authenticate(password: str = Form(...)):
         return RedirectResponse(url="/admin/login?error=1", status_code=302)
 
 @app.get("/admin/logout")
-async def admin_logout():
+async def admin_logout(admin_token: Optional[str] = Cookie(None)):
     """管理者ログアウト"""
+    if admin_token:
+        await pubsub.delete(f"admin_token:{admin_token}")
     response = RedirectResponse(url="/admin/login", status_code=302)
     response.delete_cookie(key="admin_token")
     return response
@@ -380,15 +555,57 @@ async def admin_logout():
 async def admin_page(request: Request, admin_token: Optional[str] = Cookie(None)):
     """管理画面"""
     # 認証チェック
-    if not verify_admin_token(admin_token):
+    if not await verify_admin_token(admin_token):
         return RedirectResponse(url="/admin/login", status_code=302)
     
     return templates.TemplateResponse("admin.html", {"request": request})
 
-@app.get("/api/sessions")
-async def get_sessions():
-    """全セッションの取得"""
+def build_admin_snapshot() -> dict:
+    """管理画面の初期表示用のセッション一覧と、アクティブなセッションの統計"""
     sessions = session_manager.get_all_sessions()
+    current = session_manager.get_current_session()
+    return {
+        "type": "snapshot",
+        "sessions": [s.to_dict() for s in sessions],
+        "statistics": {
+            s.session_id: message_store.get_statistics_totals(s.session_id)
+            for s in sessions if s.status == "active"
+        },
+        "current_session_id": current.session_id if current else None
+    }
+
+@app.websocket("/ws/admin")
+async def websocket_admin_events(websocket: WebSocket):
+    """管理画面へのイベントストリーム
+    
+    接続時に一覧を1回送り、以降はセッションの作成・終了・削除、参加者や統計の変化があったときだけ送る。
+    """
+    await websocket.accept()
+    if not await verify_admin_token(websocket.cookies.get("admin_token")):
+        await websocket.close(code=1008, reason="Unauthorized")
+        return
+    
+    # 一覧を作っている間の変更も届くよう、先に送信先に登録する
+    admin_id = f"admin_events_{secrets.token_hex(8)}"
+    connection_manager.connect_admin(admin_id, websocket)
+    try:
+        snapshot = await storage.run_unordered(build_admin_snapshot)
+        await connection_manager.send(admin_id, snapshot)
+        while True:
+            data = await websocket.receive_json()
+            if data.get("type") == "refresh":
+                # 手動更新: 一覧を送り直す
+                snapshot = await storage.run_unordered(build_admin_snapshot)
+                await connection_manager.send(admin_id, snapshot)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await connection_manager.disconnect_admin(admin_id, websocket)
+
+@app.get("/api/sessions")
+async def get_sessions(status: Optional[str] = None):
+    """全セッションの取得（statusで絞り込み可能: active | ended）"""
+    sessions = await storage.run_unordered(session_manager.get_all_sessions, status=status)
     return JSONResponse(content={
         "sessions": [s.to_dict() for s in sessions]
     })
@@ -396,34 +613,107 @@ async def get_sessions():
 @app.get("/api/sessions/{session_id}")
 async def get_session(session_id: str):
     """特定のセッション情報を取得"""
-    summary = session_manager.get_session_summary(session_id)
+    summary = await storage.run(session_id, session_manager.get_session_summary, session_id)
     if not summary:
         raise HTTPException(status_code=404, detail="Session not found")
     return JSONResponse(content=summary)
 
 @app.get("/api/sessions/{session_id}/messages")
-async def get_session_messages(session_id: str):
-    """セッションのメッセージを取得"""
-    messages = message_store.get_messages_by_session(session_id)
-    return JSONResponse(content={
-        "messages": [m.to_dict() for m in messages]
-    })
+async def get_session_messages(session_id: str, limit: Optional[int] = Query(None, ge=1),
+                               before: Optional[int] = Query(None, ge=0), after: Optional[int] = Query(None, ge=0),
+                               since_join: Optional[str] = None):
+    """セッションのメッセージを取得
+    
+    Args:
+        limit: 取得する最大件数（省略時は全件）
+        before: このメッセージ番号（seq）より前を取得
+        after: このメッセージ番号（seq）より後を取得
+        since_join: 指定したクライアントIDが最初に入室した後のメッセージだけを取得
+    """
+    page = await storage.run(
+        session_id, message_store.get_message_page, session_id,
+        limit=limit, before=before, after=after, since_join=since_join
+    )
+    return JSONResponse(content=page)
+
+@app.get("/api/sessions/{session_id}/search")
+async def search_session_messages(session_id: str, q: str = Query(..., min_length=1),
+                                  limit: int = Query(20, ge=1, le=200), offset: int = Query(0, ge=0)):
+    """セッション内のメッセージを本文で検索（関連度の高い順）
+
+    Args:
+        q: 検索語（部分一致、大文字小文字を区別しない）
+        limit: 1ページの件数
+        offset: 先頭から読み飛ばす件数
+    """
+    result = await storage.run(session_id, message_store.search, session_id, q, limit=limit, offset=offset)
+    return JSONResponse(content=result)
+
+@app.get("/api/search")
+async def search_all_messages(q: str = Query(..., min_length=1), status: Optional[str] = None,
+                              limit: int = Query(20, ge=1, le=200), offset: int = Query(0, ge=0)):
+    """全セッションを横断してメッセージを検索（statusでセッションを絞り込み可能: active | ended）"""
+    session_ids = None
+    if status is not None:
+        entries = await storage.run_unordered(session_manager.list_session_entries, status)
+        session_ids = [entry["session_id"] for entry in entries]
+    result = await storage.run_unordered(
+        message_store.search_all, q, limit=limit, offset=offset, session_ids=session_ids
+    )
+    return JSONResponse(content=result)
 
 @app.get("/api/sessions/{session_id}/statistics")
 async def get_session_statistics(session_id: str):
     """セッションの統計情報を取得"""
-    stats = message_store.get_session_statistics(session_id)
+    stats = await storage.run(session_id, message_store.get_session_statistics, session_id)
     return JSONResponse(content=stats)
 
+@app.get("/api/storage/metrics")
+async def get_storage_metrics():
+    """書き込みキューの長さと書き込み時間の統計を取得"""
+    return JSONResponse(content={"batch_writer": batch_writer.metrics()})
+
+@app.get("/health")
+async def health():
+    """起動が完了して接続を受け付けられるか（準備中は 503）"""
+    body = {
+        "status": "ok" if server_state["ready"] else "starting",
+        "ready": server_state["ready"],
+        "startup_seconds": server_state["startup_seconds"],
+        "uptime_seconds": round(time.monotonic() - server_state["started"], 3),
+        "admin_password_set": get_admin_password_hash() is not None,
+        "recovery_scan": recovery_scanner.report["status"]
+    }
+    return JSONResponse(content=body, status_code=200 if server_state["ready"] else 503)
+
+@app.get("/api/storage/recovery")
+async def get_recovery_report():
+    """起動時のデータディレクトリの検査・修復の結果を取得"""
+    return JSONResponse(content=recovery_scanner.report)
+
+@app.get("/metrics")
+async def get_prometheus_metrics():
+    """Prometheus形式のメトリクス（接続数・書き込み件数・遅延のヒストグラムなど）"""
+    return Response(
+        content=metrics.REGISTRY.render(),
+        media_type="text/plain; version=0.0.4"
+    )
+
+@app.get("/api/connections/metrics")
+async def get_connection_metrics():
+    """WebSocket接続ごとの送信キューの長さと、破棄・まとめたフレーム数を取得"""
+    return JSONResponse(content=connection_manager.metrics())
+
 @app.post("/api/sessions/{session_id}/set_user_password")
 async def set_user_password(session_id: str, client_id: str, password: str):
     """ユーザーIDにパスワードを設定"""
-    session = session_manager.load_session(session_id)
+    session = await storage.run(session_id, session_manager.load_session, session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     
     session.set_user_password(client_id, password)
-    session_manager.update_session(session)
+    await storage.run(session_id, session_manager.update_session, session)
+    await notify_session_changed("session_updated", session)
     
     return JSONResponse(content={
         "status": "success",
@@ -433,7 +723,7 @@ async def set_user_password(session_id: str, client_id: str, password: str):
 @app.get("/api/sessions/{session_id}/check_user_password")
 async def check_user_password(session_id: str, client_id: str):
     """ユーザーIDがパスワード保護されているか確認"""
-    session = session_manager.load_session(session_id)
+    session = await storage.run(session_id, session_manager.load_session, session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     
@@ -445,12 +735,13 @@ async def check_user_password(session_id: str, client_id: str):
 @app.get("/api/sessions/current/info")
 async def get_current_session_info():
     """現在のセッション情報を取得"""
-    current_session = session_manager.get_current_session()
+    current_session = await storage.run_unordered(session_manager.get_current_session)
     if not current_session:
         raise HTTPException(status_code=404, detail="No active session")
     
-    summary = session_manager.get_session_summary(current_session.session_id)
-    stats = message_store.get_session_statistics(current_session.session_id)
+    session_id = current_session.session_id
+    summary = await storage.run(session_id, session_manager.get_session_summary, session_id)
+    stats = await storage.run(session_id, message_store.get_session_statistics, session_id)
     
     return JSONResponse(content={
         "session": summary,
@@ -458,28 +749,105 @@ async def get_current_session_info():
     })
 
 @app.post("/api/sessions/{session_id}/export")
-async def export_session_data(session_id: str, format: str = "json"):
-    """セッションデータをエクスポート"""
+async def export_session_data(session_id: str, format: str = "json", stream: bool = True,
+                              compress: Optional[str] = None):
+    """セッションデータをエクスポート
+    
+    Args:
+        format: json | csv | ndjson | parquet | arrow | complete
+        stream: True ならファイルを作らずにストレージから直接レスポンスへ書き出す
+        compress: gzip を指定すると圧縮して返す
+    """
+    if compress not in DataExporter.COMPRESSIONS:
+        raise HTTPException(status_code=400, detail="Invalid compression")
     try:
-        if format == "csv":
-            filepath = data_exporter.export_messages_to_csv(session_id, message_store)
-        elif format == "json":
-            filepath = data_exporter.export_messages_to_json(session_id, message_store)
+        if format in DataExporter.STREAM_FORMATS:
+            if stream:
+                chunks = data_exporter.stream_messages(session_id, message_store, format, compress)
+                filename = DataExporter.export_filename(session_id, format, compress)
+                return StreamingResponse(
+                    iterate_in_storage(chunks),
+                    media_type="application/gzip" if compress else DataExporter.STREAM_FORMATS[format],
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+                )
+            filepath = await storage.run_unordered(
+                data_exporter.export_messages, session_id, message_store, format, compress
+            )
+        elif format in DataExporter.COLUMNAR_FORMATS:
+            if not data_exporter.columnar_available():
+                raise HTTPException(status_code=501, detail=DataExporter.COLUMNAR_UNAVAILABLE)
+            filepath = await storage.run_unordered(
+                data_exporter.export_messages_columnar, session_id, message_store, format
+            )
         elif format == "complete":
-            files = data_exporter.export_complete_dataset(session_id, session_manager, message_store)
+            files = await storage.run_unordered(
+                data_exporter.export_complete_dataset, session_id, session_manager, message_store
+            )
             return JSONResponse(content={"files": files})
         else:
             raise HTTPException(status_code=400, detail="Invalid format")
         
         return FileResponse(filepath, filename=filepath.split('/')[-1])
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/export/messages")
+async def export_all_messages(format: str = "parquet", status: Optional[str] = None,
+                              since: Optional[str] = None, until: Optional[str] = None,
+                              client_id: Optional[str] = None, compress: Optional[str] = None):
+    """全セッションのメッセージを1つのデータセットとしてエクスポート
+    
+    Args:
+        format: parquet | arrow（列指向、セッション順） | ndjson | csv（タイムスタンプ順にストリーミング）
+        status: active | ended を指定するとそのセッションだけを含める
+        since, until: ndjson | csv の場合、タイムスタンプが since 以上 until 未満のメッセージだけを含める
+        client_id: ndjson | csv の場合、このクライアントのメッセージだけを含める
+        compress: ndjson | csv の場合、gzip を指定すると圧縮して返す
+    """
+    if format not in DataExporter.COLUMNAR_FORMATS and format not in DataExporter.MERGED_STREAM_FORMATS:
+        raise HTTPException(status_code=400, detail="Invalid format")
+    if compress not in DataExporter.COMPRESSIONS:
+        raise HTTPException(status_code=400, detail="Invalid compression")
+    session_ids = None
+    if status is not None:
+        entries = await storage.run_unordered(session_manager.list_session_entries, status)
+        session_ids = sorted(entry["session_id"] for entry in entries)
+    if format in DataExporter.MERGED_STREAM_FORMATS:
+        chunks = data_exporter.stream_all_messages(
+            message_store, format, compress, since=since, until=until,
+            client_id=client_id, session_ids=session_ids
+        )
+        filename = DataExporter.export_filename("all", format, compress)
+        return StreamingResponse(
+            iterate_in_storage(chunks),
+            media_type="application/gzip" if compress else DataExporter.STREAM_FORMATS[format],
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+        )
+    if not data_exporter.columnar_available():
+        raise HTTPException(status_code=501, detail=DataExporter.COLUMNAR_UNAVAILABLE)
+    try:
+        filepath = await storage.run_unordered(
+            data_exporter.export_all_messages_columnar, message_store, format, session_ids
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return FileResponse(filepath, filename=filepath.split('/')[-1])
+
+async def iterate_in_storage(chunks):
+    """同期イテレータをストレージ用のスレッドで1ブロックずつ進める"""
+    while True:
+        chunk = await storage.run_unordered(next, chunks, None)
+        if chunk is None:
+            break
+        yield chunk
+
 @app.post("/api/sessions/{session_id}/end")
 async def end_session(session_id: str, admin_token: Optional[str] = Cookie(None)):
     """セッションを終了"""
     # 認証チェック
-    if not verify_admin_token(admin_token):
+    if not await verify_admin_token(admin_token):
         raise HTTPException(status_code=401, detail="Unauthorized")
     # このセッションに接続している全ユーザーに通知
     session_end_message = {
@@ -488,29 +856,27 @@ async def end_session(session_id: str, admin_token: Optional[str] = Cookie(None)
         "timestamp": datetime.now().isoformat()
     }
     
-    # セッションに属する全クライアントを特定して通知
-    clients_to_notify = [client_id for client_id, sess_id in client_sessions.items() if sess_id == session_id]
-    for client_id in clients_to_notify:
-        if client_id in active_connections:
-            try:
-                await active_connections[client_id].send_json(session_end_message)
-            except Exception as e:
-                print(f"Error notifying client {client_id}: {e}")
+    # セッションのルームに属する全クライアントに通知
+    await connection_manager.broadcast(session_id, session_end_message)
     
     # セッションを終了
-    session_manager.end_session(session_id)
+    session = await storage.run(session_id, session_manager.end_session, session_id)
+    if session:
+        await notify_session_changed("session_ended", session)
     return JSONResponse(content={"status": "success", "message": "Session ended"})
 
 @app.delete("/api/sessions/{session_id}/delete")
 async def delete_session(session_id: str, admin_token: Optional[str] = Cookie(None)):
     """セッションを削除"""
     # 認証チェック
-    if not verify_admin_token(admin_token):
+    if not await verify_admin_token(admin_token):
         raise HTTPException(status_code=401, detail="Unauthorized")
-    success = session_manager.delete_session(session_id)
+    success = await storage.run(session_id, session_manager.delete_session, session_id)
     if success:
         # メッセージデータも削除
-        message_store.delete_session_messages(session_id)
+        await storage.run(session_id, message_store.delete_session_messages, session_id)
+        connection_manager.replay_buffer.discard(session_id)
+        await connection_manager.notify_admins({"type": "session_deleted", "session_id": session_id})
         return JSONResponse(content={"status": "success", "message": "Session deleted"})
     else:
         raise HTTPException(status_code=404, detail="Session not found")
@@ -529,26 +895,28 @@ async def create_new_session(end_previous: bool = True, password: Optional[str]
         disable_user_password: ユーザーパスワード完全無効（True=パスワードなし強制）
     """
     # 認証チェック
-    if not verify_admin_token(admin_token):
+    if not await verify_admin_token(admin_token):
         raise HTTPException(status_code=401, detail="Unauthorized")
     if end_previous:
-        # 接続中の全ユーザーにセッション終了を通知
-        if active_connections:
-            session_end_message = {
-                "type": "session_end",
-                "message": "セッションが終了しました。新しいセッションが開始されます。",
-                "timestamp": datetime.now().isoformat()
-            }
-            await broadcast_message(session_end_message)
+        # 接続中の全ユーザー（全ワーカー）にセッション終了を通知
+        session_end_message = {
+            "type": "session_end",
+            "message": "セッションが終了しました。新しいセッションが開始されます。",
+            "timestamp": datetime.now().isoformat()
+        }
+        await connection_manager.broadcast_all(session_end_message)
         
         # 全てのアクティブなセッションを終了
-        active_sessions = session_manager.get_active_sessions()
+        active_sessions = await storage.run_unordered(session_manager.get_active_sessions)
         for old_session in active_sessions:
-            session_manager.end_session(old_session.session_id)
+            ended = await storage.run(old_session.session_id, session_manager.end_session, old_session.session_id)
+            if ended:
+                await notify_session_changed("session_ended", ended)
             print(f"Previous session ended: {old_session.session_id}")
     
     # 新しいセッションを作成
-    session = session_manager.create_session(
+    session = await storage.run_unordered(
+        session_manager.create_session,
         password=password, 
         require_user_password=require_user_password,
         disable_user_password=disable_user_password
@@ -556,6 +924,7 @@ async def create_new_session(end_previous: bool = True, password: Optional[str]
     password_status = "with password" if password else "without password"
     user_pw_status = "required" if require_user_password else "optional" if not disable_user_password else "disabled"
     print(f"New session created: {session.session_id} ({password_status}, user password: {user_pw_status})")
+    await notify_session_changed("session_created", session)
     
     message = "New session created"
     if end_previous:
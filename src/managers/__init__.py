@@ -1,5 +1,6 @@
 from .session_manager import SessionManager
 from .message_store import MessageStore
+from .connection_manager import ConnectionManager
 
-__all__ = ["SessionManager", "MessageStore"]
+__all__ = ["SessionManager", "MessageStore", "ConnectionManager"]
 
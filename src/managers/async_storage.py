@@ -0,0 +1,46 @@
+import asyncio
+import functools
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List
+
+
+class AsyncStorage:
+    """ストレージ操作をイベントループの外（スレッド）で実行するクラス
+
+    同じキー（セッションID）の操作は常に同じワーカースレッドで投入順に実行されるため、
+    セッション内の書き込み順序が保たれる。エクスポートなど時間のかかる処理や
+    セッションをまたぐ処理は、別の共有スレッドプールで実行する。
+    """
+
+    def __init__(self, workers: int = 4, background_workers: int = 4):
+        self._executors: List[ThreadPoolExecutor] = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"storage-{i}")
+            for i in range(max(workers, 1))
+        ]
+        self._background = ThreadPoolExecutor(
+            max_workers=max(background_workers, 1), thread_name_prefix="storage-bg"
+        )
+
+    def _executor_for(self, key: str) -> ThreadPoolExecutor:
+        return self._executors[zlib.crc32(key.encode("utf-8")) % len(self._executors)]
+
+    async def run(self, key: str, func: Callable, *args, **kwargs) -> Any:
+        """キーごとの順序を保って実行し、完了（ディスクへの書き込み）を待つ"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor_for(key), functools.partial(func, *args, **kwargs)
+        )
+
+    async def run_unordered(self, func: Callable, *args, **kwargs) -> Any:
+        """順序の保証が不要な処理を共有スレッドプールで実行"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._background, functools.partial(func, *args, **kwargs)
+        )
+
+    def shutdown(self):
+        """実行中の処理の完了を待ってスレッドを停止"""
+        for executor in self._executors:
+            executor.shutdown(wait=True)
+        self._background.shutdown(wait=True)
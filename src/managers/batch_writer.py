@@ -0,0 +1,178 @@
+import time
+import asyncio
+from collections import defaultdict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from .. import metrics
+from ..models.message import Message
+from .async_storage import AsyncStorage
+from .message_store import MessageStore
+from .session_manager import SessionManager
+
+MESSAGES_WRITTEN = metrics.counter(
+    "chat_messages_written_total", "Messages written to storage", ("message_type",)
+)
+BATCH_SIZE = metrics.histogram(
+    "chat_write_batch_size", "Messages per group commit",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+)
+FLUSH_SECONDS = metrics.histogram(
+    "chat_write_flush_seconds", "Duration of one group commit (all sessions in the batch)"
+)
+
+# 書き込み後に呼ばれるコールバック: listener(session_id, messages, 最初のメッセージの番号, 書き込み後の統計の合計)
+CommitListener = Callable[[str, List[Message], int, Dict], Awaitable[None]]
+
+
+class BatchWriter:
+    """メッセージの書き込みをまとめるクラス（グループコミット）
+
+    一定時間（window）内、または max_batch 件までに届いたメッセージを、
+    セッションごとに1回の追記と1回のセッション情報の更新にまとめて書き込む。
+    listener を指定すると、書き込んだセッションごとに1回、書き込んだ順に呼び出す
+    （メッセージ番号（seq）順のブロードキャストと管理画面への通知用）。
+    """
+
+    def __init__(self, storage: AsyncStorage, message_store: MessageStore,
+                 session_manager: SessionManager, window: float = 0.01, max_batch: int = 100,
+                 listener: Optional[CommitListener] = None):
+        self.storage = storage
+        self.message_store = message_store
+        self.session_manager = session_manager
+        self.window = window
+        self.max_batch = max_batch
+        self.listener = listener
+        self._queue: Optional["asyncio.Queue[Optional[Tuple[Message, asyncio.Future]]]"] = None
+        self._task: Optional[asyncio.Task] = None
+        # 調整用のメトリクス
+        self._batches = 0
+        self._messages = 0
+        self._max_batch_size = 0
+        self._total_latency = 0.0
+        self._last_latency = 0.0
+        self._max_latency = 0.0
+
+    def start(self):
+        """書き込みタスクを開始"""
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """キューに残ったメッセージを書き込んでから停止"""
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+    async def submit(self, message: Message):
+        """メッセージを書き込みキューに入れ、ディスクへの書き込み完了を待つ"""
+        if self._task is None:
+            # 書き込みタスクが動いていない場合はそのまま書き込む
+            result = await self.storage.run(message.session_id, self._write, message.session_id, [message])
+            await self._notify(message.session_id, [message], result)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((message, future))
+        await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                if self._queue.empty():
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    item = self._queue.get_nowait()
+                if item is None:
+                    # 停止要求: ここまでの分を書き込んで終了
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._commit(batch)
+
+    async def _commit(self, batch: List[Tuple[Message, asyncio.Future]]):
+        """セッションごとにまとめて書き込み、待っている送信元に結果を返す"""
+        groups: Dict[str, list] = defaultdict(list)
+        for message, future in batch:
+            groups[message.session_id].append((message, future))
+
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *(self.storage.run(session_id, self._write, session_id, [m for m, _ in items])
+              for session_id, items in groups.items()),
+            return_exceptions=True
+        )
+        latency = time.perf_counter() - start
+
+        for (session_id, items), result in zip(groups.items(), results):
+            if isinstance(result, Exception):
+                print(f"Error writing messages: {result}")
+            else:
+                await self._notify(session_id, [m for m, _ in items], result)
+            for _, future in items:
+                if not future.done():
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(None)
+
+        self._batches += 1
+        self._messages += len(batch)
+        self._max_batch_size = max(self._max_batch_size, len(batch))
+        self._total_latency += latency
+        self._last_latency = latency
+        self._max_latency = max(self._max_latency, latency)
+        BATCH_SIZE.observe(len(batch))
+        FLUSH_SECONDS.observe(latency)
+
+    def _write(self, session_id: str, messages: List[Message]) -> Tuple[int, Optional[Dict]]:
+        """1セッション分のメッセージを1回の追記で保存（ワーカースレッドで実行）
+
+        最初のメッセージの番号と、listener がある場合は書き込み後の統計の合計を返す。
+        """
+        first_seq = self.message_store.save_messages(messages)[session_id]
+        for message in messages:
+            MESSAGES_WRITTEN.labels(message.message_type).inc()
+        count = sum(1 for m in messages if m.message_type == "message")
+        if count:
+            self.session_manager.increment_message_count(session_id, count)
+        if self.listener is not None:
+            return first_seq, self.message_store.get_statistics_totals(session_id)
+        return first_seq, None
+
+    async def _notify(self, session_id: str, messages: List[Message], result: Tuple[int, Optional[Dict]]):
+        first_seq, totals = result
+        if self.listener is None or totals is None:
+            return
+        try:
+            await self.listener(session_id, messages, first_seq, totals)
+        except Exception as e:
+            print(f"Error notifying commit: {e}")
+
+    def metrics(self) -> Dict:
+        """キューの長さと書き込み時間の統計"""
+        return {
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "window_ms": self.window * 1000,
+            "max_batch": self.max_batch,
+            "batches": self._batches,
+            "messages": self._messages,
+            "avg_batch_size": self._messages / self._batches if self._batches else 0,
+            "max_batch_size": self._max_batch_size,
+            "last_flush_latency_ms": self._last_latency * 1000,
+            "avg_flush_latency_ms": self._total_latency / self._batches * 1000 if self._batches else 0,
+            "max_flush_latency_ms": self._max_latency * 1000,
+        }
@@ -0,0 +1,253 @@
+import time
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
+from fastapi import WebSocket
+from .. import codec, metrics
+from .pubsub import PubSub, InProcessPubSub
+from .outbound_queue import OutboundQueue
+from .replay_buffer import ReplayBuffer
+
+# 1つのブロードキャストを全ての接続の送信キューに入れ終えるまでの時間
+FANOUT_SECONDS = metrics.histogram(
+    "chat_broadcast_fanout_seconds", "Time to enqueue one broadcast to every target connection", ("channel",)
+)
+FANOUT_TARGETS = metrics.histogram(
+    "chat_broadcast_fanout_targets", "Number of connections one broadcast was delivered to", ("channel",),
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+)
+
+
+class ConnectionManager:
+    """WebSocket接続とセッション単位のルームを管理するクラス
+
+    接続はこのワーカーのものだけを保持し、ブロードキャストは PubSub を経由して
+    全ワーカーのルームに届ける。クライアントIDの重複確認も PubSub で全ワーカー共通に行う。
+    送信は接続ごとの送信キュー（OutboundQueue）に入れるだけで、実際の送信は接続ごとのタスクが行う。
+    管理画面の接続は、同じセッションの統計などを最新のものにまとめる coalesce で送る。
+    メッセージ番号（seq）付きのブロードキャストはセッションごとのリングバッファに残し、
+    再接続したクライアントに取りこぼした分だけを再送する（resume）。
+    """
+
+    def __init__(self, send_timeout: float = 5.0, pubsub: Optional[PubSub] = None,
+                 queue_size: int = 256, overflow_policy: str = "disconnect",
+                 replay_size: int = 500):
+        if overflow_policy not in OutboundQueue.POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+        self.pubsub = pubsub or InProcessPubSub()
+        # key: クライアントID, value: WebSocket接続（このワーカーの接続のみ）
+        self.active_connections: Dict[str, WebSocket] = {}
+        # クライアントIDとセッションIDの対応
+        self.client_sessions: Dict[str, str] = {}
+        # key: セッションID, value: {クライアントID: WebSocket接続}
+        self.rooms: Dict[str, Dict[str, WebSocket]] = {}
+        # 管理画面のイベントストリームの接続（このワーカーの接続のみ）
+        self.admin_connections: Dict[str, WebSocket] = {}
+        # key: クライアントID（管理画面の接続を含む）, value: 送信キュー
+        self.queues: Dict[str, OutboundQueue] = {}
+        self.send_timeout = send_timeout
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        # 再接続時の再送用（このワーカーに届いたブロードキャストを全て記録する）
+        self.replay_buffer = ReplayBuffer(size=replay_size)
+        # 切断済みの接続を含めた累計（メトリクス用）
+        self._closed_dropped = 0
+        self._closed_coalesced = 0
+        self._evicted = 0
+        # 閉じている途中の接続のタスク（完了するまで参照を持つ）
+        self._closing: set = set()
+
+    async def start(self):
+        """他のワーカーからのブロードキャストの受信を開始"""
+        await self.pubsub.start(self._on_message)
+
+    async def close(self):
+        """送信タスクと閉じている途中の接続のタスクが終わるのを待ち、PubSubとの接続を閉じる"""
+        await asyncio.gather(*(self._close_queue(client_id) for client_id in list(self.queues)))
+        await asyncio.gather(*self._closing, return_exceptions=True)
+        await self.pubsub.close()
+
+    def is_connected(self, client_id: str) -> bool:
+        """クライアントIDがこのワーカーで接続中か確認"""
+        return client_id in self.active_connections
+
+    async def connect(self, client_id: str, session_id: str, websocket: WebSocket) -> bool:
+        """接続をセッションのルームに登録（同じクライアントIDがいずれかのワーカーで接続中ならFalse）"""
+        if not await self.pubsub.claim(f"client:{client_id}", session_id):
+            return False
+        self.active_connections[client_id] = websocket
+        self.client_sessions[client_id] = session_id
+        self.rooms.setdefault(session_id, {})[client_id] = websocket
+        self._open_queue(client_id, websocket, self.overflow_policy)
+        return True
+
+    async def disconnect(self, client_id: str, websocket: Optional[WebSocket] = None):
+        """接続をルームから削除し、クライアントIDを解放"""
+        current = self.active_connections.get(client_id)
+        if current is None or (websocket is not None and current is not websocket):
+            return
+        del self.active_connections[client_id]
+        session_id = self.client_sessions.pop(client_id, None)
+        room = self.rooms.get(session_id)
+        if room is not None:
+            room.pop(client_id, None)
+            if not room:
+                del self.rooms[session_id]
+        await self._close_queue(client_id)
+        await self.pubsub.release(f"client:{client_id}")
+
+    def connect_admin(self, admin_id: str, websocket: WebSocket):
+        """管理画面の接続をイベントの送信先に登録"""
+        self.admin_connections[admin_id] = websocket
+        self._open_queue(admin_id, websocket, "coalesce")
+
+    async def disconnect_admin(self, admin_id: str, websocket: Optional[WebSocket] = None):
+        """管理画面の接続を送信先から削除"""
+        current = self.admin_connections.get(admin_id)
+        if current is not None and (websocket is None or current is websocket):
+            del self.admin_connections[admin_id]
+            await self._close_queue(admin_id)
+
+    def _open_queue(self, client_id: str, websocket: WebSocket, policy: str):
+        queue = OutboundQueue(
+            client_id, websocket, max_size=self.queue_size, policy=policy,
+            send_timeout=self.send_timeout, on_failure=self._on_send_failure
+        )
+        self.queues[client_id] = queue
+        queue.start()
+
+    async def _close_queue(self, client_id: str):
+        queue = self.queues.pop(client_id, None)
+        if queue is not None:
+            await queue.stop()
+            self._closed_dropped += queue.dropped
+            self._closed_coalesced += queue.coalesced
+
+    async def send(self, client_id: str, message: Union[dict, str]):
+        """このワーカーに接続中の1つの接続にだけ送信（送信キュー経由）"""
+        payload = message if isinstance(message, str) else self.encode(message)
+        queue = self.queues.get(client_id)
+        if queue is not None and not queue.put(payload):
+            await self._evict(client_id, queue.websocket, code=1013)
+
+    async def resume(self, client_id: str, session_id: str, last_seq: int,
+                     load_missed: Callable[[int], Awaitable[List[str]]]) -> int:
+        """再接続したクライアントに last_seq より後のブロードキャストを再送し、再送した件数を返す
+
+        connect() の直後に（間で await せずに）呼ぶ。リングバッファが last_seq の直後から
+        保持していなければ、load_missed(last_seq) で保存済みのメッセージから読み込む。
+        読み込み中に届いたブロードキャストは再送分の後に送る（重複はクライアントが seq で取り除く）。
+        """
+        queue = self.queues.get(client_id)
+        if queue is None:
+            return 0
+        frames = self.replay_buffer.since(session_id, last_seq)
+        if frames is None:
+            queue.hold()
+            frames = []
+            try:
+                frames = await load_missed(last_seq)
+            finally:
+                queue.release(frames)
+        else:
+            queue.release(frames)
+        return len(frames)
+
+    def get_room(self, session_id: str) -> Dict[str, WebSocket]:
+        """セッションにこのワーカーで接続中のクライアント"""
+        return dict(self.rooms.get(session_id, {}))
+
+    @staticmethod
+    def encode(message: dict) -> str:
+        """送信用のペイロードにエンコード（同じイベントを複数回送る場合は事前にエンコードしておく）"""
+        return codec.dumps_str(message)
+
+    async def broadcast(self, session_id: str, message: Union[dict, str]):
+        """セッションのルームにだけメッセージを送信（全ワーカー）"""
+        payload = message if isinstance(message, str) else self.encode(message)
+        await self.pubsub.publish(f"room:{session_id}", payload)
+
+    async def broadcast_all(self, message: Union[dict, str]):
+        """全ての接続中のクライアントにメッセージを送信（全ワーカー）"""
+        payload = message if isinstance(message, str) else self.encode(message)
+        await self.pubsub.publish("all", payload)
+
+    async def notify_admins(self, event: dict, key: Optional[str] = None):
+        """管理画面にイベント（セッションの作成・終了、参加者や統計の変化）を送信（全ワーカー）
+
+        key を指定したイベントは、送信待ちの間に同じキーのイベントが届くと最新のものだけが送られる。
+        """
+        channel = "admin" if key is None else f"admin:{key}"
+        await self.pubsub.publish(channel, self.encode(event))
+
+    async def _on_message(self, channel: str, payload: str):
+        """PubSubから届いたメッセージをこのワーカーの接続に配信"""
+        if channel == "admin" or channel.startswith("admin:"):
+            key = channel[len("admin:"):] or None
+            await self._fan_out(list(self.admin_connections.items()), payload, key, kind="admin")
+        elif channel == "all":
+            await self._fan_out(list(self.active_connections.items()), payload, kind="all")
+        elif channel.startswith("room:"):
+            session_id = channel[len("room:"):]
+            self._remember(session_id, payload)
+            await self._fan_out(list(self.rooms.get(session_id, {}).items()), payload, kind="room")
+
+    def _remember(self, session_id: str, payload: str):
+        """メッセージ番号（seq）付きのブロードキャストをリングバッファに記録"""
+        try:
+            seq = codec.loads(payload).get("seq")
+        except ValueError:
+            return
+        if isinstance(seq, int):
+            self.replay_buffer.append(session_id, seq, payload)
+
+    async def _fan_out(self, targets: List[Tuple[str, WebSocket]], payload: str,
+                       key: Optional[str] = None, kind: str = "room"):
+        """エンコード済みの同じテキストフレームを全ての接続の送信キューに入れる（送信は待たない）"""
+        start = time.perf_counter()
+        overflowed = []
+        for client_id, websocket in targets:
+            queue = self.queues.get(client_id)
+            if queue is not None and queue.websocket is websocket and not queue.put(payload, key):
+                overflowed.append((client_id, websocket))
+        FANOUT_SECONDS.labels(kind).observe(time.perf_counter() - start)
+        FANOUT_TARGETS.labels(kind).observe(len(targets))
+        for client_id, websocket in overflowed:
+            # 1013: Try Again Later（受信が追いつかない）
+            await self._evict(client_id, websocket, code=1013)
+
+    async def _on_send_failure(self, queue: OutboundQueue):
+        await self._evict(queue.client_id, queue.websocket)
+
+    async def _evict(self, client_id: str, websocket: WebSocket, code: int = 1011):
+        """送信できなかった（または送信キューが溢れた）接続をルームから外して閉じる"""
+        print(f"Evicting unresponsive connection: {client_id}")
+        self._evicted += 1
+        if self.admin_connections.get(client_id) is websocket:
+            await self.disconnect_admin(client_id, websocket)
+        else:
+            await self.disconnect(client_id, websocket)
+        task = asyncio.ensure_future(self._close_quietly(websocket, code))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    async def _close_quietly(self, websocket: WebSocket, code: int = 1011):
+        try:
+            await asyncio.wait_for(websocket.close(code=code), timeout=self.send_timeout)
+        except Exception:
+            pass
+
+    def metrics(self) -> Dict:
+        """送信キューの長さと破棄・まとめたフレーム数（クライアントごとと全体）"""
+        clients = {client_id: queue.metrics() for client_id, queue in self.queues.items()}
+        return {
+            "connections": len(self.queues),
+            "queue_size": self.queue_size,
+            "overflow_policy": self.overflow_policy,
+            "total_depth": sum(m["depth"] for m in clients.values()),
+            "max_depth": max((m["depth"] for m in clients.values()), default=0),
+            "dropped": self._closed_dropped + sum(m["dropped"] for m in clients.values()),
+            "coalesced": self._closed_coalesced + sum(m["coalesced"] for m in clients.values()),
+            "evicted": self._evicted,
+            "replay_buffer": self.replay_buffer.metrics(),
+            "clients": clients
+        }
@@ -0,0 +1,244 @@
+import os
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+from .. import codec
+from ..fileio import TMP_SUFFIX
+from .message_archive import MessageArchive, TieredMessageLog
+from .message_log import JsonlMessageLog, OffsetIndex
+from .message_store import MessageStore
+from .session_manager import SessionManager
+from .sqlite_store import SQLiteMessageLog, SQLiteSessionManager
+
+# (検査対象のパス, 問題, 行った修復)
+Issue = Dict[str, Optional[str]]
+
+
+def _issue(path: Path, problem: str, action: Optional[str] = None) -> Issue:
+    return {"path": str(path), "problem": problem, "action": action}
+
+
+class RecoveryScanner:
+    """データディレクトリの検査と修復（起動時にバックグラウンドで実行する）
+
+    ファイルごとの検査を複数スレッドで並行して行い、見つかった問題と行った修復を report に残す。
+    - 書き込み途中で残った一時ファイル（*.tmp）: 一定時間より古いものを削除
+    - メッセージログ（*.jsonl）: 書き込み途中で落ちた末尾行を修復し、読めない行の数を報告
+    - アーカイブ途中のログ（*.jsonl.archiving）: アーカイブが公開済みならログを削除し、そうでなければ元に戻す
+    - オフセットインデックス: ログがなくなったものを削除
+    - セッションファイル: 読めないものを *.corrupt に退避（読み込み時にエラーにしない）
+    - 統計情報・検索インデックス・カタログ・状態のスナップショット: 読めないものを削除（ログやセッションから作り直される）
+    - アーカイブ: インデックスとデータファイルの整合性を報告
+    - SQLite: PRAGMA quick_check の結果を報告
+    サーバーの稼働中に実行するため、修復は各ストアと同じロックの中で行うか、置き換え済みのファイルだけを対象にする。
+    """
+
+    # これより古い一時ファイルは書き込み中ではないものとして削除する
+    STALE_TMP_SECONDS = 300
+
+    def __init__(self, session_manager: SessionManager, message_store: MessageStore, workers: int = 4):
+        self.session_manager = session_manager
+        self.message_store = message_store
+        self.workers = max(1, workers)
+        self.report: Dict = {"status": "not_started"}
+
+    def _message_log(self):
+        # アーカイブを使う場合は追記中のログ（hot）を検査する
+        log = self.message_store.log
+        return getattr(log, "hot", log)
+
+    def _checks(self) -> List[Tuple[Callable[[Path], List[Issue]], Path]]:
+        """(検査関数, パス) の一覧"""
+        checks = []
+        log = self._message_log()
+        messages_dir = self.message_store.data_dir
+        sqlite_paths = set()
+
+        if isinstance(self.session_manager, SQLiteSessionManager):
+            sqlite_paths.add(self.session_manager.db_path)
+        else:
+            sessions_dir = self.session_manager.data_dir
+            for path in sessions_dir.glob("*.json"):
+                if path.name.startswith("_"):
+                    # カタログ・状態のスナップショット
+                    checks.append((self._check_derived_json, path))
+                else:
+                    checks.append((self._check_session_file, path))
+
+        if isinstance(log, SQLiteMessageLog):
+            sqlite_paths.add(log.db_path)
+        elif isinstance(log, JsonlMessageLog):
+            checks.extend((self._check_jsonl, path) for path in messages_dir.glob(f"*{log.suffix}"))
+            if isinstance(self.message_store.log, TieredMessageLog):
+                checks.extend((self._check_archiving, path)
+                              for path in messages_dir.glob(f"*{log.suffix}{log.archiving_suffix}"))
+            checks.extend((self._check_offset_index, path) for path in log.index_dir.glob(f"*{log.index_suffix}"))
+        else:
+            checks.extend((self._check_json_log, path) for path in messages_dir.glob("*.json"))
+
+        for directory in (self.message_store.stats_dir, self.message_store.data_dir / "search"):
+            checks.extend((self._check_derived_json, path) for path in directory.glob("*.json"))
+        checks.extend((self._check_archive, path) for path in (messages_dir / "archive").glob("*.index.json"))
+        checks.extend((self._check_sqlite, path) for path in sorted(sqlite_paths))
+
+        for directory in {self.session_manager.data_dir, messages_dir}:
+            checks.extend((self._check_tmp_file, path) for path in directory.rglob(f"*{TMP_SUFFIX}"))
+        return checks
+
+    def scan(self) -> Dict:
+        """データディレクトリを検査・修復し、結果を返す"""
+        started = time.perf_counter()
+        started_at = datetime.now().isoformat()
+        self.report = {"status": "running", "started_at": started_at}
+        try:
+            checks = self._checks()
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="recovery") as pool:
+                results = list(pool.map(self._run_check, checks))
+        except Exception as e:
+            self.report = {"status": "failed", "started_at": started_at, "error": str(e)}
+            print(f"Recovery scan failed: {e}")
+            return self.report
+
+        issues = [issue for result in results for issue in result]
+        repaired = sum(1 for issue in issues if issue["action"])
+        duration = time.perf_counter() - started
+        self.report = {
+            "status": "completed",
+            "started_at": started_at,
+            "finished_at": datetime.now().isoformat(),
+            "duration_seconds": round(duration, 3),
+            "files_checked": len(checks),
+            "issues": issues,
+            "repaired": repaired
+        }
+        print(f"Recovery scan checked {len(checks)} file(s) in {duration:.2f}s: "
+              f"{len(issues)} issue(s), {repaired} repaired")
+        for issue in issues:
+            action = f" -> {issue['action']}" if issue["action"] else ""
+            print(f"  {issue['path']}: {issue['problem']}{action}")
+        return self.report
+
+    @staticmethod
+    def _run_check(check: Tuple[Callable[[Path], List[Issue]], Path]) -> List[Issue]:
+        func, path = check
+        try:
+            return func(path)
+        except FileNotFoundError:
+            # 検査の間に削除・置き換えられた
+            return []
+        except Exception as e:
+            return [_issue(path, f"check failed: {e}")]
+
+    def _check_tmp_file(self, path: Path) -> List[Issue]:
+        if time.time() - path.stat().st_mtime < self.STALE_TMP_SECONDS:
+            return []
+        path.unlink(missing_ok=True)
+        return [_issue(path, "leftover temporary file from an interrupted write", "removed")]
+
+    def _check_jsonl(self, path: Path) -> List[Issue]:
+        log = self._message_log()
+        if (isinstance(self.message_store.log, TieredMessageLog)
+                and log.archiving_path(path.name[:-len(log.suffix)]).exists()):
+            # アーカイブの途中で落ちたログは _check_archiving で片付ける（取り込み済みかの判定が変わらないよう触らない）
+            return []
+        issues = []
+        corrupt = 0
+        torn = False
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    torn = True
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    codec.loads(line)
+                except json.JSONDecodeError:
+                    corrupt += 1
+        if torn:
+            # 追記中の行かもしれないので、追記と同じロックの中で確認してから修復する
+            action = log.repair_tail(path.name[:-len(log.suffix)])
+            if action:
+                issues.append(_issue(path, "incomplete last record", action))
+        if corrupt:
+            issues.append(_issue(path, f"{corrupt} unreadable record(s) (skipped when reading)"))
+        return issues
+
+    def _check_archiving(self, path: Path) -> List[Issue]:
+        log = self._message_log()
+        session_id = path.name[:-len(log.suffix + log.archiving_suffix)]
+        action = self.message_store.log.recover_archiving(session_id)
+        if action:
+            return [_issue(path, "interrupted archive", action)]
+        return []
+
+    def _check_offset_index(self, path: Path) -> List[Issue]:
+        log = self._message_log()
+        session_id = path.name[:-len(log.index_suffix)]
+        if not log.path(session_id).exists():
+            path.unlink(missing_ok=True)
+            return [_issue(path, "offset index without a message log", "removed")]
+        if path.stat().st_size % OffsetIndex.ENTRY.size:
+            return [_issue(path, "incomplete last index entry (dropped on the next append)")]
+        return []
+
+    def _check_json_log(self, path: Path) -> List[Issue]:
+        try:
+            with open(path, 'rb') as f:
+                json.load(f)
+        except json.JSONDecodeError as e:
+            return [_issue(path, f"unreadable message log: {e}")]
+        return []
+
+    def _check_session_file(self, path: Path) -> List[Issue]:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                json.load(f)
+        except json.JSONDecodeError as e:
+            quarantine = path.with_name(path.name + ".corrupt")
+            os.replace(path, quarantine)
+            return [_issue(path, f"unreadable session file: {e}", f"moved to {quarantine.name}")]
+        return []
+
+    def _check_derived_json(self, path: Path) -> List[Issue]:
+        try:
+            with open(path, 'rb') as f:
+                codec.loads(f.read())
+        except json.JSONDecodeError as e:
+            path.unlink(missing_ok=True)
+            return [_issue(path, f"unreadable file: {e}", "removed (rebuilt on next use)")]
+        return []
+
+    def _check_archive(self, path: Path) -> List[Issue]:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+        except json.JSONDecodeError as e:
+            return [_issue(path, f"unreadable archive index: {e}")]
+        session_id = path.name[:-len(".index.json")]
+        suffix = MessageArchive.COMPRESSIONS.get(index.get("compression"), ".ndjson.gz")
+        data_file = path.with_name(session_id + suffix)
+        end = max((offset + length for offset, length, _ in index.get("segments", [])), default=0)
+        try:
+            size = data_file.stat().st_size
+        except FileNotFoundError:
+            return [_issue(path, f"archive data file {data_file.name} is missing")]
+        if size < end:
+            return [_issue(path, f"archive data file {data_file.name} is truncated ({size} < {end} bytes)")]
+        return []
+
+    def _check_sqlite(self, path: Path) -> List[Issue]:
+        if not path.exists():
+            return []
+        conn = sqlite3.connect(str(path), timeout=30)
+        try:
+            rows = [row[0] for row in conn.execute("PRAGMA quick_check").fetchall()]
+        finally:
+            conn.close()
+        if rows != ["ok"]:
+            return [_issue(path, "quick_check: " + "; ".join(rows[:10]))]
+        return []
@@ -0,0 +1,402 @@
+import os
+import gzip
+import json
+import shutil
+import threading
+from bisect import bisect_right
+from itertools import islice
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+from .. import codec
+from ..fileio import atomic_write, tmp_path
+from .message_log import MessageLog
+from .session_locks import SessionLocks
+
+try:
+    import zstandard
+except ImportError:  # zstd を使わない場合は不要
+    zstandard = None
+
+
+def file_identity(stat: os.stat_result) -> List[int]:
+    """ファイルを見分けるための値（同じ inode が再利用されても区別できるようにサイズと更新時刻を含める）"""
+    return [stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+
+class MessageArchive:
+    """終了したセッションのメッセージを圧縮して保存するアーカイブ（書き込みは1回だけ）
+
+    セッションごとに、segment_size 件ずつ圧縮したNDJSONのセグメントを連結したファイルと、
+    各セグメントの位置と件数を記録したインデックス（JSON）を作る。
+    読み込みは必要なセグメントだけを読み出して展開するため、全体をメモリに載せない。
+    アーカイブ後に追記された分は、既存のセグメントをそのまま複製した後ろに新しいセグメントとして足した
+    ファイルを作って置き換える（既存のセグメントの位置は変わらない）。
+    shared=True の場合は他のワーカーが作ったり置き換えたりしたアーカイブも見つけられるよう、
+    インデックスファイルが置き換えられていないかを毎回確認する。
+    """
+
+    COMPRESSIONS = {"gzip": ".ndjson.gz", "zstd": ".ndjson.zst"}
+
+    def __init__(self, data_dir: Path, compression: str = "gzip", segment_size: int = 1000,
+                 shared: bool = False):
+        if compression not in self.COMPRESSIONS:
+            raise ValueError(f"Unknown archive compression: {compression}")
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("zstd archive compression requires zstandard: "
+                             "pip install zstandard (or pip install -r requirements-optional.txt)")
+        self.data_dir = Path(data_dir)
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        self.compression = compression
+        self.segment_size = segment_size
+        self.shared = shared
+        # key: セッションID, value: インデックス（アーカイブがなければ None）
+        self._indexes: Dict[str, Optional[dict]] = {}
+        self._lock = threading.Lock()
+
+    def index_path(self, session_id: str) -> Path:
+        return self.data_dir / f"{session_id}.index.json"
+
+    def data_path(self, session_id: str, compression: Optional[str] = None) -> Path:
+        return self.data_dir / f"{session_id}{self.COMPRESSIONS[compression or self.compression]}"
+
+    @staticmethod
+    def _compress(data: bytes, compression: str) -> bytes:
+        if compression == "zstd":
+            return zstandard.ZstdCompressor(level=3).compress(data)
+        return gzip.compress(data, compresslevel=6)
+
+    @staticmethod
+    def _decompress(data: bytes, compression: str) -> bytes:
+        if compression == "zstd":
+            if zstandard is None:
+                raise RuntimeError("Reading a zstd archive requires zstandard: "
+                                   "pip install zstandard (or pip install -r requirements-optional.txt)")
+            return zstandard.ZstdDecompressor().decompress(data)
+        return gzip.decompress(data)
+
+    def _index(self, session_id: str, reload: bool = False) -> Optional[dict]:
+        """インデックスを読み込む（セグメントの開始位置 starts を計算してキャッシュする）
+
+        shared=True か reload=True の場合は、キャッシュしたインデックスのファイルが置き換えられていないか確認する。
+        """
+        index_file = self.index_path(session_id)
+        check = self.shared or reload
+        identity = None
+        if check:
+            try:
+                identity = file_identity(os.stat(index_file))
+            except FileNotFoundError:
+                with self._lock:
+                    self._indexes[session_id] = None
+                return None
+        with self._lock:
+            if session_id in self._indexes:
+                index = self._indexes[session_id]
+                if not check or (index is not None and index["identity"] == identity):
+                    return index
+        try:
+            with open(index_file, 'r', encoding='utf-8') as f:
+                identity = file_identity(os.fstat(f.fileno()))
+                index = json.load(f)
+        except FileNotFoundError:
+            index = None
+        except json.JSONDecodeError:
+            print(f"Ignoring corrupt archive index: {index_file}")
+            index = None
+        if index is not None:
+            index["identity"] = identity
+            starts, position = [], 0
+            for _, _, count in index["segments"]:
+                starts.append(position)
+                position += count
+            index["starts"] = starts
+        with self._lock:
+            self._indexes[session_id] = index
+        return index
+
+    def exists(self, session_id: str) -> bool:
+        """アーカイブが存在するか確認"""
+        return self._index(session_id) is not None
+
+    def count(self, session_id: str) -> int:
+        """アーカイブしたレコード数"""
+        index = self._index(session_id)
+        return index["count"] if index else 0
+
+    def current_index(self, session_id: str) -> Optional[dict]:
+        """ディスク上の最新のインデックス（identity が変わっていればアーカイブが置き換えられている）"""
+        return self._index(session_id, reload=True)
+
+    def contains(self, session_id: str, source: List[int]) -> bool:
+        """file_identity() が source のログを取り込んだアーカイブが公開済みか"""
+        index = self.current_index(session_id)
+        return index is not None and index.get("source") == source
+
+    def write(self, session_id: str, records: Iterable[dict], base: Optional[dict] = None) -> dict:
+        """レコードを圧縮して一時ファイルに書き込む（commit() を呼ぶまで読み込みには使われない）
+
+        base（既存のアーカイブのインデックス）を渡すと、そのセグメントを展開せずに複製した後ろに
+        records を新しいセグメントとして足す。
+        """
+        compression = base["compression"] if base else self.compression
+        tmp_file = tmp_path(self.data_path(session_id))
+        segments = [list(segment) for segment in base["segments"]] if base else []
+        count = base["count"] if base else 0
+        with open(tmp_file, 'wb') as f:
+            if segments:
+                offset, length, _ = segments[-1]
+                with open(self.data_path(session_id, compression), 'rb') as src:
+                    shutil.copyfileobj(src, f)
+                f.truncate(offset + length)
+                f.seek(offset + length)
+            records = iter(records)
+            while True:
+                batch = list(islice(records, self.segment_size))
+                if not batch:
+                    break
+                data = self._compress(b"".join(codec.dumps(r) + b"\n" for r in batch), compression)
+                segments.append([f.tell(), len(data), len(batch)])
+                f.write(data)
+                count += len(batch)
+            f.flush()
+            os.fsync(f.fileno())
+        return {"compression": compression, "count": count, "segments": segments}
+
+    def commit(self, session_id: str, index: dict, source: Optional[List[int]] = None):
+        """write() した一時ファイルをアーカイブとして公開（インデックスを最後に置き換える。write() と同じスレッドで呼ぶ）
+
+        source には取り込んだログの file_identity() を記録し、途中で落ちた場合にログを取り込み済みか判定する。
+        """
+        os.replace(tmp_path(self.data_path(session_id)), self.data_path(session_id, index["compression"]))
+        atomic_write(self.index_path(session_id), json.dumps(dict(index, source=source)))
+        with self._lock:
+            self._indexes.pop(session_id, None)
+
+    def abort(self, session_id: str):
+        """write() した一時ファイルを削除"""
+        tmp_path(self.data_path(session_id)).unlink(missing_ok=True)
+
+    def _read_segment(self, session_id: str, index: dict, number: int) -> List[dict]:
+        offset, length, _ = index["segments"][number]
+        with open(self.data_path(session_id, index["compression"]), 'rb') as f:
+            f.seek(offset)
+            data = self._decompress(f.read(length), index["compression"])
+        return [codec.loads(line) for line in data.splitlines() if line]
+
+    def iter_records(self, session_id: str) -> Iterator[dict]:
+        """レコードを保存順に返す（1セグメントずつ展開する）"""
+        index = self._index(session_id)
+        if index is None:
+            return
+        for number in range(len(index["segments"])):
+            yield from self._read_segment(session_id, index, number)
+
+    def read_range(self, session_id: str, start: int, stop: int) -> List[dict]:
+        """保存順で start 番目から stop 番目の手前までのレコードを取得（0始まり）"""
+        index = self._index(session_id)
+        if index is None:
+            return []
+        start, stop = max(start, 0), min(stop, index["count"])
+        records = []
+        number = bisect_right(index["starts"], start) - 1
+        while start < stop and number < len(index["segments"]):
+            segment_start = index["starts"][number]
+            segment = self._read_segment(session_id, index, number)
+            records.extend(segment[start - segment_start:stop - segment_start])
+            start = segment_start + len(segment)
+            number += 1
+        return records
+
+    def delete(self, session_id: str) -> bool:
+        """アーカイブを削除"""
+        index = self._index(session_id)
+        with self._lock:
+            self._indexes.pop(session_id, None)
+        if index is None:
+            return False
+        # インデックスを先に消す（途中で止まってもアーカイブとしては扱われない）
+        self.index_path(session_id).unlink(missing_ok=True)
+        self.data_path(session_id, index["compression"]).unlink(missing_ok=True)
+        return True
+
+    def session_ids(self) -> List[str]:
+        """アーカイブが存在するセッションIDの一覧"""
+        suffix = ".index.json"
+        return [p.name[:-len(suffix)] for p in self.data_dir.glob(f"*{suffix}")]
+
+    def size(self, session_id: str) -> int:
+        """アーカイブのファイルサイズ（バイト）"""
+        index = self._index(session_id)
+        if index is None:
+            return 0
+        return self.data_path(session_id, index["compression"]).stat().st_size
+
+
+class TieredMessageLog(MessageLog):
+    """追記中のログ（hot）と終了したセッションのアーカイブ（cold）をまとめて1つのログとして扱う
+
+    アーカイブしたレコードの後ろに hot のレコードが続くものとして番号を振るため、
+    アーカイブ後にメッセージが追記されても番号（seq）は変わらない（次の archive_session() でアーカイブに足す）。
+    """
+
+    def __init__(self, hot: MessageLog, archive: MessageArchive):
+        self.hot = hot
+        self.archive = archive
+        self.data_dir = hot.data_dir
+        self.suffix = hot.suffix
+        # 追記とアーカイブの切り替えを排他する（セッションごと）
+        self._session_locks = SessionLocks()
+        # アーカイブを切り替えた回数（切り替えと同時に読んだ場合に読み直すため）
+        self._generations: Dict[str, int] = {}
+
+    def path(self, session_id: str) -> Path:
+        return self.hot.path(session_id)
+
+    def append(self, session_id: str, records: List[dict]) -> int:
+        """レコードを追記し、最初のレコードの番号（seq）を返す"""
+        with self._session_locks(session_id):
+            return self.archive.count(session_id) + self.hot.append(session_id, records)
+
+    def _consistent(self, session_id: str, read):
+        """アーカイブの切り替えと重ならないように read(アーカイブ済みの件数) を実行"""
+        while True:
+            generation = self._generations.get(session_id, 0)
+            result = read(self.archive.count(session_id))
+            if self._generations.get(session_id, 0) == generation:
+                return result
+
+    def iter_records(self, session_id: str) -> Iterator[dict]:
+        """レコードを保存順に返す（アーカイブ分は1セグメントずつ展開する）"""
+        archived = self.archive.count(session_id)
+        yield from self.archive.iter_records(session_id)
+        hot_records = 0
+        for record in self.hot.iter_records(session_id):
+            hot_records += 1
+            yield record
+        if not archived and not hot_records and self.archive.count(session_id):
+            # 読み込みの途中でアーカイブに移された
+            yield from self.archive.iter_records(session_id)
+
+    def count(self, session_id: str) -> int:
+        """レコード数を取得"""
+        return self._consistent(session_id, lambda archived: archived + self.hot.count(session_id))
+
+    def read_range(self, session_id: str, start: int, stop: int) -> List[dict]:
+        """保存順で start 番目から stop 番目の手前までのレコードを取得（0始まり）"""
+        def read(archived: int) -> List[dict]:
+            records = []
+            if start < archived:
+                records.extend(self.archive.read_range(session_id, start, min(stop, archived)))
+            if stop > archived:
+                records.extend(self.hot.read_range(session_id, max(start - archived, 0), stop - archived))
+            return records
+        return self._consistent(session_id, read)
+
+    def timestamp_at(self, session_id: str, position: int) -> Optional[str]:
+        """position 番目（0始まり）のレコードのタイムスタンプ"""
+        def read(archived: int) -> Optional[str]:
+            if position < archived:
+                records = self.archive.read_range(session_id, position, position + 1)
+                return records[0].get("timestamp", "") if records else None
+            return self.hot.timestamp_at(session_id, position - archived)
+        return self._consistent(session_id, read)
+
+    def query(self, session_id: str, client_id: Optional[str] = None,
+              message_type: Optional[str] = None) -> List[dict]:
+        """条件に合うレコードを取得"""
+        archived = [
+            record for record in self.archive.iter_records(session_id)
+            if (client_id is None or record.get("client_id") == client_id)
+            and (message_type is None or record.get("message_type") == message_type)
+        ]
+        return archived + self.hot.query(session_id, client_id=client_id, message_type=message_type)
+
+    def exists(self, session_id: str) -> bool:
+        """ログが存在するか確認"""
+        return self.archive.exists(session_id) or self.hot.exists(session_id)
+
+    def delete(self, session_id: str) -> bool:
+        """ログとアーカイブを削除"""
+        with self._session_locks(session_id):
+            archived = self.archive.delete(session_id)
+            deleted = self.hot.delete(session_id)
+            self._generations[session_id] = self._generations.get(session_id, 0) + 1
+            return archived or deleted
+
+    def session_ids(self) -> List[str]:
+        """ログまたはアーカイブが存在するセッションIDの一覧"""
+        session_ids = self.hot.session_ids()
+        known = set(session_ids)
+        return session_ids + [s for s in self.archive.session_ids() if s not in known]
+
+    def archive_session(self, session_id: str) -> bool:
+        """追記中のログを圧縮してアーカイブに移す（移した場合は True）
+
+        アーカイブ済みのセッションに後から追記された分は、既存のアーカイブの後ろに新しいセグメントとして足す。
+        圧縮は排他せずに行い、その間に追記があった場合やアーカイブが置き換えられた場合は移さない
+        （hot にレコードが残るので、呼び出し側が unarchived_count() を見てやり直す）。
+        件数の確認からアーカイブの公開・ログの削除までは hot の remove_archived() が
+        他のワーカーの追記とも重ならないように行う。
+        """
+        with self._session_locks(session_id):
+            base = self.archive.current_index(session_id)
+            count = self.hot.count(session_id)
+        if not count:
+            return False
+        try:
+            index = self.archive.write(session_id, islice(self.hot.iter_records(session_id), count), base=base)
+        except Exception:
+            self.archive.abort(session_id)
+            raise
+        expected = count + (base["count"] if base else 0)
+        with self._session_locks(session_id):
+            current = self.archive.current_index(session_id)
+            unchanged = (current is None) if base is None else (current is not None
+                                                               and current["identity"] == base["identity"])
+            try:
+                moved = (index["count"] == expected and unchanged
+                         and self.hot.remove_archived(session_id, count, lambda: self.archive.commit(
+                             session_id, index, source=self._archiving_source(session_id))))
+            except Exception:
+                self.archive.abort(session_id)
+                raise
+            if not moved:
+                self.archive.abort(session_id)
+                print(f"Skipping archive of {session_id}: messages were added while compressing")
+                return False
+            self._generations[session_id] = self._generations.get(session_id, 0) + 1
+        return True
+
+    def unarchived_count(self, session_id: str) -> int:
+        """アーカイブに移していない（hot に残っている）レコード数"""
+        return self.hot.count(session_id)
+
+    def _archiving_source(self, session_id: str) -> Optional[List[int]]:
+        """アーカイブ中のログ（hot が *.archiving として残すもの）の file_identity()"""
+        archiving_path = getattr(self.hot, "archiving_path", None)
+        if archiving_path is None:
+            return None
+        return file_identity(os.stat(archiving_path(session_id)))
+
+    def recover_archiving(self, session_id: str) -> Optional[str]:
+        """アーカイブの途中で落ちて残ったログを片付ける（hot が対応していれば）
+
+        アーカイブがあってもそのログを取り込んだものとは限らない（マージの途中で落ちた）ため、
+        アーカイブに記録した source とログの file_identity() が一致するかで判定する。
+        """
+        recover = getattr(self.hot, "recover_archiving", None)
+        if recover is None:
+            return None
+        with self._session_locks(session_id):
+            action = recover(session_id, lambda stat: self.archive.contains(session_id, file_identity(stat)))
+            if action:
+                self._generations[session_id] = self._generations.get(session_id, 0) + 1
+            return action
+
+    def flush(self):
+        """未同期の書き込みをディスクに反映"""
+        self.hot.flush()
+
+    def close(self):
+        """ログを閉じる"""
+        self.hot.close()
@@ -0,0 +1,757 @@
+import os
+import json
+import mmap
+import time
+import struct
+import threading
+from collections import OrderedDict
+from itertools import islice
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+from pathlib import Path
+from .. import codec
+from ..fileio import atomic_write, fsync_directory, tmp_path
+from .session_locks import SessionLocks
+
+try:
+    import fcntl
+except ImportError:  # Windows: 複数プロセスからの同時書き込みには対応しない
+    fcntl = None
+
+
+class MessageLog:
+    """メッセージログの基底クラス（保存形式を差し替えるためのインターフェース）"""
+
+    suffix = ""
+
+    def __init__(self, data_dir: Path):
+        self.data_dir = Path(data_dir)
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+
+    def path(self, session_id: str) -> Path:
+        """セッションのログファイルのパス"""
+        return self.data_dir / f"{session_id}{self.suffix}"
+
+    def append(self, session_id: str, records: List[dict]) -> int:
+        """レコードを追記し、最初のレコードの番号（seq、1始まり）を返す"""
+        raise NotImplementedError
+
+    def iter_records(self, session_id: str) -> Iterator[dict]:
+        """レコードを保存順に返す"""
+        raise NotImplementedError
+
+    def count(self, session_id: str) -> int:
+        """レコード数を取得"""
+        return sum(1 for _ in self.iter_records(session_id))
+
+    def read_range(self, session_id: str, start: int, stop: int) -> List[dict]:
+        """保存順で start 番目から stop 番目の手前までのレコードを取得（0始まり）"""
+        return list(islice(self.iter_records(session_id), max(start, 0), max(stop, 0)))
+
+    def timestamp_at(self, session_id: str, position: int) -> Optional[str]:
+        """position 番目（0始まり）のレコードのタイムスタンプ"""
+        records = self.read_range(session_id, position, position + 1)
+        return records[0].get("timestamp", "") if records else None
+
+    def import_records(self, session_id: str, records: Iterable[dict]) -> bool:
+        """ログがない場合だけ records を書き込む（既にあれば何もせず False を返す）
+
+        移行用。保存形式ごとに、途中で落ちても一部だけのログが残らないように書き込む。
+        """
+        if self.exists(session_id):
+            return False
+        self.append(session_id, list(records))
+        return True
+
+    def query(self, session_id: str, client_id: Optional[str] = None,
+              message_type: Optional[str] = None) -> List[dict]:
+        """条件に合うレコードを取得"""
+        return [
+            record for record in self.iter_records(session_id)
+            if (client_id is None or record.get("client_id") == client_id)
+            and (message_type is None or record.get("message_type") == message_type)
+        ]
+
+    def exists(self, session_id: str) -> bool:
+        """ログが存在するか確認"""
+        return self.path(session_id).exists()
+
+    def delete(self, session_id: str) -> bool:
+        """ログを削除"""
+        log_file = self.path(session_id)
+        if log_file.exists():
+            log_file.unlink()
+            return True
+        return False
+
+    def remove_archived(self, session_id: str, count: int, commit: Callable[[], None]) -> bool:
+        """レコード数が count のままなら commit()（アーカイブの公開）を呼んでからログを削除する
+
+        件数が変わっていた（追記があった）場合は何もせず False を返す。
+        """
+        if self.count(session_id) != count:
+            return False
+        commit()
+        self.delete(session_id)
+        return True
+
+    def session_ids(self) -> List[str]:
+        """ログが存在するセッションIDの一覧"""
+        return [p.name[:-len(self.suffix)] for p in self.data_dir.glob(f"*{self.suffix}")]
+
+    def flush(self):
+        """未同期の書き込みをディスクに反映"""
+        pass
+
+    def close(self):
+        """ログを閉じる"""
+        self.flush()
+
+
+class JsonArrayMessageLog(MessageLog):
+    """旧形式: セッションごとのJSON配列（追記のたびに全体を書き直す）"""
+
+    suffix = ".json"
+
+    def append(self, session_id: str, records: List[dict]) -> int:
+        """レコードを追記し、最初のレコードの番号（seq）を返す"""
+        messages = list(self.iter_records(session_id))
+        first_seq = len(messages) + 1
+        messages.extend(records)
+        atomic_write(self.path(session_id), json.dumps(messages, ensure_ascii=False, indent=2))
+        return first_seq
+
+    def iter_records(self, session_id: str) -> Iterator[dict]:
+        """レコードを保存順に返す"""
+        log_file = self.path(session_id)
+        if not log_file.exists():
+            return iter(())
+        with open(log_file, 'r', encoding='utf-8') as f:
+            try:
+                return iter(json.load(f))
+            except json.JSONDecodeError as e:
+                print(f"Corrupt message log {log_file} (read as empty): {e}")
+                return iter(())
+
+
+class OffsetIndex:
+    """ログファイルのサイドカーインデックス: 固定長の (seq, バイト位置, 長さ, タイムスタンプ) の配列
+
+    n 番目（0始まり）のレコードのエントリはファイルの n * ENTRY.size バイト目にあるため、
+    件数はファイルサイズから、任意の位置のエントリは1回のスライスで求まる。
+    読み込みは mmap で行い、ファイルが伸びた場合だけ張り直す。
+    複数のプロセスから追記するため、書き込みは flock で排他する。
+    """
+
+    # seq, レコードの開始バイト位置, 改行を含む長さ, タイムスタンプ（ASCII、32バイトまで）
+    ENTRY = struct.Struct("<QQI32s")
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._file = open(self.path, 'a+b')
+        self._map: Optional[mmap.mmap] = None
+        self._size = 0
+
+    def refresh(self) -> bool:
+        """他のプロセスの追記に追いつく（ファイルが削除されていれば False）"""
+        stat = os.fstat(self._file.fileno())
+        if stat.st_nlink == 0:
+            return False
+        if stat.st_size != self._size:
+            self._remap(stat.st_size)
+        return True
+
+    def _remap(self, size: int):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        # 書き込み途中のエントリは数えない
+        self._size = size - size % self.ENTRY.size
+        if self._size:
+            self._map = mmap.mmap(self._file.fileno(), self._size, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        return self._size // self.ENTRY.size
+
+    def entry(self, position: int):
+        """position 番目のエントリ (seq, 位置, 長さ, タイムスタンプ)"""
+        return self.ENTRY.unpack_from(self._map, position * self.ENTRY.size)
+
+    def entries(self, start: int, stop: int) -> Iterator[tuple]:
+        """start 番目から stop 番目の手前までのエントリ"""
+        if start >= stop:
+            return iter(())
+        return self.ENTRY.iter_unpack(self._map[start * self.ENTRY.size:stop * self.ENTRY.size])
+
+    def timestamp(self, position: int) -> str:
+        """position 番目のレコードのタイムスタンプ"""
+        return self.entry(position)[3].rstrip(b"\0").decode("ascii", "replace")
+
+    def end(self) -> int:
+        """インデックス済みの範囲の終わり（ログファイル上のバイト位置）"""
+        if not len(self):
+            return 0
+        _, offset, length, _ = self.entry(len(self) - 1)
+        return offset + length
+
+    @classmethod
+    def pack(cls, seq: int, offset: int, length: int, timestamp) -> bytes:
+        if not isinstance(timestamp, str):
+            timestamp = ""
+        return cls.ENTRY.pack(seq, offset, length, timestamp.encode("ascii", "replace")[:32])
+
+    def lock(self):
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        self.refresh()
+
+    def unlock(self):
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    def write(self, data: bytes):
+        """エントリを追記（lock() している間に呼ぶ）"""
+        if os.fstat(self._file.fileno()).st_size != self._size:
+            # 書き込み途中で落ちたエントリを取り除く
+            self._file.truncate(self._size)
+        self._file.write(data)
+        self._file.flush()
+        self._remap(self._size + len(data))
+
+    def clear(self):
+        """全てのエントリを削除（lock() している間に呼ぶ）"""
+        self._file.truncate(0)
+        self._remap(0)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+
+class JsonlMessageLog(MessageLog):
+    """追記専用ログ: 1行1レコードのJSON Lines形式
+
+    レコードの位置は index/ 以下のサイドカーインデックス（OffsetIndex）に追記時に記録し、
+    件数・範囲の読み込み・タイムスタンプでの検索を、ファイル全体を読まずに行う。
+    インデックスがない・ログより遅れている場合は、読み込み時にログの続きから作る。
+    """
+
+    suffix = ".jsonl"
+    index_suffix = ".idx"
+    # アーカイブ中のログ（ログと同じファイルへのハードリンク。アーカイブを公開してから削除する）
+    archiving_suffix = ".archiving"
+    FSYNC_POLICIES = ("always", "interval", "never")
+    MAX_OPEN_FILES = 64
+
+    def __init__(self, data_dir: Path, fsync_policy: str = "interval", fsync_interval: float = 1.0):
+        super().__init__(data_dir)
+        if fsync_policy not in self.FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync_policy}")
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.index_dir = self.data_dir / "index"
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        # 追記用に開いたままにするファイル（LRU）
+        self._handles: "OrderedDict[str, object]" = OrderedDict()
+        self._last_fsync: Dict[str, float] = {}
+        self._unsynced: set = set()
+        # 開いたままにするインデックスと、読み込み用に mmap したログ（LRU）
+        self._indexes: "OrderedDict[str, OffsetIndex]" = OrderedDict()
+        self._maps: "OrderedDict[str, tuple]" = OrderedDict()
+        # ログの読み書きはセッションごとのロックの中で行う（別のセッションの fsync を待たない）
+        self._session_locks = SessionLocks()
+        # LRU と未同期のセッションの出し入れだけを排他する
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def encode(record: dict) -> bytes:
+        """レコードを1行分のバイト列に変換"""
+        return codec.dumps(record) + b"\n"
+
+    def index_path(self, session_id: str) -> Path:
+        """セッションのサイドカーインデックスのパス"""
+        return self.index_dir / f"{session_id}{self.index_suffix}"
+
+    def _evict(self, cache: "OrderedDict[str, object]", close):
+        """LRU から溢れたセッションのファイルを閉じる（他のスレッドが使用中のセッションは後回しにする）"""
+        with self._lock:
+            victims = list(cache)[:max(0, len(cache) - self.MAX_OPEN_FILES)]
+        for session_id in victims:
+            lock = self._session_locks(session_id)
+            if lock.acquire(blocking=False):
+                try:
+                    close(session_id)
+                finally:
+                    lock.release()
+
+    def _handle(self, session_id: str):
+        with self._lock:
+            handle = self._handles.get(session_id)
+            if handle is not None:
+                self._handles.move_to_end(session_id)
+                return handle
+        handle = open(self.path(session_id), 'ab')
+        with self._lock:
+            self._handles[session_id] = handle
+        self._evict(self._handles, self._close_handle)
+        return handle
+
+    def _close_handle(self, session_id: str):
+        with self._lock:
+            handle = self._handles.pop(session_id, None)
+            unsynced = session_id in self._unsynced
+            self._unsynced.discard(session_id)
+            self._last_fsync.pop(session_id, None)
+        if handle is None:
+            return
+        if unsynced:
+            handle.flush()
+            os.fsync(handle.fileno())
+        handle.close()
+
+    def _locked_handle(self, session_id: str):
+        """追記用のファイルをロックして返す（他のワーカーが削除・アーカイブしたファイルなら開き直す）"""
+        while True:
+            handle = self._handle(session_id)
+            if fcntl is not None:
+                fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+            try:
+                if os.path.samestat(os.fstat(handle.fileno()), os.stat(self.path(session_id))):
+                    return handle
+            except FileNotFoundError:
+                pass
+            if fcntl is not None:
+                fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+            self._close_handle(session_id)
+
+    def append(self, session_id: str, records: List[dict]) -> int:
+        """レコードを追記し、最初のレコードの番号（seq）を返す"""
+        if not records:
+            return self.count(session_id) + 1
+        lines = [self.encode(record) for record in records]
+        with self._session_locks(session_id):
+            # 他のプロセス（ワーカー）の追記と混ざらないよう、位置の確認から書き込みまでをロックする
+            handle = self._locked_handle(session_id)
+            try:
+                # 番号は他のワーカーの追記分も含めたレコード数から決める
+                index = self._refresh_index(session_id)
+                first_seq = len(index) + 1
+                position = os.fstat(handle.fileno()).st_size
+                if position > index.end() and not self._ends_with_newline(session_id):
+                    # 書き込み途中で落ちた末尾行に続けて書かないよう、改行で区切る
+                    handle.write(b"\n")
+                    position += 1
+                handle.write(b"".join(lines))
+                handle.flush()
+                # インデックスが最新なら追記分のエントリを足す（遅れていれば次の読み込み時に追いつく）
+                index.lock()
+                try:
+                    if index.end() == position:
+                        entries = []
+                        for seq, (line, record) in enumerate(zip(lines, records), start=first_seq):
+                            entries.append(index.pack(seq, position, len(line), record.get("timestamp")))
+                            position += len(line)
+                        index.write(b"".join(entries))
+                finally:
+                    index.unlock()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+
+            if self.fsync_policy == "always":
+                os.fsync(handle.fileno())
+            elif self.fsync_policy == "interval":
+                now = time.monotonic()
+                if now - self._last_fsync.get(session_id, 0.0) >= self.fsync_interval:
+                    os.fsync(handle.fileno())
+                    with self._lock:
+                        self._last_fsync[session_id] = now
+                        self._unsynced.discard(session_id)
+                else:
+                    with self._lock:
+                        self._unsynced.add(session_id)
+            else:
+                # neverでもflush()/close()時には同期する
+                with self._lock:
+                    self._unsynced.add(session_id)
+        return first_seq
+
+    def _ends_with_newline(self, session_id: str) -> bool:
+        with open(self.path(session_id), 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() == 0:
+                return True
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def repair_tail(self, session_id: str) -> Optional[str]:
+        """書き込み途中で落ちた末尾行を修復し、行った修復の内容を返す（問題がなければ None）
+
+        末尾行が改行だけ欠けた完全なレコードなら改行を足し、そうでなければ切り詰める。
+        他のワーカーの追記と重ならないよう、追記と同じファイルロックの中で行う。
+        """
+        with self._session_locks(session_id):
+            try:
+                f = open(self.path(session_id), 'r+b')
+            except FileNotFoundError:
+                return None
+            with f:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                try:
+                    size = os.fstat(f.fileno()).st_size
+                    # 最後の改行の直後（末尾行の先頭）を探す
+                    tail_start, end = 0, size
+                    while end > 0:
+                        begin = max(0, end - 65536)
+                        f.seek(begin)
+                        newline = f.read(end - begin).rfind(b"\n")
+                        if newline >= 0:
+                            tail_start = begin + newline + 1
+                            break
+                        end = begin
+                    if tail_start == size:
+                        return None
+                    f.seek(tail_start)
+                    tail = f.read()
+                    try:
+                        complete = isinstance(codec.loads(tail), dict)
+                    except json.JSONDecodeError:
+                        complete = False
+                    if complete:
+                        f.seek(size)
+                        f.write(b"\n")
+                        return "added missing newline after the last record"
+                    f.truncate(tail_start)
+                    return f"truncated {size - tail_start} bytes of an incomplete last record"
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def import_records(self, session_id: str, records: Iterable[dict]) -> bool:
+        """ログがない場合だけ records を書き込む（一時ファイルに書いてからログとして作成する）"""
+        log_file = self.path(session_id)
+        if log_file.exists():
+            return False
+        tmp_file = tmp_path(log_file)
+        try:
+            with open(tmp_file, 'wb') as f:
+                for record in records:
+                    f.write(self.encode(record))
+                f.flush()
+                os.fsync(f.fileno())
+            with self._session_locks(session_id):
+                # ログがない間に残っていたインデックスは使わない（読み込み時に作り直す）
+                self._close_index(session_id)
+                self.index_path(session_id).unlink(missing_ok=True)
+                try:
+                    # 他のプロセスが先に作ったログは上書きしない
+                    os.link(tmp_file, log_file)
+                except FileExistsError:
+                    return False
+            fsync_directory(self.data_dir)
+            return True
+        finally:
+            tmp_file.unlink(missing_ok=True)
+
+    def iter_records(self, session_id: str) -> Iterator[dict]:
+        """レコードを保存順に返す"""
+        log_file = self.path(session_id)
+        if not log_file.exists():
+            return
+        with open(log_file, 'rb') as f:
+            for line_no, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    yield codec.loads(line)
+                except json.JSONDecodeError:
+                    # 書き込み途中で落ちた末尾行などは読み飛ばす
+                    print(f"Skipping corrupt record in {log_file} (line {line_no})")
+
+    def count(self, session_id: str) -> int:
+        """レコード数を取得（インデックスのエントリ数）"""
+        with self._session_locks(session_id):
+            index = self._refresh_index(session_id)
+            return len(index) if index is not None else 0
+
+    def read_range(self, session_id: str, start: int, stop: int) -> List[dict]:
+        """保存順で start 番目から stop 番目の手前までのレコードを取得（0始まり）
+
+        インデックスから範囲のバイト位置を求め、mmap したログから該当するレコードだけを読む。
+        """
+        with self._session_locks(session_id):
+            index = self._refresh_index(session_id)
+            if index is None:
+                return []
+            start = max(start, 0)
+            stop = min(stop, len(index))
+            if start >= stop:
+                return []
+            entries = list(index.entries(start, stop))
+            data = self._mapped(session_id, index.end())
+            records = []
+            for _, offset, length, _ in entries:
+                try:
+                    records.append(codec.loads(data[offset:offset + length]))
+                except json.JSONDecodeError:
+                    pass
+            return records
+
+    def timestamp_at(self, session_id: str, position: int) -> Optional[str]:
+        """position 番目（0始まり）のレコードのタイムスタンプ（インデックスから読む）"""
+        with self._session_locks(session_id):
+            index = self._refresh_index(session_id)
+            if index is None or not 0 <= position < len(index):
+                return None
+            return index.timestamp(position)
+
+    def _mapped(self, session_id: str, size: int) -> mmap.mmap:
+        """ログファイルを size バイト以上 mmap したもの（ファイルが伸びていれば張り直す）"""
+        with self._lock:
+            cached = self._maps.get(session_id)
+            if cached is not None and cached[1] >= size:
+                self._maps.move_to_end(session_id)
+                return cached[0]
+        self._unmap(session_id)
+        with open(self.path(session_id), 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            inode = os.fstat(f.fileno()).st_ino
+        with self._lock:
+            # (mmap, 張った長さ, ログファイルの inode)
+            self._maps[session_id] = (mapped, len(mapped), inode)
+        self._evict(self._maps, self._unmap)
+        return mapped
+
+    def _unmap(self, session_id: str):
+        with self._lock:
+            cached = self._maps.pop(session_id, None)
+        if cached is not None:
+            cached[0].close()
+
+    def _index(self, session_id: str) -> OffsetIndex:
+        with self._lock:
+            index = self._indexes.get(session_id)
+            if index is not None:
+                self._indexes.move_to_end(session_id)
+        if index is not None:
+            if index.refresh():
+                return index
+            # 他のワーカーが削除したインデックスは開き直す
+            self._close_index(session_id)
+        index = OffsetIndex(self.index_path(session_id))
+        index.refresh()
+        with self._lock:
+            self._indexes[session_id] = index
+        self._evict(self._indexes, self._close_index)
+        return index
+
+    def _close_index(self, session_id: str):
+        with self._lock:
+            index = self._indexes.pop(session_id, None)
+        if index is not None:
+            index.close()
+        self._unmap(session_id)
+
+    def _refresh_index(self, session_id: str) -> Optional[OffsetIndex]:
+        """インデックスをログファイルの末尾まで追いつかせる（ログがなければ None）"""
+        log_file = self.path(session_id)
+        try:
+            stat = log_file.stat()
+        except FileNotFoundError:
+            self._close_index(session_id)
+            return None
+
+        index = self._index(session_id)
+        with self._lock:
+            cached = self._maps.get(session_id)
+        if cached is not None and cached[2] != stat.st_ino:
+            # ログファイルが置き換えられた
+            self._unmap(session_id)
+        if stat.st_size == index.end():
+            return index
+
+        index.lock()
+        try:
+            # ロックを待つ間に他のワーカーが追記した分も含めるため、サイズを取り直す
+            try:
+                size = log_file.stat().st_size
+            except FileNotFoundError:
+                return index
+            position = index.end()
+            if size < position:
+                # ログファイルが置き換えられた場合は作り直す
+                print(f"Rebuilding offset index for {log_file}")
+                index.clear()
+                self._unmap(session_id)
+                position = 0
+            if size > position:
+                entries = []
+                seq = len(index) + 1
+                with open(log_file, 'rb') as f:
+                    f.seek(position)
+                    for line in f:
+                        if not line.endswith(b"\n"):
+                            # 書き込み途中の行は次回に回す
+                            break
+                        if line.strip():
+                            try:
+                                record = codec.loads(line)
+                                entries.append(index.pack(seq, position, len(line), record.get("timestamp")))
+                                seq += 1
+                            except json.JSONDecodeError:
+                                pass
+                        position += len(line)
+                if entries:
+                    index.write(b"".join(entries))
+        finally:
+            index.unlock()
+        return index
+
+    def archiving_path(self, session_id: str) -> Path:
+        """アーカイブ中のログのパス"""
+        return self.data_dir / f"{session_id}{self.suffix}{self.archiving_suffix}"
+
+    def remove_archived(self, session_id: str, count: int, commit: Callable[[], None]) -> bool:
+        """レコード数が count のままなら commit()（アーカイブの公開）を呼んでからログを削除する
+
+        他のワーカーの追記と重ならないよう、件数の確認から削除までを追記と同じファイルロックの中で行う。
+        公開の前にログを *.archiving としてハードリンクしておき、途中で落ちた場合は
+        recover_archiving() でこのログを取り込んだアーカイブが公開済みならログを削除、そうでなければ元に戻す。
+        """
+        log_file = self.path(session_id)
+        archiving = self.archiving_path(session_id)
+        with self._session_locks(session_id):
+            try:
+                f = open(log_file, 'rb')
+            except FileNotFoundError:
+                return False
+            with f:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                try:
+                    try:
+                        if not os.path.samestat(os.fstat(f.fileno()), os.stat(log_file)):
+                            return False
+                    except FileNotFoundError:
+                        # ロックを待つ間に他のワーカーがアーカイブした
+                        return False
+                    index = self._refresh_index(session_id)
+                    if index is None or len(index) != count:
+                        return False
+                    os.link(log_file, archiving)
+                    fsync_directory(self.data_dir)
+                    try:
+                        commit()
+                    except Exception:
+                        archiving.unlink()
+                        raise
+                    self._close_handle(session_id)
+                    self._close_index(session_id)
+                    self.index_path(session_id).unlink(missing_ok=True)
+                    log_file.unlink()
+                    archiving.unlink()
+                    fsync_directory(self.data_dir)
+                    return True
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def recover_archiving(self, session_id: str, archived: Callable[[os.stat_result], bool]) -> Optional[str]:
+        """アーカイブの途中で落ちて残った *.archiving を片付け、行った修復の内容を返す
+
+        archived(*.archiving の stat) が真（このログを取り込んだアーカイブが公開済み）ならログを削除し、
+        そうでなければログを元に戻す。
+        """
+        log_file = self.path(session_id)
+        archiving = self.archiving_path(session_id)
+        with self._session_locks(session_id):
+            try:
+                f = open(archiving, 'rb')
+            except FileNotFoundError:
+                return None
+            with f:
+                # アーカイブ中のワーカーがいれば終わるのを待つ（ログと同じファイルなので同じロック）
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                try:
+                    stat = os.fstat(f.fileno())
+                    try:
+                        if not os.path.samestat(stat, os.stat(archiving)):
+                            return None
+                    except FileNotFoundError:
+                        return None
+                    try:
+                        same_log = os.path.samestat(stat, os.stat(log_file))
+                    except FileNotFoundError:
+                        same_log = None
+                    if archived(stat):
+                        if same_log:
+                            self._close_handle(session_id)
+                            self._close_index(session_id)
+                            self.index_path(session_id).unlink(missing_ok=True)
+                            log_file.unlink()
+                        archiving.unlink()
+                        action = "removed the log already moved to the archive"
+                    elif same_log is None:
+                        os.rename(archiving, log_file)
+                        action = "restored the log of an interrupted archive"
+                    elif same_log:
+                        archiving.unlink()
+                        action = "removed the link left by an interrupted archive"
+                    else:
+                        return None
+                    fsync_directory(self.data_dir)
+                    return action
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def delete(self, session_id: str) -> bool:
+        """ログとインデックスを削除"""
+        with self._session_locks(session_id):
+            self._close_handle(session_id)
+            self._close_index(session_id)
+            self.index_path(session_id).unlink(missing_ok=True)
+            return super().delete(session_id)
+
+    def flush(self):
+        """未同期の書き込みをディスクに反映（セッションごとにロックし、追記を長く止めない）"""
+        with self._lock:
+            session_ids = list(self._unsynced)
+        for session_id in session_ids:
+            with self._session_locks(session_id):
+                with self._lock:
+                    handle = self._handles.get(session_id)
+                if handle is not None:
+                    handle.flush()
+                    os.fsync(handle.fileno())
+                with self._lock:
+                    self._last_fsync[session_id] = time.monotonic()
+                    self._unsynced.discard(session_id)
+
+    def close(self):
+        """ログを閉じる"""
+        with self._lock:
+            session_ids = list(self._handles) + list(self._indexes)
+        for session_id in session_ids:
+            with self._session_locks(session_id):
+                self._close_handle(session_id)
+                self._close_index(session_id)
+
+
+LOG_FORMATS = {
+    "jsonl": JsonlMessageLog,
+    "json": JsonArrayMessageLog,
+}
+
+
+def create_message_log(log_format: str, data_dir: Path, **options) -> MessageLog:
+    """形式名からメッセージログを作成"""
+    if log_format not in LOG_FORMATS:
+        raise ValueError(f"Unknown message log format: {log_format}")
+    log_class = LOG_FORMATS[log_format]
+    if log_class is JsonArrayMessageLog:
+        return log_class(data_dir)
+    return log_class(data_dir, **options)
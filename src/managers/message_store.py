@@ -1,134 +1,589 @@
+import os
 import json
-from typing import List, Optional, Dict
+import heapq
+import tempfile
+import threading
+from itertools import islice
+from operator import itemgetter
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 from pathlib import Path
 from datetime import datetime
-from ..models.message import Message
+from .. import codec
+from ..models.message import Message, MessageRecord
+from ..metrics import timed
+from ..fileio import atomic_write
+from .message_log import MessageLog, JsonArrayMessageLog, create_message_log
+from .message_archive import MessageArchive, TieredMessageLog
+from .search_index import SearchIndex
+from .session_locks import SessionLocks
+
+try:
+    import fcntl
+except ImportError:  # Windows: 複数ワーカーでの共有には対応しない
+    fcntl = None
+
+
+def timestamp_key(timestamp: str) -> str:
+    """タイムスタンプを並べ替え・比較用のキー（ローカル時刻の固定長の文字列）に変換
+    
+    クライアントが送る UTC（末尾が Z）とサーバーのローカル時刻（タイムゾーンなし）が混在するため、
+    タイムゾーン付きのものはローカル時刻に揃える。解釈できない文字列はそのまま、文字列以外は空文字列を返す。
+    """
+    try:
+        parsed = datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        return timestamp if isinstance(timestamp, str) else ""
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed.isoformat(timespec="microseconds")
 
 
 class MessageStore:
-    """メッセージストアクラス"""
+    """メッセージストアクラス
+    
+    shared=True の場合は他のワーカー（プロセス）も同じログに追記する前提で、
+    統計情報などの集計値は自分の書き込み分を直接足さずにログの末尾から追いつかせる。
+    archive に圧縮形式（gzip / zstd）を指定すると、archive_session() で終了したセッションの
+    ログを archive/ 以下に圧縮して移す。読み込みはアーカイブと追記中のログを区別せずに行える。
+    """
+    
+    # iter_all_messages でセッションごとに一度に読み込むレコード数
+    MERGE_CHUNK_SIZE = 256
+    # 時刻順に並んでいないセッションをメモリ上で並べ替える件数（超える場合は一時ファイルを使う外部マージソート）
+    SORT_RUN_SIZE = 50000
     
-    def __init__(self, data_dir: str = "data/messages"):
+    def __init__(self, data_dir: str = "data/messages", log_format: str = "jsonl",
+                 fsync_policy: str = "interval", fsync_interval: float = 1.0,
+                 log: Optional[MessageLog] = None, shared: bool = False,
+                 archive: Optional[str] = None, archive_segment_size: int = 1000):
         self.data_dir = Path(data_dir)
+        self.shared = shared
         self.data_dir.mkdir(parents=True, exist_ok=True)
+        # log を渡した場合はそちらを使う（SQLiteなど別の保存先）
+        self.log: MessageLog = log or create_message_log(
+            log_format, self.data_dir,
+            fsync_policy=fsync_policy, fsync_interval=fsync_interval
+        )
+        if not isinstance(self.log, JsonArrayMessageLog):
+            self.migrate_legacy_files()
+        if archive:
+            self.log = TieredMessageLog(self.log, MessageArchive(
+                self.data_dir / "archive", archive, segment_size=archive_segment_size, shared=shared
+            ))
+        # セッションごとの {"records": 確認済みのレコード数, "joins": {クライアントID: 最初の入室メッセージの番号}}
+        self._first_joins: Dict[str, Dict] = {}
+        # セッションごとの統計情報（保存のたびに更新し、stats/ 以下に保存する）
+        self.stats_dir = self.data_dir / "stats"
+        self.stats_dir.mkdir(parents=True, exist_ok=True)
+        self._stats: Dict[str, Dict] = {}
+        self._dirty_stats: set = set()
+        # 本文検索用の転置インデックス（保存のたびに更新し、search/ 以下に保存する）
+        self.search_index = SearchIndex(self.data_dir / "search", self.log)
+        # 集計値などのメモリ上の状態はセッションごとのロックの中で更新する（別のセッションの追記を待たない）
+        self._session_locks = SessionLocks()
+        # _dirty_stats の出し入れだけを排他する
+        self._lock = threading.Lock()
     
     def save_message(self, message: Message):
         """メッセージを保存"""
-        # セッションごとにファイルを分ける
-        session_file = self.data_dir / f"{message.session_id}.json"
-        
-        # 既存のメッセージをロード
-        messages = []
-        if session_file.exists():
-            with open(session_file, 'r', encoding='utf-8') as f:
-                try:
-                    messages = json.load(f)
-                except json.JSONDecodeError:
-                    messages = []
+        self.save_messages([message])
+    
+    @timed("message_store")
+    def save_messages(self, messages: List[Message]) -> Dict[str, int]:
+        """複数のメッセージをセッションごとに1回の追記で保存
         
-        # 新しいメッセージを追加
-        messages.append(message.to_dict())
+        セッションごとに、追記した最初のメッセージの番号（seq）を返す。
+        """
+        by_session: Dict[str, List[Dict]] = {}
+        for message in messages:
+            by_session.setdefault(message.session_id, []).append(message.to_dict())
         
-        # ファイルに保存
-        with open(session_file, 'w', encoding='utf-8') as f:
-            json.dump(messages, f, ensure_ascii=False, indent=2)
+        first_seqs: Dict[str, int] = {}
+        for session_id, records in by_session.items():
+            with self._session_locks(session_id):
+                if self.shared:
+                    # 他のワーカーの追記と合わせて、集計値はログの末尾から追いつかせる
+                    first_seqs[session_id] = self.log.append(session_id, records)
+                    self._load_stats(session_id)
+                    self.search_index.catch_up(session_id)
+                    continue
+                
+                # 統計情報は追記前のログに合わせて読み込んでから更新する
+                stats = self._load_stats(session_id)
+                
+                # セッションごとのログにまとめて追記
+                next_seq = self.log.append(session_id, records)
+                first_seqs[session_id] = next_seq
+                
+                for record in records:
+                    self._apply_to_stats(stats, record)
+                self._mark_dirty(session_id)
+                self.search_index.add(session_id, next_seq, records)
+        return first_seqs
+    
+    @timed("message_store")
+    def get_records_by_session(self, session_id: str) -> List[MessageRecord]:
+        """セッションIDでメッセージを取得（軽量な MessageRecord で返す）"""
+        return [MessageRecord.from_dict(msg) for msg in self.log.iter_records(session_id)]
     
     def get_messages_by_session(self, session_id: str) -> List[Message]:
         """セッションIDでメッセージを取得"""
-        session_file = self.data_dir / f"{session_id}.json"
-        if not session_file.exists():
-            return []
-        
-        with open(session_file, 'r', encoding='utf-8') as f:
-            try:
-                data = json.load(f)
-                return [Message.from_dict(msg) for msg in data]
-            except json.JSONDecodeError:
-                return []
+        return [record.to_message() for record in self.get_records_by_session(session_id)]
+    
+    def iter_messages(self, session_id: str, limit: Optional[int] = None) -> Iterator[MessageRecord]:
+        """メッセージを保存順に1件ずつ返す（全件をメモリに読み込まない）"""
+        for record in islice(self.log.iter_records(session_id), limit):
+            yield MessageRecord.from_dict(record)
+    
+    @timed("message_store")
+    def get_records_by_client(self, session_id: str, client_id: str) -> List[MessageRecord]:
+        """特定のクライアントのメッセージを取得（軽量な MessageRecord で返す）"""
+        return [MessageRecord.from_dict(msg) for msg in self.log.query(session_id, client_id=client_id)]
     
     def get_messages_by_client(self, session_id: str, client_id: str) -> List[Message]:
         """特定のクライアントのメッセージを取得"""
-        messages = self.get_messages_by_session(session_id)
-        return [msg for msg in messages if msg.client_id == client_id]
+        return [record.to_message() for record in self.get_records_by_client(session_id, client_id)]
+    
+    @timed("message_store")
+    def get_records_by_type(self, session_id: str, message_type: str) -> List[MessageRecord]:
+        """メッセージタイプで絞り込み（軽量な MessageRecord で返す）"""
+        return [MessageRecord.from_dict(msg) for msg in self.log.query(session_id, message_type=message_type)]
     
     def get_messages_by_type(self, session_id: str, message_type: str) -> List[Message]:
         """メッセージタイプで絞り込み"""
-        messages = self.get_messages_by_session(session_id)
-        return [msg for msg in messages if msg.message_type == message_type]
+        return [record.to_message() for record in self.get_records_by_type(session_id, message_type)]
     
+    @timed("message_store")
     def get_messages_count(self, session_id: str) -> int:
         """セッションのメッセージ数を取得"""
-        return len(self.get_messages_by_session(session_id))
+        return self.log.count(session_id)
     
+    @timed("message_store")
+    def get_message_page(self, session_id: str, limit: Optional[int] = None,
+                         before: Optional[int] = None, after: Optional[int] = None,
+                         since_join: Optional[str] = None) -> Dict:
+        """メッセージをカーソル指定で取得
+        
+        メッセージ番号（seq）はセッション内の保存順で1から始まる。
+        after を指定すると seq > after のメッセージを古い順に、指定しなければ
+        before（未指定なら末尾）より前のメッセージを新しい側から limit 件返す。
+        since_join にクライアントIDを指定すると、そのクライアントが最初に入室した
+        メッセージより後だけに絞り込む（入室記録がなければ空）。
+        limit / before / after に負の値は指定できない（ValueError）。
+        """
+        for name, value in (("limit", limit), ("before", before), ("after", after)):
+            if value is not None and value < 0:
+                raise ValueError(f"{name} must not be negative: {value}")
+        total = self.log.count(session_id)
+        lower = after or 0  # この番号より後
+        upper = min(before, total + 1) if before is not None else total + 1  # この番号より前
+        
+        if since_join is not None:
+            join_seq = self.find_first_join(session_id, since_join)
+            if join_seq is None:
+                lower = upper
+            else:
+                lower = max(lower, join_seq)
+        
+        # seq は1始まり、ログ上の位置は0始まり
+        start, stop = lower, max(upper - 1, lower)
+        has_more = False
+        if limit is not None and stop - start > limit:
+            has_more = True
+            if after is not None:
+                stop = start + limit
+            else:
+                start = stop - limit
+        
+        records = self.log.read_range(session_id, start, stop)
+        messages = []
+        for seq, record in enumerate(records, start=start + 1):
+            data = MessageRecord.from_dict(record).to_dict()
+            data["seq"] = seq
+            messages.append(data)
+        
+        return {
+            "messages": messages,
+            "total": total,
+            "has_more": has_more,
+            "first_seq": start + 1 if messages else None,
+            "last_seq": start + len(messages) if messages else None,
+        }
+    
+    @timed("message_store")
+    def find_first_join(self, session_id: str, client_id: str) -> Optional[int]:
+        """クライアントが最初に入室したメッセージの番号（seq）を取得"""
+        with self._session_locks(session_id):
+            first_joins = self._first_joins.setdefault(session_id, {"records": 0, "joins": {}})
+            # 前回以降に追記された分だけを確認する
+            record_count = self.log.count(session_id)
+            if first_joins["records"] > record_count:
+                first_joins.update(records=0, joins={})
+            if first_joins["records"] < record_count:
+                records = self.log.read_range(session_id, first_joins["records"], record_count)
+                for seq, record in enumerate(records, start=first_joins["records"] + 1):
+                    if self._is_join(record):
+                        first_joins["joins"].setdefault(record.get("client_id"), seq)
+                first_joins["records"] = record_count
+            return first_joins["joins"].get(client_id)
+    
+    @staticmethod
+    def _is_join(record: dict) -> bool:
+        return record.get("message_type") == "system" and "joined" in record.get("content", "")
+    
+    @timed("message_store")
     def get_all_messages(self) -> List[Message]:
-        """全てのメッセージを取得"""
-        all_messages = []
-        for message_file in self.data_dir.glob("*.json"):
-            try:
-                with open(message_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    all_messages.extend([Message.from_dict(msg) for msg in data])
-            except Exception as e:
-                print(f"Error loading messages from {message_file}: {e}")
+        """全てのメッセージをタイムスタンプ順に取得（大量の場合は iter_all_messages() を使う）"""
+        return [record.to_message() for record in self.iter_all_messages()]
+    
+    def iter_all_messages(self, since: Optional[str] = None, until: Optional[str] = None,
+                          client_id: Optional[str] = None,
+                          session_ids: Optional[Iterable[str]] = None) -> Iterator[MessageRecord]:
+        """全セッション（または session_ids）のメッセージをタイムスタンプ順に1件ずつ返す
         
-        # タイムスタンプでソート
-        all_messages.sort(key=lambda m: m.timestamp)
-        return all_messages
+        セッションごとに時刻順に並べたストリームをヒープでマージする（k-way マージ）。
+        時刻の比較は timestamp_key() で揃えたキーで行う。
+        since 以上 until 未満のタイムスタンプ（ISO形式の文字列）と client_id で絞り込める。
+        """
+        if session_ids is None:
+            session_ids = self.log.session_ids()
+        since = timestamp_key(since) if since else None
+        until = timestamp_key(until) if until else None
+        streams = [self._iter_session_range(session_id, since, until, client_id) for session_id in session_ids]
+        return (message for _, message in heapq.merge(*streams, key=itemgetter(0)))
     
-    def get_session_statistics(self, session_id: str) -> Dict:
-        """セッションの統計情報を取得"""
-        messages = self.get_messages_by_session(session_id)
+    def _iter_session_range(self, session_id: str, since: Optional[str], until: Optional[str],
+                            client_id: Optional[str]) -> Iterator[Tuple[str, MessageRecord]]:
+        """1セッションのメッセージを (時刻のキー, メッセージ) として時刻順に返す（ファイルは一定件数ずつ読む）
+        
+        タイムスタンプはクライアントの時計なので保存順と時刻順が一致するとは限らない。
+        統計情報に記録した、ログが時刻順に並んでいるかどうかで読み方を変える。
+        - 並んでいる: 開始位置を二分探索で求め、until に達したら読むのをやめる（MERGE_CHUNK_SIZE 件ずつ返す）
+        - 並んでいない: 範囲内のメッセージを全て読んで _sort_by_time() で並べ替えてから返す
+        ログやアーカイブが読めないセッションは、ログに出力して飛ばす。
+        """
+        try:
+            with self._session_locks(session_id):
+                stats = self._load_stats(session_id)
+                ordered, total = stats["ordered"], stats["records"]
+            position = self._first_position_since(session_id, since, total) if since and ordered else 0
+            
+            def matching() -> Iterator[Tuple[str, dict]]:
+                nonlocal position
+                while position < total:
+                    records = self.log.read_range(session_id, position, min(position + self.MERGE_CHUNK_SIZE, total))
+                    if not records:
+                        return
+                    for record in records:
+                        key = timestamp_key(record.get("timestamp", ""))
+                        if until is not None and key >= until:
+                            if ordered:
+                                return
+                            continue
+                        if since is not None and key < since:
+                            continue
+                        if client_id is None or record.get("client_id") == client_id:
+                            yield key, record
+                    position += len(records)
+            
+            entries = matching() if ordered else self._sort_by_time(matching())
+            for key, record in entries:
+                yield key, MessageRecord.from_dict(record)
+        except (OSError, ValueError) as e:
+            # ValueError: 読めない統計情報・アーカイブ（json.JSONDecodeError など）
+            print(f"Error loading messages from {self.log.path(session_id)}: {e}")
+    
+    def _sort_by_time(self, entries: Iterator[Tuple[str, dict]]) -> Iterator[Tuple[str, dict]]:
+        """(時刻のキー, レコード) を時刻順（同じ時刻は元の順）に並べ替えて返す
         
-        if not messages:
+        SORT_RUN_SIZE 件以下ならメモリ上で並べ替える。超える場合は SORT_RUN_SIZE 件ずつ並べ替えて
+        一時ファイルに書き出し、それらをヒープでマージする（外部マージソート）ため、
+        メモリに載るのは SORT_RUN_SIZE 件と各一時ファイルの1行だけになる。
+        """
+        runs = []
+        try:
+            while True:
+                run = sorted(islice(entries, self.SORT_RUN_SIZE), key=itemgetter(0))
+                if len(run) < self.SORT_RUN_SIZE and not runs:
+                    yield from run
+                    return
+                if run:
+                    f = tempfile.TemporaryFile()
+                    runs.append(f)
+                    f.writelines(codec.dumps(entry) + b"\n" for entry in run)
+                    f.seek(0)
+                if len(run) < self.SORT_RUN_SIZE:
+                    break
+            yield from heapq.merge(*(map(codec.loads, f) for f in runs), key=itemgetter(0))
+        finally:
+            for f in runs:
+                f.close()
+    
+    def _first_position_since(self, session_id: str, since: str, total: int) -> int:
+        """タイムスタンプが since 以上の最初のレコードの位置（時刻順に並んだログを二分探索）"""
+        low, high = 0, total
+        while low < high:
+            middle = (low + high) // 2
+            timestamp = self.log.timestamp_at(session_id, middle)
+            if timestamp is not None and timestamp_key(timestamp) < since:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+    
+    @timed("message_store")
+    def get_session_statistics(self, session_id: str) -> Dict:
+        """セッションの統計情報を取得（保存時に更新済みの集計値を返す）"""
+        with self._session_locks(session_id):
+            stats = self._load_stats(session_id)
             return {
-                "total_messages": 0,
-                "total_chars": 0,
-                "total_words": 0,
-                "participants": [],
-                "message_by_user": {}
+                "total_messages": stats["total_messages"],
+                "total_chars": stats["total_chars"],
+                "total_words": stats["total_words"],
+                "participants": list(stats["participants"]),
+                "message_by_user": {
+                    client_id: dict(data) for client_id, data in stats["message_by_user"].items()
+                }
             }
-        
-        # 参加者ごとのメッセージ数を集計
-        message_by_user = {}
-        total_chars = 0
-        total_words = 0
-        participants = set()
-        
-        for msg in messages:
-            if msg.message_type == "message":
-                participants.add(msg.client_id)
-                if msg.client_id not in message_by_user:
-                    message_by_user[msg.client_id] = {
-                        "count": 0,
-                        "chars": 0,
-                        "words": 0
-                    }
-                
-                message_by_user[msg.client_id]["count"] += 1
-                message_by_user[msg.client_id]["chars"] += msg.metadata.char_count
-                message_by_user[msg.client_id]["words"] += msg.metadata.word_count
-                
-                total_chars += msg.metadata.char_count
-                total_words += msg.metadata.word_count
-        
+    
+    @timed("message_store")
+    def get_statistics_totals(self, session_id: str) -> Dict:
+        """メッセージ数・文字数・単語数の合計だけを取得（管理画面の更新用）"""
+        with self._session_locks(session_id):
+            stats = self._load_stats(session_id)
+            return {
+                "total_messages": stats["total_messages"],
+                "total_chars": stats["total_chars"],
+                "total_words": stats["total_words"]
+            }
+    
+    def _stats_path(self, session_id: str) -> Path:
+        return self.stats_dir / f"{session_id}.json"
+    
+    @staticmethod
+    def _empty_stats() -> Dict:
         return {
-            "total_messages": len([m for m in messages if m.message_type == "message"]),
-            "total_chars": total_chars,
-            "total_words": total_words,
-            "participants": list(participants),
-            "message_by_user": message_by_user
+            "records": 0,  # 集計済みのレコード数（ログとの整合性の確認用）
+            "last_timestamp": "",  # 集計済みのレコードの最も新しいタイムスタンプ（timestamp_key）
+            "ordered": True,  # ログがタイムスタンプ順に並んでいるか（iter_all_messages で使う）
+            "total_messages": 0,
+            "total_chars": 0,
+            "total_words": 0,
+            "participants": [],
+            "message_by_user": {}
         }
     
+    @staticmethod
+    def _apply_to_stats(stats: Dict, record: Dict):
+        """1レコード分を統計情報に加算"""
+        stats["records"] += 1
+        key = timestamp_key(record.get("timestamp", ""))
+        if key < stats["last_timestamp"]:
+            stats["ordered"] = False
+        else:
+            stats["last_timestamp"] = key
+        if record.get("message_type", "message") != "message":
+            return
+        
+        client_id = record.get("client_id")
+        metadata = record.get("metadata") or {}
+        content = record.get("content", "")
+        chars = metadata.get("char_count", len(content))
+        words = metadata.get("word_count", len(content.split()))
+        
+        if client_id not in stats["message_by_user"]:
+            stats["participants"].append(client_id)
+            stats["message_by_user"][client_id] = {
+                "count": 0,
+                "chars": 0,
+                "words": 0
+            }
+        user_stats = stats["message_by_user"][client_id]
+        user_stats["count"] += 1
+        user_stats["chars"] += chars
+        user_stats["words"] += words
+        
+        stats["total_messages"] += 1
+        stats["total_chars"] += chars
+        stats["total_words"] += words
+    
+    def _load_stats(self, session_id: str) -> Dict:
+        """統計情報を取得（ログより古ければ追記された分を集計して追いつかせる）"""
+        stats = self._stats.get(session_id)
+        if stats is not None and not self.shared:
+            return stats
+        
+        record_count = self.log.count(session_id)
+        stats_file = self._stats_path(session_id)
+        if stats is None and stats_file.exists():
+            try:
+                with open(stats_file, 'r', encoding='utf-8') as f:
+                    stats = json.load(f)
+            except json.JSONDecodeError:
+                stats = None
+        
+        if stats is None or "ordered" not in stats or stats.get("records", 0) > record_count:
+            # ログが置き換えられた場合や、以前のバージョンで集計した場合は集計し直す
+            stats = self._empty_stats()
+        if stats["records"] < record_count:
+            for record in self.log.read_range(session_id, stats["records"], record_count):
+                self._apply_to_stats(stats, record)
+            self._mark_dirty(session_id)
+        
+        self._stats[session_id] = stats
+        return stats
+    
+    def _mark_dirty(self, session_id: str):
+        with self._lock:
+            self._dirty_stats.add(session_id)
+    
+    def _save_stats(self):
+        """更新された統計情報をファイルに保存"""
+        with self._lock:
+            session_ids = list(self._dirty_stats)
+            self._dirty_stats.clear()
+        snapshots = {}
+        for session_id in session_ids:
+            with self._session_locks(session_id):
+                if session_id in self._stats:
+                    snapshots[session_id] = json.dumps(self._stats[session_id], ensure_ascii=False)
+        for session_id, data in snapshots.items():
+            # ログから作り直せるため fsync はしない（置き換えの途中で壊れないことだけを保証する）
+            atomic_write(self._stats_path(session_id), data, fsync=False)
+    
+    @timed("message_store")
+    def archive_session(self, session_id: str) -> bool:
+        """終了したセッションのログを圧縮してアーカイブに移す（アーカイブが無効なら何もしない）"""
+        if not isinstance(self.log, TieredMessageLog):
+            return False
+        return self.log.archive_session(session_id)
+    
+    def unarchived_count(self, session_id: str) -> int:
+        """アーカイブに移していないメッセージ数（アーカイブが無効なら 0）"""
+        if not isinstance(self.log, TieredMessageLog):
+            return 0
+        return self.log.unarchived_count(session_id)
+    
+    @timed("message_store")
     def delete_session_messages(self, session_id: str) -> bool:
         """セッションのメッセージを削除"""
-        session_file = self.data_dir / f"{session_id}.json"
-        if session_file.exists():
-            session_file.unlink()
-            return True
-        return False
+        with self._session_locks(session_id):
+            self._first_joins.pop(session_id, None)
+            self._stats.pop(session_id, None)
+            with self._lock:
+                self._dirty_stats.discard(session_id)
+            stats_file = self._stats_path(session_id)
+            if stats_file.exists():
+                stats_file.unlink()
+            self.search_index.delete(session_id)
+            return self.log.delete(session_id)
+    
+    @timed("message_store")
+    def search_records(self, session_id: str, keyword: str) -> List[MessageRecord]:
+        """メッセージを検索（保存順、軽量な MessageRecord で返す）"""
+        hits = sorted(seq for _, seq in self.search_index.search(session_id, keyword))
+        return [MessageRecord.from_dict(record) for _, record in self._read_hits(session_id, hits)]
     
     def search_messages(self, session_id: str, keyword: str) -> List[Message]:
-        """メッセージを検索"""
-        messages = self.get_messages_by_session(session_id)
-        return [msg for msg in messages if keyword.lower() in msg.content.lower()]
-
+        """メッセージを検索（保存順）"""
+        return [record.to_message() for record in self.search_records(session_id, keyword)]
+    
+    @timed("message_store")
+    def search(self, session_id: str, query: str, limit: int = 20, offset: int = 0) -> Dict:
+        """セッション内のメッセージを検索し、関連度の高い順に1ページ分を返す"""
+        hits = self.search_index.search(session_id, query)
+        return self._search_page(query, [(score, session_id, seq) for score, seq in hits], limit, offset)
+    
+    @timed("message_store")
+    def search_all(self, query: str, limit: int = 20, offset: int = 0,
+                   session_ids: Optional[List[str]] = None) -> Dict:
+        """全セッション（または指定したセッション）を横断して検索
+        
+        セッションごとにインデックスでヒットした番号だけを集め、返すページ分のメッセージだけを読み込む。
+        """
+        if session_ids is None:
+            session_ids = self.log.session_ids()
+        hits = []
+        for session_id in session_ids:
+            try:
+                hits.extend((score, session_id, seq) for score, seq in self.search_index.search(session_id, query))
+            except Exception as e:
+                print(f"Error searching messages in {self.log.path(session_id)}: {e}")
+        return self._search_page(query, hits, limit, offset)
+    
+    def _search_page(self, query: str, hits: List, limit: int, offset: int) -> Dict:
+        """(スコア, セッションID, seq) の一覧を並べ替えて1ページ分のメッセージを読み込む"""
+        # スコアが同じなら新しいセッション・新しいメッセージを先にする
+        hits.sort(reverse=True)
+        page = hits[offset:offset + limit]
+        results = []
+        for score, session_id, seq in page:
+            for _, record in self._read_hits(session_id, [seq]):
+                data = MessageRecord.from_dict(record).to_dict()
+                data["seq"] = seq
+                data["score"] = round(score, 4)
+                results.append(data)
+        return {
+            "query": query,
+            "total": len(hits),
+            "results": results,
+            "has_more": offset + limit < len(hits),
+        }
+    
+    def _read_hits(self, session_id: str, seqs: List[int]):
+        """番号（seq）を指定してレコードを読み込む"""
+        for seq in seqs:
+            for record in self.log.read_range(session_id, seq - 1, seq):
+                yield seq, record
+    
+    def migrate_legacy_files(self) -> int:
+        """旧形式（JSON配列）のファイルを現在のログ形式に一括変換
+        
+        複数のワーカーが同時に起動しても1つずつ変換するよう、データディレクトリのファイルロックの中で行う。
+        ログは丸ごと書き込んでから作成するため、途中で落ちても次の起動時に最初から変換し直せる。
+        """
+        with open(self.data_dir / ".migrate.lock", 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                return self._migrate_legacy_files()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    
+    def _migrate_legacy_files(self) -> int:
+        legacy_log = JsonArrayMessageLog(self.data_dir)
+        migrated = 0
+        for session_id in legacy_log.session_ids():
+            legacy_file = legacy_log.path(session_id)
+            try:
+                with open(legacy_file, 'r', encoding='utf-8') as f:
+                    records = json.load(f)
+            except FileNotFoundError:
+                # ロックを待つ間に他のワーカーが変換した
+                continue
+            except json.JSONDecodeError as e:
+                print(f"Skipping migration of {legacy_file}: {e}")
+                continue
+            if not self.log.import_records(session_id, records):
+                print(f"Skipping migration of {legacy_file}: {self.log.path(session_id)} already exists")
+                continue
+            # 元ファイルはバックアップとして残す
+            os.replace(legacy_file, legacy_file.with_name(legacy_file.name + ".bak"))
+            migrated += 1
+        if migrated:
+            print(f"Migrated {migrated} message file(s) to {self.log.suffix} format")
+        return migrated
+    
+    @timed("message_store")
+    def flush(self):
+        """未同期の書き込みをディスクに反映"""
+        self.log.flush()
+        self._save_stats()
+        self.search_index.save()
+    
+    def close(self):
+        """ストアを閉じる"""
+        self.log.close()
+        self._save_stats()
+        self.search_index.save()
@@ -0,0 +1,135 @@
+import time
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Sequence, Tuple
+from fastapi import WebSocket
+from .. import metrics
+
+# キューに入れてから送信し終えるまでの時間（遅いクライアントほど長くなる）
+DELIVERY_SECONDS = metrics.histogram(
+    "chat_broadcast_delivery_seconds", "Time from enqueue to completed WebSocket send"
+)
+DROPPED_FRAMES = metrics.counter(
+    "chat_outbound_dropped_frames_total", "Frames dropped because an outbound queue was full", ("policy",)
+)
+COALESCED_FRAMES = metrics.counter(
+    "chat_outbound_coalesced_frames_total", "Queued frames replaced by a newer frame with the same key"
+)
+
+
+class OutboundQueue:
+    """1つのWebSocket接続の送信キュー
+
+    送信は接続ごとの送信タスクが順番に行い、回線の遅いクライアントが
+    同じルームの他のクライアントへの送信を待たせないようにする。
+    キューが max_size に達したときの動作は policy で指定する:
+    - drop_oldest: 最も古いフレームを捨てる
+    - coalesce: 同じキーのフレームは最新のものに置き換え、それでも溢れる場合は最も古いフレームを捨てる
+    - disconnect: 接続を切断する
+    """
+
+    POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+    def __init__(self, client_id: str, websocket: WebSocket, max_size: int = 256,
+                 policy: str = "disconnect", send_timeout: float = 5.0,
+                 on_failure: Optional[Callable[["OutboundQueue"], Awaitable[None]]] = None):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.client_id = client_id
+        self.websocket = websocket
+        self.max_size = max_size
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self.on_failure = on_failure
+        # (キー, ペイロード, キューに入れた時刻)
+        self._frames: Deque[Tuple[Optional[str], str, float]] = deque()
+        self._ready = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        # True の間は送信せずにキューに貯める（再送するフレームを先頭に入れるまで）
+        self._held = False
+        self._stopped = False
+        # メトリクス
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+
+    def start(self):
+        """送信タスクを開始"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """送信タスクを停止し、終わるのを待つ（未送信のフレームは捨てる）"""
+        task, self._task = self._task, None
+        self._frames.clear()
+        # wait_for は送信完了と同時のキャンセルを握りつぶすことがあるので、フラグを立てて起こす
+        self._stopped = True
+        self._ready.set()
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    def put(self, payload: str, key: Optional[str] = None) -> bool:
+        """フレームをキューに入れる（policy が disconnect で溢れた場合は False）"""
+        if key is not None and self.policy == "coalesce":
+            for i, (queued_key, _, queued_at) in enumerate(self._frames):
+                if queued_key == key:
+                    self._frames[i] = (key, payload, queued_at)
+                    self.coalesced += 1
+                    COALESCED_FRAMES.inc()
+                    return True
+
+        if len(self._frames) >= self.max_size:
+            self.dropped += 1
+            DROPPED_FRAMES.labels(self.policy).inc()
+            if self.policy == "disconnect":
+                return False
+            self._frames.popleft()
+
+        self._frames.append((key, payload, time.perf_counter()))
+        self.max_depth = max(self.max_depth, len(self._frames))
+        self._ready.set()
+        return True
+
+    def hold(self):
+        """送信を一時停止（その間に届いたフレームはキューに貯める）"""
+        self._held = True
+
+    def release(self, frames: Sequence[str] = ()):
+        """frames をキューの先頭に入れて送信を再開（再送用、max_size を超えても捨てない）"""
+        now = time.perf_counter()
+        self._frames.extendleft((None, payload, now) for payload in reversed(frames))
+        self.max_depth = max(self.max_depth, len(self._frames))
+        self._held = False
+        self._ready.set()
+
+    async def _run(self):
+        while not self._stopped:
+            await self._ready.wait()
+            while self._frames and not self._held:
+                _, payload, queued_at = self._frames.popleft()
+                try:
+                    await asyncio.wait_for(self.websocket.send_text(payload), timeout=self.send_timeout)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    # 送信できない（タイムアウト・切断済み）接続は呼び出し元で後片付けする
+                    self._task = None
+                    if self.on_failure is not None:
+                        await self.on_failure(self)
+                    return
+                self.sent += 1
+                DELIVERY_SECONDS.observe(time.perf_counter() - queued_at)
+            self._ready.clear()
+
+    def metrics(self) -> Dict:
+        """キューの長さと送信・破棄したフレーム数"""
+        return {
+            "depth": len(self._frames),
+            "max_depth": self.max_depth,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "policy": self.policy
+        }
@@ -0,0 +1,358 @@
+import os
+import asyncio
+import itertools
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Optional, Set
+from .. import codec
+
+# 受信したメッセージを処理するコールバック: handler(channel, data)
+Handler = Callable[[str, str], Awaitable[None]]
+
+# ブローカーとやり取りする1行（1メッセージ）の最大長
+MAX_LINE = 16 * 1024 * 1024
+
+
+class PubSub:
+    """ワーカー間でブロードキャストと共有状態をやり取りするためのインターフェース
+
+    - publish したメッセージは自分を含む全ワーカーの handler に届く
+    - claim したキーは release するか、そのワーカーが終了するまで他のワーカーから claim できない
+    - set / get / delete はワーカー間で共有するキーと値（管理者トークンなど）
+    """
+
+    async def start(self, handler: Handler):
+        """メッセージの受信を開始"""
+        raise NotImplementedError
+
+    async def publish(self, channel: str, data: str):
+        """チャンネルにメッセージを送信"""
+        raise NotImplementedError
+
+    async def claim(self, key: str, value: str = "1") -> bool:
+        """キーがどのワーカーにも確保されていなければ確保する"""
+        raise NotImplementedError
+
+    async def release(self, key: str):
+        """確保したキーを解放"""
+        raise NotImplementedError
+
+    async def set(self, key: str, value: str):
+        """共有の値を設定"""
+        raise NotImplementedError
+
+    async def get(self, key: str) -> Optional[str]:
+        """共有の値を取得"""
+        raise NotImplementedError
+
+    async def delete(self, key: str):
+        """共有の値を削除"""
+        raise NotImplementedError
+
+    async def close(self):
+        """接続を閉じる"""
+        pass
+
+
+class InProcessPubSub(PubSub):
+    """1プロセス（ワーカー1つ）用: メッセージも共有状態もプロセス内で完結する"""
+
+    def __init__(self):
+        self._handler: Optional[Handler] = None
+        self._claims: Dict[str, str] = {}
+        self._values: Dict[str, str] = {}
+
+    async def start(self, handler: Handler):
+        """メッセージの受信を開始"""
+        self._handler = handler
+
+    async def publish(self, channel: str, data: str):
+        """チャンネルにメッセージを送信"""
+        if self._handler is not None:
+            await self._handler(channel, data)
+
+    async def claim(self, key: str, value: str = "1") -> bool:
+        """キーが確保されていなければ確保する"""
+        if key in self._claims:
+            return False
+        self._claims[key] = value
+        return True
+
+    async def release(self, key: str):
+        """確保したキーを解放"""
+        self._claims.pop(key, None)
+
+    async def set(self, key: str, value: str):
+        """共有の値を設定"""
+        self._values[key] = value
+
+    async def get(self, key: str) -> Optional[str]:
+        """共有の値を取得"""
+        return self._values.get(key)
+
+    async def delete(self, key: str):
+        """共有の値を削除"""
+        self._values.pop(key, None)
+
+
+class UnixSocketPubSub(PubSub):
+    """複数ワーカー用: 同じマシン上のブローカー（PubSubBroker）にUnixソケットで接続する
+
+    publish したメッセージは自分の handler にすぐ渡し、ブローカー経由で他のワーカーにも届ける。
+    ブローカーとの接続が切れた場合は再接続し、確保していたキーを確保し直す。
+    接続の回復・応答・送信を timeout 秒より長く待つ場合は ConnectionError にする（呼び出し側を止めたままにしない）。
+    """
+
+    RECONNECT_INTERVAL = 0.5
+
+    def __init__(self, socket_path: str, timeout: float = 5.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._handler: Optional[Handler] = None
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._connected: Optional[asyncio.Event] = None
+        self._replies: Dict[int, asyncio.Future] = {}
+        self._request_ids = itertools.count(1)
+        # 再接続時に確保し直すキー
+        self._claims: Dict[str, str] = {}
+        # 受信したメッセージは1つのタスクで順番に処理する（チャンネル内の順序を保つ）
+        self._inbox: Optional["asyncio.Queue[tuple]"] = None
+        self._tasks = []
+        self._closing = False
+
+    async def start(self, handler: Handler):
+        """ブローカーに接続してメッセージの受信を開始"""
+        self._handler = handler
+        # イベントループに紐づくものは起動時に作る
+        self._connected = asyncio.Event()
+        self._inbox = asyncio.Queue()
+        await self._connect()
+        self._tasks = [
+            asyncio.create_task(self._read_loop()),
+            asyncio.create_task(self._deliver_loop()),
+        ]
+
+    async def _connect(self):
+        while not self._closing:
+            try:
+                self._reader, self._writer = await asyncio.open_unix_connection(
+                    self.socket_path, limit=MAX_LINE
+                )
+                break
+            except (FileNotFoundError, ConnectionRefusedError) as e:
+                print(f"Waiting for pub/sub broker at {self.socket_path}: {e}")
+                await asyncio.sleep(self.RECONNECT_INTERVAL)
+        self._connected.set()
+        for key, value in self._claims.items():
+            self._send({"op": "claim", "key": key, "value": value, "id": 0})
+
+    async def _read_loop(self):
+        while not self._closing:
+            try:
+                line = await self._reader.readline()
+            except (ConnectionError, ValueError):
+                # ValueError: MAX_LINE を超える行を受信した
+                line = b""
+            if not line:
+                # ブローカーとの接続が切れた
+                self._connected.clear()
+                for future in self._replies.values():
+                    if not future.done():
+                        future.set_exception(ConnectionError("pub/sub broker disconnected"))
+                self._replies.clear()
+                if self._closing:
+                    return
+                print("Lost connection to pub/sub broker, reconnecting...")
+                await self._connect()
+                continue
+            try:
+                message = codec.loads(line)
+                if message["op"] == "message":
+                    self._inbox.put_nowait((message["channel"], message["data"]))
+                elif message["op"] == "reply":
+                    future = self._replies.pop(message["id"], None)
+                    if future is not None and not future.done():
+                        future.set_result(message.get("result"))
+            except (codec.JSONDecodeError, KeyError, TypeError) as e:
+                # 読めないフレームは捨てて次の行を読む（受信を止めない）
+                print(f"Skipping malformed pub/sub frame: {e!r}")
+
+    async def _deliver_loop(self):
+        while True:
+            channel, data = await self._inbox.get()
+            try:
+                await self._handler(channel, data)
+            except Exception as e:
+                print(f"Error handling pub/sub message on {channel}: {e}")
+
+    def _send(self, message: dict):
+        self._writer.write(codec.dumps(message) + b"\n")
+
+    async def _wait(self, awaitable, error: str):
+        """awaitable を timeout 秒まで待つ（超えたら ConnectionError）"""
+        try:
+            return await asyncio.wait_for(awaitable, self.timeout)
+        except asyncio.TimeoutError:
+            raise ConnectionError(f"{error} (pub/sub broker at {self.socket_path})") from None
+
+    async def _request(self, message: dict):
+        await self._wait(self._connected.wait(), "not connected")
+        request_id = next(self._request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._replies[request_id] = future
+        try:
+            self._send(dict(message, id=request_id))
+            await self._wait(self._writer.drain(), "send timed out")
+            return await self._wait(future, "no reply")
+        finally:
+            self._replies.pop(request_id, None)
+
+    async def publish(self, channel: str, data: str):
+        """チャンネルにメッセージを送信（自分のワーカーにはすぐ届ける）"""
+        if self._handler is not None:
+            await self._handler(channel, data)
+        await self._wait(self._connected.wait(), "not connected")
+        self._send({"op": "publish", "channel": channel, "data": data})
+        await self._wait(self._writer.drain(), "send timed out")
+
+    async def claim(self, key: str, value: str = "1") -> bool:
+        """キーがどのワーカーにも確保されていなければ確保する"""
+        ok = await self._request({"op": "claim", "key": key, "value": value})
+        if ok:
+            self._claims[key] = value
+        return bool(ok)
+
+    async def release(self, key: str):
+        """確保したキーを解放"""
+        if self._claims.pop(key, None) is not None:
+            await self._request({"op": "release", "key": key})
+
+    async def set(self, key: str, value: str):
+        """共有の値を設定"""
+        await self._request({"op": "set", "key": key, "value": value})
+
+    async def get(self, key: str) -> Optional[str]:
+        """共有の値を取得"""
+        return await self._request({"op": "get", "key": key})
+
+    async def delete(self, key: str):
+        """共有の値を削除"""
+        await self._request({"op": "delete", "key": key})
+
+    async def close(self):
+        """接続を閉じる（確保したキーはブローカー側で解放される）"""
+        self._closing = True
+        for task in self._tasks:
+            task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+
+
+class PubSubBroker:
+    """ワーカー間のメッセージを中継するブローカー（Unixソケットのサーバー）
+
+    1行1メッセージのJSONでやり取りする。確保されたキーは確保したワーカーとの接続に紐づき、
+    接続が切れると解放される（落ちたワーカーのクライアントIDが残らない）。
+    送信先の受信が追いつくまで送信元の読み込みを待たせ（バックプレッシャー）、
+    SEND_TIMEOUT 秒待っても受信しないワーカーは切断する（再接続して確保し直す）。
+    """
+
+    SEND_TIMEOUT = 5.0
+
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+        self._clients: Set[asyncio.StreamWriter] = set()
+        # key: キー, value: (値, 確保した接続)
+        self._claims: Dict[str, tuple] = {}
+        self._values: Dict[str, str] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        """ソケットを作成して接続の受付を開始"""
+        path = Path(self.socket_path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.exists():
+            os.unlink(path)
+        self._server = await asyncio.start_unix_server(
+            self._handle_client, path=str(path), limit=MAX_LINE
+        )
+        print(f"Pub/sub broker listening on {self.socket_path}")
+
+    async def serve_forever(self):
+        """終了するまで接続を受け付ける"""
+        await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._clients.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    message = codec.loads(line)
+                except codec.JSONDecodeError:
+                    continue
+                await self._dispatch(writer, message)
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            self._clients.discard(writer)
+            for key in [k for k, (_, owner) in self._claims.items() if owner is writer]:
+                del self._claims[key]
+            writer.close()
+
+    async def _send(self, client: asyncio.StreamWriter, payload: bytes):
+        client.write(payload)
+        try:
+            await asyncio.wait_for(client.drain(), self.SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            print("Disconnecting a pub/sub client that stopped reading")
+            # close() は送信バッファを送り切るまで閉じないため、すぐに切断する
+            client.transport.abort()
+        except ConnectionError:
+            pass
+
+    async def _dispatch(self, writer: asyncio.StreamWriter, message: dict):
+        op = message.get("op")
+        if op == "publish":
+            payload = codec.dumps({
+                "op": "message", "channel": message["channel"], "data": message["data"]
+            }) + b"\n"
+            await asyncio.gather(*(self._send(client, payload) for client in list(self._clients) if client is not writer))
+            return
+
+        key = message.get("key")
+        if op == "claim":
+            current = self._claims.get(key)
+            result = current is None or current[1] is writer
+            if result:
+                self._claims[key] = (message.get("value"), writer)
+        elif op == "release":
+            current = self._claims.get(key)
+            if current is not None and current[1] is writer:
+                del self._claims[key]
+            result = None
+        elif op == "set":
+            self._values[key] = message.get("value")
+            result = None
+        elif op == "get":
+            result = self._values.get(key)
+        elif op == "delete":
+            self._values.pop(key, None)
+            result = None
+        else:
+            return
+        if message.get("id"):
+            await self._send(writer, codec.dumps({"op": "reply", "id": message["id"], "result": result}) + b"\n")
+
+
+def create_pubsub(backend: str, socket_path: str, timeout: float = 5.0) -> PubSub:
+    """設定名から PubSub を作成"""
+    if backend == "memory":
+        return InProcessPubSub()
+    if backend == "unix":
+        return UnixSocketPubSub(socket_path, timeout=timeout)
+    raise ValueError(f"Unknown pub/sub backend: {backend}")
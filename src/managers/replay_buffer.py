@@ -0,0 +1,66 @@
+from collections import OrderedDict, deque
+from typing import Deque, List, Optional, Tuple
+
+
+class ReplayBuffer:
+    """セッションごとの直近のブロードキャストを保持するリングバッファ（再接続時の再送用）
+
+    メッセージ番号（seq）とエンコード済みのペイロードを seq 順に保持し、
+    再接続したクライアントが最後に受信した番号より後のものだけを返す。
+    古いものは size 件を超えると捨て、セッション数が max_sessions を超えると
+    最も長く使われていないセッションから捨てる。
+    """
+
+    def __init__(self, size: int = 500, max_sessions: int = 256):
+        self.size = size
+        self.max_sessions = max_sessions
+        # key: セッションID, value: (seq, ペイロード) のリングバッファ
+        self._buffers: "OrderedDict[str, Deque[Tuple[int, str]]]" = OrderedDict()
+
+    def append(self, session_id: str, seq: int, payload: str):
+        """ブロードキャストしたペイロードを記録"""
+        if self.size <= 0:
+            return
+        buffer = self._buffers.get(session_id)
+        if buffer is None:
+            buffer = self._buffers[session_id] = deque(maxlen=self.size)
+            while len(self._buffers) > self.max_sessions:
+                self._buffers.popitem(last=False)
+        else:
+            self._buffers.move_to_end(session_id)
+
+        if not buffer or seq > buffer[-1][0]:
+            buffer.append((seq, payload))
+            return
+        # 複数ワーカーの書き込みは前後して届くことがあるため、seq 順の位置に入れる
+        index = len(buffer)
+        while index > 0 and buffer[index - 1][0] > seq:
+            index -= 1
+        if index > 0 and buffer[index - 1][0] == seq:
+            return
+        if index == 0 and len(buffer) == self.size:
+            # 保持している範囲より古い
+            return
+        if len(buffer) == self.size:
+            buffer.popleft()
+            index -= 1
+        buffer.insert(index, (seq, payload))
+
+    def since(self, session_id: str, last_seq: int) -> Optional[List[str]]:
+        """last_seq より後のペイロードを seq 順に返す（バッファが last_seq の直後から保持していなければ None）"""
+        buffer = self._buffers.get(session_id)
+        if not buffer or buffer[0][0] > last_seq + 1:
+            return None
+        return [payload for seq, payload in buffer if seq > last_seq]
+
+    def discard(self, session_id: str):
+        """セッションのバッファを削除"""
+        self._buffers.pop(session_id, None)
+
+    def metrics(self) -> dict:
+        """保持しているセッション数とペイロード数"""
+        return {
+            "sessions": len(self._buffers),
+            "frames": sum(len(buffer) for buffer in self._buffers.values()),
+            "size": self.size
+        }
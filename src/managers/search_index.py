@@ -0,0 +1,345 @@
+import bisect
+import math
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+from pathlib import Path
+from .. import codec
+from ..fileio import atomic_write
+from .message_log import MessageLog
+from .session_locks import SessionLocks
+
+# ひらがな・カタカナ・漢字（CJK統合漢字）・半角カタカナ・全角の長音記号
+_CJK = "ぁ-ゟ゠-ヿ㐀-䶿一-鿿豈-﫿ｦ-ﾟ"
+_TOKEN_RE = re.compile(rf"[{_CJK}]+|[^\W{_CJK}]+")
+_CJK_RE = re.compile(rf"[{_CJK}]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """検索用のトークンに分割
+
+    英数字などは単語単位、日本語（かな・漢字）は区切りがないため2文字ずつ（bi-gram）に分割する。
+    1文字だけの日本語の並びはそのまま1トークンとする。
+    """
+    tokens = []
+    for run in _TOKEN_RE.findall(text.lower()):
+        if _CJK_RE.fullmatch(run) and len(run) > 1:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+class SearchIndex:
+    """メッセージ本文の転置インデックス（セッションごと）
+
+    トークンごとに {メッセージ番号(seq): 出現回数} を保持し、保存時に差分で更新する。
+    インデックスは index_dir/<session_id>.json（スナップショット）と <session_id>.delta（追加分）に保存し、
+    ログより古ければ差分を読み込んで追いつかせる。
+    保存時は前回から追加したレコードのトークンだけを .delta に追記し、.delta が大きくなったら
+    ファイルからスナップショットを作り直す（コンパクション。メモリ上のインデックスはロックしない）。
+    ロックはセッションごとに持つため、あるセッションの保存や読み込みが他のセッションの追加を待たせない。
+    メモリには最近使ったセッションのインデックスだけを保持する。
+    """
+
+    MAX_CACHED_SESSIONS = 32
+    # .delta のレコード数がスナップショットのレコード数（最低でもこの数）を超えたらコンパクションする
+    COMPACT_MIN_RECORDS = 1000
+
+    def __init__(self, index_dir: Path, log: MessageLog):
+        self.index_dir = Path(index_dir)
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        self.log = log
+        self._indexes: "OrderedDict[str, Dict]" = OrderedDict()
+        # インデックスの読み書きはセッションごとのロックの中で行う
+        self._session_locks = SessionLocks()
+        # _indexes の出し入れだけを排他する
+        self._lock = threading.Lock()
+
+    def _index_path(self, session_id: str) -> Path:
+        return self.index_dir / f"{session_id}.json"
+
+    def _delta_path(self, session_id: str) -> Path:
+        return self.index_dir / f"{session_id}.delta"
+
+    @staticmethod
+    def _empty_index() -> Dict:
+        # base_records / delta_records: ファイルのスナップショットと .delta のレコード数
+        # pending: まだ .delta に書き出していない [seq, {トークン: 出現回数}]
+        # terms: 前方一致の検索に使うトークンのソート済みリスト（最初の検索で作る）
+        return {"records": 0, "postings": {}, "base_records": 0, "delta_records": 0, "pending": [],
+                "terms": None}
+
+    @staticmethod
+    def _apply(index: Dict, seq: int, counts: Dict[str, int]):
+        index["records"] = seq
+        postings = index["postings"]
+        terms = index["terms"]
+        for token, count in counts.items():
+            entries = postings.get(token)
+            if entries is None:
+                entries = postings[token] = {}
+                if terms is not None:
+                    bisect.insort(terms, token)
+            entries[seq] = count
+
+    def _add_record(self, index: Dict, seq: int, record: Dict):
+        """1レコード分のトークンを追加"""
+        counts: Dict[str, int] = {}
+        for token in tokenize(record.get("content", "")):
+            counts[token] = counts.get(token, 0) + 1
+        self._apply(index, seq, counts)
+        index["pending"].append([seq, counts])
+
+    def _get(self, session_id: str) -> Dict:
+        """インデックスを取得（ログに追いついていなければ差分を追加、セッションのロックの中で呼ぶ）"""
+        with self._lock:
+            index = self._indexes.get(session_id)
+            if index is not None:
+                self._indexes.move_to_end(session_id)
+        if index is None:
+            index = self._read(session_id)
+            with self._lock:
+                self._indexes[session_id] = index
+            self._evict()
+
+        record_count = self.log.count(session_id)
+        if index["records"] > record_count:
+            # ログが置き換えられた場合は作り直す
+            index = self._reset(session_id)
+        if index["records"] < record_count:
+            records = self.log.read_range(session_id, index["records"], record_count)
+            for seq, record in enumerate(records, start=index["records"] + 1):
+                self._add_record(index, seq, record)
+        return index
+
+    def _reset(self, session_id: str) -> Dict:
+        """保存済みのインデックスを削除して空のインデックスにする"""
+        self._index_path(session_id).unlink(missing_ok=True)
+        self._delta_path(session_id).unlink(missing_ok=True)
+        index = self._empty_index()
+        with self._lock:
+            self._indexes[session_id] = index
+        return index
+
+    def _read(self, session_id: str, delta_size: Optional[int] = None) -> Dict:
+        """スナップショットと .delta（delta_size バイトまで）からインデックスを読み込む"""
+        index = self._empty_index()
+        index_file = self._index_path(session_id)
+        if index_file.exists():
+            try:
+                with open(index_file, 'rb') as f:
+                    data = codec.loads(f.read())
+                index["records"] = index["base_records"] = data["records"]
+                index["postings"] = {
+                    token: {seq: count for seq, count in entries}
+                    for token, entries in data["postings"].items()
+                }
+            except (codec.JSONDecodeError, OSError) as e:
+                print(f"Error loading search index {index_file}: {e}")
+        try:
+            with open(self._delta_path(session_id), 'rb') as f:
+                delta = f.read() if delta_size is None else f.read(delta_size)
+        except FileNotFoundError:
+            delta = b""
+        for line in delta.splitlines():
+            try:
+                seq, counts = codec.loads(line)
+            except (codec.JSONDecodeError, TypeError, ValueError):
+                # 書き込み途中の行より後はログから追いつかせる
+                break
+            index["delta_records"] += 1
+            # スナップショットに含まれる分や、他のワーカーと重複して書いた分は飛ばす
+            if seq == index["records"] + 1:
+                self._apply(index, seq, counts)
+        return index
+
+    def _evict(self):
+        """最近使っていないセッションのインデックスをメモリから外す（追加分は .delta に書き出す）"""
+        with self._lock:
+            victims = list(self._indexes)[:max(0, len(self._indexes) - self.MAX_CACHED_SESSIONS)]
+        for session_id in victims:
+            lock = self._session_locks(session_id)
+            if not lock.acquire(blocking=False):
+                # 他のスレッドが使用中のものは外さない
+                continue
+            try:
+                with self._lock:
+                    index = self._indexes.pop(session_id, None)
+                if index is not None and index["pending"]:
+                    self._write_pending(session_id, index)
+            finally:
+                lock.release()
+
+    @staticmethod
+    def _serialize(index: Dict) -> bytes:
+        return codec.dumps({
+            "records": index["records"],
+            "postings": {
+                token: [[seq, count] for seq, count in entries.items()]
+                for token, entries in index["postings"].items()
+            }
+        })
+
+    def _write_pending(self, session_id: str, index: Dict):
+        """まだ保存していない追加分を .delta に追記（セッションのロックの中で呼ぶ）"""
+        pending, index["pending"] = index["pending"], []
+        # ログから作り直せるため fsync はしない
+        with open(self._delta_path(session_id), 'ab') as f:
+            f.write(b"".join(codec.dumps(entry) + b"\n" for entry in pending))
+        index["delta_records"] += len(pending)
+
+    def _compact(self, session_id: str):
+        """スナップショットと .delta から新しいスナップショットを作り、.delta を空にする
+
+        読み込みと書き出しはファイルだけを使ってロックの外で行う。読み込みでは seq がスナップショットより
+        前の .delta の行を飛ばすため、スナップショットを置き換えた時点でも内容は正しい。
+        """
+        lock = self._session_locks(session_id)
+        delta_file = self._delta_path(session_id)
+        with lock:
+            try:
+                size = delta_file.stat().st_size
+            except FileNotFoundError:
+                return
+        index = self._read(session_id, delta_size=size)
+        atomic_write(self._index_path(session_id), self._serialize(index), fsync=False)
+        with lock:
+            # コンパクションの間に追記された分だけを残す
+            try:
+                with open(delta_file, 'rb') as f:
+                    f.seek(size)
+                    rest = f.read()
+            except FileNotFoundError:
+                return
+            atomic_write(delta_file, rest, fsync=False)
+            with self._lock:
+                cached = self._indexes.get(session_id)
+            if cached is not None:
+                cached["base_records"] = index["records"]
+                cached["delta_records"] = rest.count(b"\n")
+
+    def add(self, session_id: str, start_seq: int, records: List[Dict]):
+        """追記したレコードをインデックスに追加（start_seq は先頭レコードの番号）"""
+        with self._session_locks(session_id):
+            # 読み込み時にログから追いついた分は _get で追加済み
+            index = self._get(session_id)
+            for seq, record in enumerate(records, start=start_seq):
+                if seq == index["records"] + 1:
+                    self._add_record(index, seq, record)
+
+    def catch_up(self, session_id: str):
+        """ログに追記された分（他のプロセスの書き込みを含む）をインデックスに追加"""
+        with self._session_locks(session_id):
+            self._get(session_id)
+
+    def search(self, session_id: str, query: str) -> List[Tuple[float, int]]:
+        """クエリを含むメッセージの (スコア, seq) をスコアの高い順に取得
+
+        スコアはクエリのトークンごとの出現回数 × IDF の合計。
+        インデックスで候補を絞り込み、クエリ全体を部分文字列として含むかは本文で確認する。
+        """
+        tokens = list(dict.fromkeys(tokenize(query)))
+        keyword = query.lower()
+        if not keyword.strip():
+            return []
+        if not tokens:
+            # 記号だけのクエリはインデックスを使えないので全件を確認
+            return [
+                (1.0, seq) for seq, record in enumerate(self.log.iter_records(session_id), start=1)
+                if keyword in record.get("content", "").lower()
+            ]
+
+        with self._session_locks(session_id):
+            index = self._get(session_id)
+            total = index["records"]
+            postings = index["postings"]
+            scores: Optional[Dict[int, float]] = None
+            for token in tokens:
+                # クエリのトークンで始まる語もヒットさせる（"hel" → "hello"）
+                token_counts: Dict[int, int] = {}
+                for term in self._matching_terms(index, token):
+                    for seq, count in postings[term].items():
+                        token_counts[seq] = token_counts.get(seq, 0) + count
+                if not token_counts:
+                    return []
+                idf = math.log((total + 1) / (len(token_counts) + 1)) + 1
+                if scores is None:
+                    scores = {seq: count * idf for seq, count in token_counts.items()}
+                else:
+                    scores = {
+                        seq: score + token_counts[seq] * idf
+                        for seq, score in scores.items() if seq in token_counts
+                    }
+                if not scores:
+                    return []
+
+        # クエリが1トークンそのものなら候補はすべて一致。それ以外は本文で確認する
+        if len(tokens) > 1 or tokens[0] != keyword:
+            matched = set(self._verify(session_id, sorted(scores), keyword))
+            scores = {seq: score for seq, score in scores.items() if seq in matched}
+        return sorted(((score, seq) for seq, score in scores.items()), reverse=True)
+
+    @staticmethod
+    def _matching_terms(index: Dict, token: str) -> Iterable[str]:
+        """クエリのトークンに一致する語（セッションのロックの中で呼ぶ）
+
+        日本語のbi-gramは完全一致、それ以外はソート済みのトークンを二分探索して前方一致で探す。
+        語の途中に含まれるだけの語（"ell" → "hello"）はヒットしない。
+        日本語1文字のクエリは語の2文字目にも一致させる必要があるため、全トークンを走査する
+        （トークン数に比例して時間がかかる）。
+        """
+        postings = index["postings"]
+        if _CJK_RE.fullmatch(token):
+            if len(token) == 2:
+                return [token] if token in postings else []
+            return [term for term in postings if token in term]
+        terms = index["terms"]
+        if terms is None:
+            terms = index["terms"] = sorted(postings)
+        matched = []
+        for i in range(bisect.bisect_left(terms, token), len(terms)):
+            if not terms[i].startswith(token):
+                break
+            matched.append(terms[i])
+        return matched
+
+    def _verify(self, session_id: str, seqs: List[int], keyword: str) -> Iterable[int]:
+        """候補のうち本文にクエリを含むものの seq を返す（近い候補はまとめて読み込む）"""
+        i = 0
+        while i < len(seqs):
+            j = i
+            while j + 1 < len(seqs) and seqs[j + 1] - seqs[j] <= 16:
+                j += 1
+            records = self.log.read_range(session_id, seqs[i] - 1, seqs[j])
+            wanted = set(seqs[i:j + 1])
+            for seq, record in enumerate(records, start=seqs[i]):
+                if seq in wanted and keyword in record.get("content", "").lower():
+                    yield seq
+            i = j + 1
+
+    def delete(self, session_id: str):
+        """セッションのインデックスを削除"""
+        with self._session_locks(session_id):
+            with self._lock:
+                self._indexes.pop(session_id, None)
+            self._index_path(session_id).unlink(missing_ok=True)
+            self._delta_path(session_id).unlink(missing_ok=True)
+
+    def save(self):
+        """追加分を .delta に保存し、大きくなった .delta をスナップショットにまとめる"""
+        with self._lock:
+            session_ids = [session_id for session_id, index in self._indexes.items() if index["pending"]]
+        compact = []
+        for session_id in session_ids:
+            with self._session_locks(session_id):
+                with self._lock:
+                    index = self._indexes.get(session_id)
+                if index is None or not index["pending"]:
+                    continue
+                self._write_pending(session_id, index)
+                if index["delta_records"] > max(index["base_records"], self.COMPACT_MIN_RECORDS):
+                    compact.append(session_id)
+        for session_id in compact:
+            self._compact(session_id)
@@ -0,0 +1,131 @@
+import json
+from bisect import bisect_left, insort
+from typing import Dict, List, Optional, Tuple
+from pathlib import Path
+from ..models.session import Session
+from ..fileio import AtomicWriter
+
+
+class SessionCatalog:
+    """セッション一覧のインデックス
+
+    セッションごとの概要（作成日時・状態・件数）を1ファイルにまとめて保持し、
+    一覧表示や状態での絞り込みをセッションファイルを読まずに行う。
+    """
+
+    def __init__(self, catalog_file: Path, writer: Optional[AtomicWriter] = None):
+        self.catalog_file = Path(catalog_file)
+        self.writer = writer or AtomicWriter("always")
+        self.entries: Dict[str, dict] = {}
+        # 作成日時の昇順に並べた (created_at, session_id)。None は全件、それ以外は状態ごと
+        self._ordered: Dict[Optional[str], List[Tuple[str, str]]] = {None: []}
+        self._changed = False
+        # 最後に読み書きした時点のファイルの状態（他のプロセスによる更新の検出用）
+        self._file_state: Optional[Tuple[int, int, int]] = None
+
+    def _stat(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            stat = self.catalog_file.stat()
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    @staticmethod
+    def entry_from_session(session: Session) -> dict:
+        """セッションからカタログのエントリを作成"""
+        return {
+            "session_id": session.session_id,
+            "created_at": session.created_at,
+            "ended_at": session.ended_at,
+            "status": session.status,
+            "participant_count": len(session.participants),
+            "total_messages": session.total_messages,
+        }
+
+    def load(self) -> bool:
+        """カタログをファイルから読み込む（存在しない・壊れている場合はFalse）"""
+        if not self.catalog_file.exists():
+            return False
+        file_state = self._stat()
+        try:
+            with open(self.catalog_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"Error loading session catalog {self.catalog_file}: {e}")
+            return False
+        self.entries = {}
+        self._ordered = {None: []}
+        for entry in data.get("sessions", []):
+            self._insert(entry)
+        self._changed = False
+        self._file_state = file_state
+        return True
+
+    def refresh(self) -> bool:
+        """他のプロセスがファイルを更新していれば読み直す（読み直した場合はTrue）"""
+        file_state = self._stat()
+        if file_state is None or file_state == self._file_state:
+            return False
+        return self.load()
+
+    def rebuild(self, sessions: List[Session]):
+        """セッションの一覧からカタログを作り直す"""
+        self.entries = {}
+        self._ordered = {None: []}
+        for session in sessions:
+            self._insert(self.entry_from_session(session))
+        self._changed = True
+
+    def save(self):
+        """変更があればカタログをファイルに保存"""
+        if not self._changed:
+            return
+        data = {"sessions": [self.entries[sid] for _, sid in self._ordered[None]]}
+        self.writer.write(self.catalog_file, json.dumps(data, ensure_ascii=False))
+        self._changed = False
+        self._file_state = self._stat()
+
+    def upsert(self, session: Session):
+        """セッションのエントリを追加・更新"""
+        entry = self.entry_from_session(session)
+        if self.entries.get(session.session_id) == entry:
+            return
+        self.remove(session.session_id)
+        self._insert(entry)
+        self._changed = True
+
+    def remove(self, session_id: str):
+        """セッションのエントリを削除"""
+        entry = self.entries.pop(session_id, None)
+        if entry is None:
+            return
+        key = (entry["created_at"], session_id)
+        for status in (None, entry["status"]):
+            ordered = self._ordered.get(status, [])
+            index = bisect_left(ordered, key)
+            if index < len(ordered) and ordered[index] == key:
+                del ordered[index]
+        self._changed = True
+
+    def list(self, status: Optional[str] = None) -> List[dict]:
+        """エントリを作成日時の降順で取得（statusで絞り込み可能）"""
+        ordered = self._ordered.get(status, [])
+        return [self.entries[sid] for _, sid in reversed(ordered)]
+
+    def session_ids(self, status: Optional[str] = None) -> List[str]:
+        """セッションIDを作成日時の降順で取得（statusで絞り込み可能）"""
+        return [sid for _, sid in reversed(self._ordered.get(status, []))]
+
+    def get(self, session_id: str) -> Optional[dict]:
+        """セッションのエントリを取得"""
+        return self.entries.get(session_id)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _insert(self, entry: dict):
+        session_id = entry["session_id"]
+        self.entries[session_id] = entry
+        key = (entry["created_at"], session_id)
+        insort(self._ordered[None], key)
+        insort(self._ordered.setdefault(entry["status"], []), key)
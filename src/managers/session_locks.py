@@ -0,0 +1,22 @@
+import threading
+from typing import Dict
+
+
+class SessionLocks:
+    """セッションIDごとの再入可能なロック
+
+    ストアの状態をセッション単位で排他し、あるセッションの書き込み（fsync など）が
+    他のセッションの操作を待たせないようにする。
+    """
+
+    def __init__(self):
+        self._locks: Dict[str, threading.RLock] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, session_id: str) -> threading.RLock:
+        """セッションのロックを取得（with で使う）"""
+        with self._lock:
+            lock = self._locks.get(session_id)
+            if lock is None:
+                lock = self._locks[session_id] = threading.RLock()
+            return lock
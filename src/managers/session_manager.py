@@ -1,136 +1,448 @@
 import os
 import json
+import threading
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Optional, List, Dict
+from typing import Callable, Optional, List, Dict, Set
 from pathlib import Path
 from ..models.session import Session
+from ..metrics import timed
+from ..fileio import AtomicWriter
+from .session_catalog import SessionCatalog
+
+try:
+    import fcntl
+except ImportError:  # Windows: 複数ワーカーでの共有には対応しない
+    fcntl = None
 
 
 class SessionManager:
-    """セッション管理クラス"""
+    """セッション管理クラス
+    
+    shared=True の場合は複数のワーカー（プロセス）で同じ保存先を共有する前提で動作する。
+    変更はファイルロックの中で最新の内容を読み直してからすぐに保存し、
+    頻繁に発生するメッセージ数の加算だけを差分として溜めて flush 時に反映する。
+    セッションファイルとカタログは一時ファイル経由で置き換え、fsync_policy が batch の場合は
+    flush でまとめて書き出すファイルの fsync を1回の置き換えにまとめる。
+    メモリ上の変更と一時ファイルへの書き出しだけを self._lock の中で行い、fsync と置き換えは
+    ロックの外で行うため、書き出しの間も読み込みや参加者・メッセージ数の更新を待たせない。
+    起動時は状態のスナップショット（現在のセッションID）から現在のセッションだけを読み込み、
+    カタログは最初に使うときに読み込む。
+    on_session_ended はセッションを終了したときに（ロックを離してから、呼び出したスレッドで）呼ばれる。
+    """
     
-    def __init__(self, data_dir: str = "data/sessions"):
+    def __init__(self, data_dir: str = "data/sessions", shared: bool = False,
+                 fsync_policy: str = "batch",
+                 on_session_ended: Optional[Callable[[Session], None]] = None):
         self.data_dir = Path(data_dir)
         self.data_dir.mkdir(parents=True, exist_ok=True)
+        self.shared = shared
+        self.on_session_ended = on_session_ended
+        self.writer = AtomicWriter(fsync_policy)
         self.current_session: Optional[Session] = None
+        # メモリ上のセッション（ディスクより優先される正本、共有時は使わない）
+        self._cache: Dict[str, Session] = {}
+        # ディスクへの書き出しが済んでいないセッションID
+        self._dirty: Set[str] = set()
+        # 共有時に未反映のメッセージ数の加算分
+        self._pending_counts: Dict[str, int] = {}
+        # キャッシュとカタログは複数スレッドから更新される
+        self._lock = threading.RLock()
+        # ファイルを置き換える順序を保つ（self._lock より先に取る）
+        self._write_lock = threading.RLock()
+        # ファイルロックを持っているか（スレッドごと。入れ子で取らないため）
+        self._storage_held = threading.local()
+        # セッション一覧のインデックス（一覧・絞り込み用、最初に使うときに読み込む）
+        self._catalog: Optional[SessionCatalog] = None
+        # 現在のセッションIDのスナップショット（再起動時に現在のセッションを復元する）
+        self.state_file = self.data_dir / "_state.json"
+        self._current_restored = self._restore_current_session()
+    
+    @property
+    def catalog(self) -> SessionCatalog:
+        """セッション一覧のインデックス（最初に使うときに読み込み、なければ全セッションを走査して作る）"""
+        catalog = self._catalog
+        if catalog is None:
+            with self._lock:
+                if self._catalog is None:
+                    catalog = self._create_catalog()
+                    with self._storage_lock():
+                        if not catalog.load():
+                            self._build_catalog(catalog)
+                    self._catalog = catalog
+                catalog = self._catalog
+        return catalog
+    
+    def load_catalog(self) -> int:
+        """セッション一覧のインデックスを読み込み（なければ全セッションを走査して作り）、セッション数を返す
+
+        起動時にバックグラウンドで呼び、最初の一覧表示を待たせないようにする。
+        """
+        return len(self.catalog)
+    
+    @contextmanager
+    def _storage_lock(self):
+        """共有時に他のワーカーと排他するためのファイルロック（self._lock の中で使い、入れ子にできる）"""
+        if not self.shared or fcntl is None or getattr(self._storage_held, "value", False):
+            # 同じスレッドで既にロックを持っていればそのまま使う（他のスレッドは flock で待つ）
+            yield
+            return
+        with open(self.data_dir / ".lock", 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            self._storage_held.value = True
+            try:
+                yield
+            finally:
+                self._storage_held.value = False
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    
+    @contextmanager
+    def _writing(self):
+        """中で書き込んだセッション・カタログを、抜けるときに self._lock の外でまとめて置き換える
+        
+        共有時はファイルロックの中で置き換える必要があるため、書き込んだときにすぐ置き換える。
+        """
+        if self.shared:
+            yield
+            return
+        with self._write_lock, self.writer.batch():
+            yield
     
+    def _restore_current_session(self) -> bool:
+        """スナップショットから現在のセッションを復元（スナップショットがなければ False）"""
+        state = self._read_state()
+        if state is None:
+            return False
+        session_id = state.get("current_session_id")
+        if session_id:
+            try:
+                session = self.load_session(session_id)
+            except Exception as e:
+                print(f"Error restoring current session {session_id}: {e}")
+                session = None
+            if session is not None and session.status == "active":
+                self.current_session = session
+        return True
+    
+    def _set_current_session(self, session: Optional[Session]):
+        """現在のセッションを変更してスナップショットに保存"""
+        self.current_session = session
+        self._current_restored = True
+        try:
+            self._write_state({"current_session_id": session.session_id if session else None})
+        except OSError as e:
+            print(f"Error saving session state: {e}")
+    
+    @timed("session_manager")
     def create_session(self, session_id: Optional[str] = None, password: Optional[str] = None, 
                       require_user_password: bool = False, disable_user_password: bool = False) -> Session:
         """新しいセッションを作成"""
-        if session_id is None:
-            # タイムスタンプベースのセッションID生成
-            session_id = f"session_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        
-        session = Session(
-            session_id=session_id, 
-            require_user_password=require_user_password,
-            disable_user_password=disable_user_password
-        )
-        
-        # パスワードが指定されている場合は設定
-        if password:
-            session.set_password(password)
-        
-        self.current_session = session
-        self._save_session(session)
-        return session
+        with self._writing(), self._lock:
+            if session_id is None:
+                # タイムスタンプベースのセッションID生成
+                session_id = f"session_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            
+            session = Session(
+                session_id=session_id, 
+                require_user_password=require_user_password,
+                disable_user_password=disable_user_password
+            )
+            
+            # パスワードが指定されている場合は設定
+            if password:
+                session.set_password(password)
+            
+            if not self.shared:
+                self._cache[session.session_id] = session
+            with self._storage_lock():
+                self._refresh_catalog()
+                self._save_session(session)
+                self.catalog.save()
+                self._set_current_session(session)
+            return session
     
     def get_current_session(self) -> Optional[Session]:
         """現在のアクティブなセッションを取得"""
-        return self.current_session
+        if self.shared:
+            # 他のワーカーで作成・終了された場合もあるので、最新のアクティブなセッションを使う
+            with self._lock:
+                self._refresh_catalog()
+                session_ids = self.catalog.session_ids("active")
+                return self.load_session(session_ids[0]) if session_ids else None
+        with self._lock:
+            if not self._current_restored:
+                # スナップショットがない（以前のバージョンで保存した）場合は最新のアクティブなセッションを使う
+                self._current_restored = True
+                session_ids = self.catalog.session_ids("active")
+                if session_ids:
+                    self.current_session = self.load_session(session_ids[0])
+            return self.current_session
     
+    @timed("session_manager")
     def load_session(self, session_id: str) -> Optional[Session]:
         """指定されたセッションをロード"""
-        session_file = self.data_dir / f"{session_id}.json"
-        if not session_file.exists():
-            return None
-        
-        with open(session_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            return Session.from_dict(data)
+        with self._lock:
+            if self.shared:
+                # 他のワーカーの変更を反映するため毎回読み込み、未反映の加算分を足す
+                session = self._read_session(session_id)
+                if session is not None and self._pending_counts.get(session_id):
+                    session.increment_message_count(self._pending_counts[session_id])
+                return session
+            
+            session = self._cache.get(session_id)
+            if session is not None:
+                return session
+            
+            session = self._read_session(session_id)
+            if session is not None:
+                self._cache[session_id] = session
+            return session
     
-    def get_all_sessions(self) -> List[Session]:
-        """全てのセッションを取得"""
-        sessions = []
-        for session_file in self.data_dir.glob("*.json"):
-            try:
-                with open(session_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    sessions.append(Session.from_dict(data))
-            except Exception as e:
-                print(f"Error loading session {session_file}: {e}")
-        
-        # 作成日時の降順でソート
-        sessions.sort(key=lambda s: s.created_at, reverse=True)
-        return sessions
+    @timed("session_manager")
+    def get_all_sessions(self, status: Optional[str] = None) -> List[Session]:
+        """全てのセッションを作成日時の降順で取得（statusで絞り込み可能）"""
+        with self._lock:
+            self._refresh_catalog()
+            sessions = []
+            for session_id in self.catalog.session_ids(status):
+                try:
+                    session = self.load_session(session_id)
+                    if session:
+                        sessions.append(session)
+                except Exception as e:
+                    print(f"Error loading session {session_id}: {e}")
+            return sessions
     
     def get_active_sessions(self) -> List[Session]:
         """アクティブなセッションのみを取得"""
-        return [s for s in self.get_all_sessions() if s.status == "active"]
+        return self.get_all_sessions(status="active")
+    
+    @timed("session_manager")
+    def list_session_entries(self, status: Optional[str] = None) -> List[Dict]:
+        """カタログ上のセッション概要を取得（セッションファイルは読まない）"""
+        with self._lock:
+            self._refresh_catalog()
+            return self.catalog.list(status)
     
+    def rebuild_catalog(self):
+        """保存済みのセッションを全て走査してカタログを作り直す"""
+        with self._lock:
+            self._build_catalog(self.catalog)
+    
+    def _build_catalog(self, catalog: SessionCatalog):
+        sessions = []
+        for session_id in self._scan_session_ids():
+            try:
+                session = self.load_session(session_id)
+                if session:
+                    sessions.append(session)
+            except Exception as e:
+                print(f"Error loading session {session_id}: {e}")
+        catalog.rebuild(sessions)
+        catalog.save()
+    
+    @timed("session_manager")
     def update_session(self, session: Session):
         """セッションを更新"""
-        self._save_session(session)
-    
-    def add_participant(self, session_id: str, client_id: str):
-        """セッションに参加者を追加"""
-        session = self.load_session(session_id)
-        if session:
-            session.add_participant(client_id)
-            self._save_session(session)
-            if self.current_session and self.current_session.session_id == session_id:
-                self.current_session = session
+        with self._writing(), self._lock:
+            if not self.shared:
+                self._cache[session.session_id] = session
+            with self._storage_lock():
+                self._refresh_catalog()
+                self._save_session(session)
+                self.catalog.save()
     
-    def remove_participant(self, session_id: str, client_id: str):
-        """セッションから参加者を削除"""
-        session = self.load_session(session_id)
-        if session:
-            session.remove_participant(client_id)
-            self._save_session(session)
-            if self.current_session and self.current_session.session_id == session_id:
-                self.current_session = session
+    def _modify(self, session_id: str, change, save: bool = False) -> Optional[Session]:
+        """セッションに変更を加える
+        
+        save=False の場合はメモリ上だけを変更し、ディスクへは次回のflushで反映する。
+        共有時は常にロックの中で読み直し、変更してすぐに保存する。
+        """
+        with self._lock:
+            if not self.shared:
+                session = self.load_session(session_id)
+                if session:
+                    change(session)
+                    if save:
+                        self._save_session(session)
+                        self.catalog.save()
+                    else:
+                        self._dirty.add(session_id)
+                return session
+            
+            with self._storage_lock():
+                self._refresh_catalog()
+                session = self._read_session(session_id)
+                if session:
+                    change(session)
+                    self._save_session(session)
+                    self.catalog.save()
+                return session
     
-    def increment_message_count(self, session_id: str):
-        """セッションのメッセージ数をインクリメント"""
-        session = self.load_session(session_id)
-        if session:
-            session.increment_message_count()
-            self._save_session(session)
-            if self.current_session and self.current_session.session_id == session_id:
-                self.current_session = session
+    @timed("session_manager")
+    def add_participant(self, session_id: str, client_id: str) -> Optional[Session]:
+        """セッションに参加者を追加（ディスクへは次回のflushで反映）"""
+        return self._modify(session_id, lambda session: session.add_participant(client_id))
+    
+    @timed("session_manager")
+    def remove_participant(self, session_id: str, client_id: str) -> Optional[Session]:
+        """セッションから参加者を削除（ディスクへは次回のflushで反映）"""
+        return self._modify(session_id, lambda session: session.remove_participant(client_id))
     
-    def end_session(self, session_id: str):
+    @timed("session_manager")
+    def increment_message_count(self, session_id: str, count: int = 1):
+        """セッションのメッセージ数をインクリメント（ディスクへは次回のflushで反映）"""
+        with self._lock:
+            if self.shared:
+                self._pending_counts[session_id] = self._pending_counts.get(session_id, 0) + count
+                self._dirty.add(session_id)
+                return
+            self._modify(session_id, lambda session: session.increment_message_count(count))
+    
+    @timed("session_manager")
+    def end_session(self, session_id: str) -> Optional[Session]:
         """セッションを終了"""
-        session = self.load_session(session_id)
-        if session:
-            session.end_session()
-            self._save_session(session)
-            if self.current_session and self.current_session.session_id == session_id:
-                self.current_session = None
+        with self._writing(), self._lock:
+            session = self._modify(session_id, lambda session: session.end_session(), save=True)
+            if session and self.current_session and self.current_session.session_id == session_id:
+                self._set_current_session(None)
+        if session and self.on_session_ended:
+            self.on_session_ended(session)
+        return session
     
+    @timed("session_manager")
     def get_session_summary(self, session_id: str) -> Optional[Dict]:
         """セッションのサマリーを取得"""
-        session = self.load_session(session_id)
-        if not session:
-            return None
+        with self._lock:
+            session = self.load_session(session_id)
+            if not session:
+                return None
         
-        return {
-            "session_id": session.session_id,
-            "created_at": session.created_at,
-            "ended_at": session.ended_at,
-            "status": session.status,
-            "participant_count": len(session.participants),
-            "participants": session.participants,
-            "total_messages": session.total_messages,
-            "duration": self._calculate_duration(session),
-            "metadata": session.metadata.model_dump()
-        }
+            return {
+                "session_id": session.session_id,
+                "created_at": session.created_at,
+                "ended_at": session.ended_at,
+                "status": session.status,
+                "participant_count": len(session.participants),
+                "participants": session.participants,
+                "total_messages": session.total_messages,
+                "duration": self._calculate_duration(session),
+                "metadata": session.metadata.model_dump()
+            }
+    
+    @timed("session_manager")
+    def flush(self) -> int:
+        """未保存のセッションをまとめてディスクに書き出す"""
+        if self.shared:
+            with self._lock:
+                return self._flush_pending_counts()
+        with self._write_lock:
+            with self._lock:
+                dirty = set(self._dirty)
+            flushed = 0
+            try:
+                with self.writer.batch():
+                    with self._lock:
+                        for session_id in dirty:
+                            session = self._cache.get(session_id)
+                            if session:
+                                self._save_session(session)
+                                flushed += 1
+                            else:
+                                self._dirty.discard(session_id)
+                        if flushed:
+                            self.catalog.save()
+                    # fsync と置き換えは self._lock を離してから行う
+            except Exception:
+                # 置き換えられなかったセッションは次回書き出す
+                with self._lock:
+                    self._dirty.update(session_id for session_id in dirty if session_id in self._cache)
+                raise
+            return flushed
+    
+    def _flush_pending_counts(self) -> int:
+        """共有時: 溜めたメッセージ数の加算分を最新のセッションに反映して保存"""
+        if not self._pending_counts:
+            return 0
+        pending, self._pending_counts = self._pending_counts, {}
+        self._dirty.clear()
+        flushed = 0
+        with self._storage_lock():
+            self._refresh_catalog()
+            for session_id, count in pending.items():
+                session = self._read_session(session_id)
+                if session:
+                    session.increment_message_count(count)
+                    self._save_session(session)
+                    flushed += 1
+            if flushed:
+                self.catalog.save()
+        return flushed
+    
+    def close(self):
+        """未保存のセッションを書き出して終了"""
+        self.flush()
+    
+    def _refresh_catalog(self):
+        """共有時: 他のワーカーがカタログを更新していれば読み直す"""
+        if self.shared:
+            self.catalog.refresh()
     
     def _save_session(self, session: Session):
-        """セッションをファイルに保存"""
-        session_file = self.data_dir / f"{session.session_id}.json"
-        with open(session_file, 'w', encoding='utf-8') as f:
-            f.write(session.to_json())
+        """セッションを保存してカタログに反映"""
+        self._write_session(session)
+        self._dirty.discard(session.session_id)
+        self.catalog.upsert(session)
+    
+    # ---- 保存先ごとに差し替える部分（既定はセッションごとのJSONファイル） ----
+    
+    def _create_catalog(self) -> SessionCatalog:
+        """セッション一覧のインデックスを作成"""
+        return SessionCatalog(self.data_dir / "_catalog.json", writer=self.writer)
+    
+    def _read_state(self) -> Optional[Dict]:
+        """状態のスナップショットを読み込む（なければ None）"""
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except json.JSONDecodeError as e:
+            print(f"Ignoring corrupt session state {self.state_file}: {e}")
+            return None
+    
+    def _write_state(self, state: Dict):
+        """状態のスナップショットを保存"""
+        self.writer.write(self.state_file, json.dumps(state))
+    
+    def _read_session(self, session_id: str) -> Optional[Session]:
+        """セッションをファイルから読み込む"""
+        session_file = self.data_dir / f"{session_id}.json"
+        if not session_file.exists():
+            return None
+        
+        with open(session_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+            return Session.from_dict(data)
+    
+    def _write_session(self, session: Session):
+        """セッションをファイルに保存（一時ファイルに書いてから置き換える）"""
+        self.writer.write(self.data_dir / f"{session.session_id}.json", session.to_json())
+    
+    def _delete_session_data(self, session_id: str) -> bool:
+        """セッションファイルを削除"""
+        session_file = self.data_dir / f"{session_id}.json"
+        if session_file.exists():
+            os.remove(session_file)
+            return True
+        return False
+    
+    def _scan_session_ids(self) -> List[str]:
+        """保存済みの全セッションID（カタログの再構築用）"""
+        return [
+            session_file.stem for session_file in self.data_dir.glob("*.json")
+            if not session_file.name.startswith("_")
+        ]
     
     def _calculate_duration(self, session: Session) -> Optional[str]:
         """セッションの継続時間を計算"""
@@ -150,11 +462,20 @@ class SessionManager:
         except Exception:
             return None
     
+    @timed("session_manager")
     def delete_session(self, session_id: str) -> bool:
         """セッションを削除"""
-        session_file = self.data_dir / f"{session_id}.json"
-        if session_file.exists():
-            os.remove(session_file)
-            return True
-        return False
+        with self._writing(), self._lock:
+            self._cache.pop(session_id, None)
+            self._dirty.discard(session_id)
+            if self.current_session and self.current_session.session_id == session_id:
+                self._set_current_session(None)
+            self._pending_counts.pop(session_id, None)
+        
+            with self._storage_lock():
+                self._refresh_catalog()
+                deleted = self._delete_session_data(session_id)
+                self.catalog.remove(session_id)
+                self.catalog.save()
+            return deleted
 
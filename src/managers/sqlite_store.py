@@ -0,0 +1,335 @@
+import json
+import sqlite3
+import threading
+from itertools import islice
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+from pathlib import Path
+from .. import codec
+from ..models.session import Session
+from .message_log import MessageLog
+from .session_catalog import SessionCatalog
+from .session_manager import SessionManager
+
+
+def connect(db_path: Path) -> sqlite3.Connection:
+    """WALモードでSQLiteデータベースに接続"""
+    db_path = Path(db_path)
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(db_path), check_same_thread=False, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+class SQLiteMessageLog(MessageLog):
+    """SQLiteのテーブルに保存するメッセージログ
+
+    (session_id, seq) を主キーとし、(session_id, timestamp) と (session_id, client_id) に
+    インデックスを張る。seq はセッション内の保存順で1から始まる。
+    """
+
+    CHUNK_SIZE = 1000
+
+    def __init__(self, db_path: Path, fsync_policy: str = "interval", fsync_interval: float = 1.0):
+        self.db_path = Path(db_path)
+        self.data_dir = self.db_path.parent
+        self._lock = threading.RLock()
+        self._conn = connect(self.db_path)
+        # always のみ毎回ディスクまで同期する（WALのNORMALはプロセスが落ちてもデータを失わない）
+        synchronous = "FULL" if fsync_policy == "always" else "NORMAL"
+        self._conn.execute(f"PRAGMA synchronous={synchronous}")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                message_id TEXT,
+                client_id TEXT,
+                message_type TEXT,
+                timestamp TEXT,
+                record TEXT NOT NULL,
+                PRIMARY KEY (session_id, seq)
+            );
+            CREATE INDEX IF NOT EXISTS idx_messages_session_timestamp
+                ON messages (session_id, timestamp);
+            CREATE INDEX IF NOT EXISTS idx_messages_session_client
+                ON messages (session_id, client_id);
+        """)
+        self._conn.commit()
+
+    def path(self, session_id: str) -> Path:
+        """データベースファイルのパス"""
+        return self.db_path
+
+    def append(self, session_id: str, records: List[dict]) -> int:
+        """レコードを追記し、最初のレコードの番号（seq）を返す"""
+        if not records:
+            return self.count(session_id) + 1
+        with self._lock, self._conn:
+            # 他のプロセスと番号が重ならないよう、最大値の確認から書き込みまでを排他する
+            self._conn.execute("BEGIN IMMEDIATE")
+            next_seq = self._max_seq(session_id) + 1
+            self._insert(session_id, next_seq, records)
+        return next_seq
+
+    def import_records(self, session_id: str, records: Iterable[dict]) -> bool:
+        """ログがない場合だけ records を1つのトランザクションで書き込む（途中で落ちても一部だけ残らない）"""
+        records = iter(records)
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            if self._max_seq(session_id):
+                return False
+            next_seq = 1
+            while True:
+                chunk = list(islice(records, self.CHUNK_SIZE))
+                if not chunk:
+                    break
+                self._insert(session_id, next_seq, chunk)
+                next_seq += len(chunk)
+        return True
+
+    def _insert(self, session_id: str, first_seq: int, records: List[dict]):
+        self._conn.executemany(
+            "INSERT INTO messages (session_id, seq, message_id, client_id, message_type, timestamp, record)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (session_id, seq, record.get("message_id"), record.get("client_id"),
+                 record.get("message_type"), record.get("timestamp"),
+                 codec.dumps(record).decode("utf-8"))
+                for seq, record in enumerate(records, start=first_seq)
+            ]
+        )
+
+    def iter_records(self, session_id: str) -> Iterator[dict]:
+        """レコードを保存順に返す（一定件数ずつ読み込む）"""
+        start = 0
+        while True:
+            records = self.read_range(session_id, start, start + self.CHUNK_SIZE)
+            yield from records
+            if len(records) < self.CHUNK_SIZE:
+                return
+            start += self.CHUNK_SIZE
+
+    def count(self, session_id: str) -> int:
+        """レコード数を取得"""
+        with self._lock:
+            return self._max_seq(session_id)
+
+    def read_range(self, session_id: str, start: int, stop: int) -> List[dict]:
+        """保存順で start 番目から stop 番目の手前までのレコードを取得（0始まり）"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT record FROM messages WHERE session_id = ? AND seq > ? AND seq <= ? ORDER BY seq",
+                (session_id, max(start, 0), max(stop, 0))
+            ).fetchall()
+        return [codec.loads(row["record"]) for row in rows]
+
+    def query(self, session_id: str, client_id: Optional[str] = None,
+              message_type: Optional[str] = None) -> List[dict]:
+        """インデックスを使って条件に合うレコードを取得"""
+        sql = "SELECT record FROM messages WHERE session_id = ?"
+        params: list = [session_id]
+        if client_id is not None:
+            sql += " AND client_id = ?"
+            params.append(client_id)
+        if message_type is not None:
+            sql += " AND message_type = ?"
+            params.append(message_type)
+        with self._lock:
+            rows = self._conn.execute(sql + " ORDER BY seq", params).fetchall()
+        return [codec.loads(row["record"]) for row in rows]
+
+    def exists(self, session_id: str) -> bool:
+        """ログが存在するか確認"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM messages WHERE session_id = ? LIMIT 1", (session_id,)
+            ).fetchone()
+        return row is not None
+
+    def delete(self, session_id: str) -> bool:
+        """ログを削除"""
+        with self._lock, self._conn:
+            cursor = self._conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+        return cursor.rowcount > 0
+
+    def remove_archived(self, session_id: str, count: int, commit: Callable[[], None]) -> bool:
+        """レコード数が count のままなら commit()（アーカイブの公開）を呼んでからログを削除する
+
+        件数の確認から削除までを1つのトランザクションで行い、他のプロセスの追記を待たせる。
+        """
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            if self._max_seq(session_id) != count:
+                return False
+            self._conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            commit()
+        return True
+
+    def session_ids(self) -> List[str]:
+        """ログが存在するセッションIDの一覧"""
+        with self._lock:
+            rows = self._conn.execute("SELECT DISTINCT session_id FROM messages").fetchall()
+        return [row["session_id"] for row in rows]
+
+    def close(self):
+        """データベースを閉じる"""
+        with self._lock:
+            self._conn.close()
+
+    def _max_seq(self, session_id: str) -> int:
+        row = self._conn.execute(
+            "SELECT COALESCE(MAX(seq), 0) FROM messages WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return row[0]
+
+
+class SQLiteSessionCatalog(SessionCatalog):
+    """sessions テーブルの概要カラムをそのままセッション一覧のインデックスとして使う"""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self._conn = conn
+
+    def load(self) -> bool:
+        """テーブルが常に最新なので読み込みは不要"""
+        return True
+
+    def refresh(self) -> bool:
+        """テーブルが常に最新なので読み直しは不要"""
+        return False
+
+    def rebuild(self, sessions: List[Session]):
+        """セッションの一覧から概要カラムを更新（1つのトランザクションで行う）"""
+        with self._conn:
+            for session in sessions:
+                self._upsert(session)
+
+    def save(self):
+        """変更は1件ごとにトランザクションで確定しているため、残っているものがあれば確定するだけ"""
+        self._conn.commit()
+
+    def upsert(self, session: Session):
+        """セッションの概要を追加・更新"""
+        with self._conn:
+            self._upsert(session)
+
+    def _upsert(self, session: Session):
+        entry = self.entry_from_session(session)
+        self._conn.execute(
+            "INSERT INTO sessions (session_id, created_at, ended_at, status, participant_count, total_messages)"
+            " VALUES (:session_id, :created_at, :ended_at, :status, :participant_count, :total_messages)"
+            " ON CONFLICT (session_id) DO UPDATE SET created_at = excluded.created_at,"
+            " ended_at = excluded.ended_at, status = excluded.status,"
+            " participant_count = excluded.participant_count, total_messages = excluded.total_messages",
+            entry
+        )
+
+    def remove(self, session_id: str):
+        """セッションを削除"""
+        with self._conn:
+            self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def list(self, status: Optional[str] = None) -> List[dict]:
+        """概要を作成日時の降順で取得（statusで絞り込み可能）"""
+        columns = "session_id, created_at, ended_at, status, participant_count, total_messages"
+        if status is None:
+            rows = self._conn.execute(
+                f"SELECT {columns} FROM sessions ORDER BY created_at DESC, session_id DESC"
+            ).fetchall()
+        else:
+            rows = self._conn.execute(
+                f"SELECT {columns} FROM sessions WHERE status = ? ORDER BY created_at DESC, session_id DESC",
+                (status,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def session_ids(self, status: Optional[str] = None) -> List[str]:
+        """セッションIDを作成日時の降順で取得（statusで絞り込み可能）"""
+        return [entry["session_id"] for entry in self.list(status)]
+
+    def get(self, session_id: str) -> Optional[dict]:
+        """セッションの概要を取得"""
+        row = self._conn.execute(
+            "SELECT session_id, created_at, ended_at, status, participant_count, total_messages"
+            " FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+class SQLiteSessionManager(SessionManager):
+    """セッションをSQLiteに保存するセッション管理クラス"""
+
+    def __init__(self, db_path: str = "data/chat.db", data_dir: str = "data/sessions",
+                 shared: bool = False, on_session_ended: Optional[Callable[[Session], None]] = None):
+        self.db_path = Path(db_path)
+        self._conn = connect(self.db_path)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                created_at TEXT,
+                ended_at TEXT,
+                status TEXT,
+                participant_count INTEGER DEFAULT 0,
+                total_messages INTEGER DEFAULT 0,
+                data TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_sessions_status_created
+                ON sessions (status, created_at);
+            CREATE INDEX IF NOT EXISTS idx_sessions_created
+                ON sessions (created_at);
+            CREATE TABLE IF NOT EXISTS state (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+        self._conn.commit()
+        super().__init__(data_dir, shared=shared, on_session_ended=on_session_ended)
+
+    def _create_catalog(self) -> SessionCatalog:
+        return SQLiteSessionCatalog(self._conn)
+
+    def _read_state(self) -> Optional[Dict]:
+        row = self._conn.execute("SELECT value FROM state WHERE key = 'sessions'").fetchone()
+        return json.loads(row["value"]) if row else None
+
+    def _write_state(self, state: Dict):
+        with self._conn:
+            self._conn.execute(
+                "INSERT INTO state (key, value) VALUES ('sessions', ?)"
+                " ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                (json.dumps(state),)
+            )
+
+    def _read_session(self, session_id: str) -> Optional[Session]:
+        row = self._conn.execute(
+            "SELECT data FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row is None or row["data"] is None:
+            return None
+        return Session.from_dict(json.loads(row["data"]))
+
+    def _write_session(self, session: Session):
+        with self._conn:
+            self._conn.execute(
+                "INSERT INTO sessions (session_id, created_at, status, data) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (session_id) DO UPDATE SET data = excluded.data",
+                (session.session_id, session.created_at, session.status, session.to_json())
+            )
+
+    def _delete_session_data(self, session_id: str) -> bool:
+        with self._conn:
+            cursor = self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        return cursor.rowcount > 0
+
+    def _scan_session_ids(self) -> List[str]:
+        rows = self._conn.execute("SELECT session_id FROM sessions").fetchall()
+        return [row["session_id"] for row in rows]
+
+    def close(self):
+        """未保存のセッションを書き出してデータベースを閉じる"""
+        self.flush()
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
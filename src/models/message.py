@@ -61,3 +61,95 @@ class Message(BaseModel):
         """JSON文字列からインスタンスを作成"""
         return cls.from_dict(json.loads(json_str))
 
+
+class MessageRecord:
+    """保存済みメッセージの軽量な表現（一括読み込み用）
+
+    保存時に検証済みのレコードをそのまま信頼し、pydanticの検証やメタデータの再計算を行わない。
+    Message を返すAPI（MessageStore.get_messages_by_* など）は to_message() で変換して返す。
+    """
+
+    __slots__ = (
+        "message_id", "session_id", "client_id", "message_type", "content", "timestamp",
+        "char_count", "word_count", "client_color",
+    )
+
+    def __init__(self, message_id: str, session_id: str, client_id: str, message_type: str,
+                 content: str, timestamp: str, char_count: int = 0, word_count: int = 0,
+                 client_color: Optional[str] = None):
+        self.message_id = message_id
+        self.session_id = session_id
+        self.client_id = client_id
+        self.message_type = message_type
+        self.content = content
+        self.timestamp = timestamp
+        self.char_count = char_count
+        self.word_count = word_count
+        self.client_color = client_color
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "MessageRecord":
+        """保存済みの辞書から作成（メタデータは保存されている値を使う）"""
+        message_type = data.get("message_type", "message")
+        content = data["content"]
+        metadata = data.get("metadata") or {}
+        if "char_count" in metadata:
+            char_count = metadata["char_count"]
+            word_count = metadata.get("word_count", 0)
+        elif message_type == "message":
+            # メタデータのない古いレコードだけ計算する
+            char_count = len(content)
+            word_count = len(content.split())
+        else:
+            char_count = word_count = 0
+        return cls(
+            data["message_id"], data["session_id"], data["client_id"], message_type, content,
+            data["timestamp"], char_count, word_count, metadata.get("client_color")
+        )
+
+    def to_dict(self) -> dict:
+        """辞書形式に変換（Message.to_dict() と同じ形）"""
+        return {
+            "message_id": self.message_id,
+            "session_id": self.session_id,
+            "client_id": self.client_id,
+            "message_type": self.message_type,
+            "content": self.content,
+            "timestamp": self.timestamp,
+            "metadata": {
+                "char_count": self.char_count,
+                "word_count": self.word_count,
+                "client_color": self.client_color,
+            },
+        }
+
+    def to_csv_row(self):
+        """CSV行データに変換"""
+        return [
+            self.message_id,
+            self.session_id,
+            self.client_id,
+            self.message_type,
+            self.content,
+            self.timestamp,
+            self.char_count,
+            self.word_count,
+            self.client_color or ""
+        ]
+
+    def to_message(self) -> Message:
+        """pydanticの Message に変換（検証・再計算は行わない）"""
+        return Message.model_construct(
+            message_id=self.message_id,
+            session_id=self.session_id,
+            client_id=self.client_id,
+            message_type=self.message_type,
+            content=self.content,
+            timestamp=self.timestamp,
+            metadata=MessageMetadata.model_construct(
+                char_count=self.char_count,
+                word_count=self.word_count,
+                client_color=self.client_color,
+            ),
+        )
+
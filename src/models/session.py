@@ -79,9 +79,9 @@ class Session(BaseModel):
         if client_id in self.participants:
             self.participants.remove(client_id)
     
-    def increment_message_count(self):
+    def increment_message_count(self, count: int = 1):
         """メッセージ数をインクリメント"""
-        self.total_messages += 1
+        self.total_messages += count
     
     def end_session(self):
         """セッションを終了"""
@@ -52,6 +52,19 @@ function getClientColor(clientId) {
 let clientId;
 let currentSessionId;
 
+// 受信済みのメッセージ番号（seq）: この番号までは全て受信済み
+let lastSeq = null;
+// lastSeq より後で受信済みの番号（前後して届いた場合）
+const receivedSeqs = new Set();
+// 取りこぼしがこの件数を超えたら、それより前は諦めて進める
+const MAX_PENDING_SEQS = 100;
+
+// 切断時の再接続
+let reconnectDelay = 1000;
+let hasJoined = false;
+let sessionEnded = false;
+let loggingOut = false;
+
 async function checkSession() {
     // 現在のセッションIDを取得
     try {
@@ -127,9 +140,13 @@ async function connect() {
     // グローバル変数に保存
     currentSessionId = sessionId;
 
+    openSocket();
+}
+
+function openSocket() {
     // WebSocket接続にsession_idを含める
-    const wsUrl = sessionId 
-        ? `ws://${window.location.host}/ws?session_id=${sessionId}`
+    const wsUrl = currentSessionId 
+        ? `ws://${window.location.host}/ws?session_id=${currentSessionId}`
         : `ws://${window.location.host}/ws`;
     
     ws = new WebSocket(wsUrl);
@@ -138,19 +155,30 @@ async function connect() {
         document.getElementById('status-text').textContent = 'Online';
         document.getElementById('status-icon').className = 'online';
         document.getElementById('client-id').textContent = `Client ID: ${clientId}`;
+        reconnectDelay = 1000;
         
-        // 過去のメッセージを読み込む
-        await loadPastMessages();
+        // 過去のメッセージは最初の接続時だけ読み込む
+        // （再接続時は参加メッセージに lastSeq を付けて、取りこぼした分だけを受け取る）
+        if (!hasJoined) {
+            await loadPastMessages();
+        }
         
         // 参加メッセージを送信
         sendSystemMessage('join');
+        hasJoined = true;
     };
 
     ws.onmessage = function(event) {
         const data = JSON.parse(event.data);
         
+        // 再送などで重複して届いたメッセージは表示しない
+        if (data.seq !== undefined && !markReceived(data.seq)) {
+            return;
+        }
+        
         // セッション終了メッセージの処理
         if (data.type === 'session_end') {
+            sessionEnded = true;
             displayMessage(data);
             // 3秒後にログイン画面へリダイレクト
             setTimeout(() => {
@@ -174,13 +202,21 @@ async function connect() {
     };
 
     ws.onclose = function(event) {
-        if (event.reason === "Client ID already in use") {
+        if (event.reason === "Client ID already in use" && !hasJoined) {
             alert("This ID is already in use. Please log in with a different ID.");
             window.location.href = '/'; // ログインページに戻す
-        } else {
-            document.getElementById('status-text').textContent = 'Offline';
-            document.getElementById('status-icon').className = 'offline';
-            console.log('WebSocket closed:', event);
+            return;
+        }
+        document.getElementById('status-text').textContent = 'Offline';
+        document.getElementById('status-icon').className = 'offline';
+        console.log('WebSocket closed:', event);
+        
+        // セッションが続いていれば間隔を空けて再接続
+        // （切断をサーバーが検知するまでは同じIDが使用中として拒否されるため、その場合も再試行する）
+        if (hasJoined && !sessionEnded && !loggingOut && event.reason !== "Invalid or inactive session") {
+            document.getElementById('status-text').textContent = 'Reconnecting...';
+            setTimeout(openSocket, reconnectDelay);
+            reconnectDelay = Math.min(reconnectDelay * 2, 30000);
         }
     };
 
@@ -213,10 +249,35 @@ function sendSystemMessage(type) {
             client_id: clientId,
             timestamp: new Date().toISOString()
         };
+        if (type === 'join' && lastSeq !== null) {
+            // この番号より後のメッセージをサーバーから再送してもらう
+            messageData.last_seq = lastSeq;
+        }
         ws.send(JSON.stringify(messageData));
     }
 }
 
+// メッセージ番号を受信済みにする（既に受信済みなら false）
+function markReceived(seq) {
+    if (lastSeq === null) {
+        lastSeq = seq - 1;
+    }
+    if (seq <= lastSeq || receivedSeqs.has(seq)) {
+        return false;
+    }
+    receivedSeqs.add(seq);
+    // 連続して受信できた分だけ lastSeq を進める
+    while (receivedSeqs.has(lastSeq + 1)) {
+        lastSeq += 1;
+        receivedSeqs.delete(lastSeq);
+    }
+    if (receivedSeqs.size > MAX_PENDING_SEQS) {
+        lastSeq = Math.max(...receivedSeqs);
+        receivedSeqs.clear();
+    }
+    return true;
+}
+
 function displayMessage(data) {
     const messageArea = document.getElementById('messageArea');
     const messageDiv = document.createElement('div');
@@ -288,8 +349,10 @@ async function loadPastMessages() {
         
         console.log(`[loadPastMessages] Loading messages for session: ${currentSessionId}, clientId: ${clientId}`);
         
-        // セッションのメッセージを取得
-        const messagesResponse = await fetch(`/api/sessions/${currentSessionId}/messages`);
+        // 自分が最初に参加した後のメッセージだけをサーバー側で絞り込んで取得
+        // （参加記録がない初回参加の場合は空で返る）
+        const params = new URLSearchParams({ since_join: clientId });
+        const messagesResponse = await fetch(`/api/sessions/${currentSessionId}/messages?${params}`);
         if (!messagesResponse.ok) {
             console.log('[loadPastMessages] Failed to fetch messages, status:', messagesResponse.status);
             return;
@@ -297,45 +360,10 @@ async function loadPastMessages() {
         
         const data = await messagesResponse.json();
         const messages = data.messages;
+        // 読み込んだ時点の最後のメッセージ番号（参加時に送り、それ以降の分を受け取る）
+        lastSeq = data.total;
         
-        console.log(`[loadPastMessages] Total messages in session: ${messages.length}`);
-        
-        // 自分が最初に参加した時刻を探す
-        let myJoinTime = null;
-        for (const msg of messages) {
-            if (msg.message_type === 'system' && 
-                msg.client_id === clientId && 
-                msg.content.includes('joined')) {
-                myJoinTime = new Date(msg.timestamp);
-                console.log(`[loadPastMessages] Found join message at: ${myJoinTime.toISOString()}`);
-                break;
-            }
-        }
-        
-        // 自分が参加した記録がない場合は、履歴を表示しない（初回参加）
-        if (!myJoinTime) {
-            console.log('[loadPastMessages] First time joining this session - no past messages to load');
-            return;
-        }
-        
-        // 自分が参加した時刻以降のメッセージのみを表示
-        let loadedCount = 0;
         messages.forEach(msg => {
-            const msgTime = new Date(msg.timestamp);
-            
-            // 自分の参加時刻より前のメッセージはスキップ
-            if (msgTime < myJoinTime) {
-                return;
-            }
-            
-            // 自分の最初の参加メッセージはスキップ（新しく送信されるため）
-            if (msg.message_type === 'system' && 
-                msg.client_id === clientId && 
-                msg.content.includes('joined') &&
-                Math.abs(msgTime - myJoinTime) < 1000) {  // 1秒以内なら同じメッセージ
-                return;
-            }
-            
             // メッセージを画面に表示
             displayMessage({
                 type: msg.message_type,
@@ -343,11 +371,9 @@ async function loadPastMessages() {
                 message: msg.content,
                 timestamp: msg.timestamp
             });
-            
-            loadedCount++;
         });
         
-        console.log(`[loadPastMessages] Loaded ${loadedCount} past messages (since you joined)`);
+        console.log(`[loadPastMessages] Loaded ${messages.length} past messages (since you joined)`);
     } catch (error) {
         console.error('[loadPastMessages] Error:', error);
     }
@@ -373,6 +399,7 @@ function testColorDistribution(numUsers) {
 function logout() {
     if (confirm('ログアウトしますか？')) {
         // WebSocket接続を閉じる
+        loggingOut = true;
         if (ws) {
             ws.close();
         }
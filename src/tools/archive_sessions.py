@@ -0,0 +1,67 @@
+"""終了済みのセッションのメッセージをまとめて圧縮アーカイブに移す
+
+使い方:
+    python -m src.tools.archive_sessions [--data-dir data] [--backend json|sqlite] [--compression gzip|zstd]
+
+サーバーは終了したセッションをその場でアーカイブするため、これはアーカイブ機能を
+有効にする前に終了したセッションや、終了後の書き込みで移せなかったセッションの移行用。
+サーバーを停止してから実行する。アーカイブ後に追記されたメッセージは既存のアーカイブに足し、
+移すメッセージがないセッションはスキップする。
+"""
+import argparse
+from pathlib import Path
+
+from .. import config
+from ..managers.message_store import MessageStore
+from ..managers.session_manager import SessionManager
+from ..managers.sqlite_store import SQLiteMessageLog, SQLiteSessionManager
+
+
+def archive_ended_sessions(data_dir: Path, backend: str, db_path: Path, compression: str) -> dict:
+    """終了済みのセッションのメッセージをアーカイブに移す"""
+    messages_dir = data_dir / "messages"
+    if backend == "sqlite":
+        session_manager = SQLiteSessionManager(db_path=str(db_path), data_dir=str(data_dir / "sessions"))
+        message_store = MessageStore(str(messages_dir), log=SQLiteMessageLog(db_path), archive=compression)
+    else:
+        session_manager = SessionManager(str(data_dir / "sessions"))
+        message_store = MessageStore(str(messages_dir), archive=compression)
+    result = {"archived": 0, "skipped": 0, "bytes_before": 0, "bytes_after": 0}
+
+    archive = message_store.log.archive
+    for entry in session_manager.list_session_entries(status="ended"):
+        session_id = entry["session_id"]
+        hot_file = message_store.log.path(session_id)
+        size_before = hot_file.stat().st_size if backend != "sqlite" and hot_file.exists() else 0
+        archived_before = archive.size(session_id)
+        if message_store.archive_session(session_id):
+            result["archived"] += 1
+            result["bytes_before"] += size_before
+            result["bytes_after"] += archive.size(session_id) - archived_before
+        else:
+            result["skipped"] += 1
+
+    message_store.close()
+    session_manager.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="終了済みのセッションのメッセージを圧縮アーカイブに移す")
+    parser.add_argument("--data-dir", default="data", help="データのディレクトリ（既定: data）")
+    parser.add_argument("--backend", choices=("json", "sqlite"), default=config.STORAGE_BACKEND,
+                        help=f"ストレージ（既定: {config.STORAGE_BACKEND}）")
+    parser.add_argument("--db", default=config.SQLITE_PATH, help=f"SQLiteデータベースのパス（既定: {config.SQLITE_PATH}）")
+    parser.add_argument("--compression", choices=("gzip", "zstd"),
+                        default=config.MESSAGE_ARCHIVE if config.MESSAGE_ARCHIVE != "off" else "gzip",
+                        help="圧縮形式（既定: MESSAGE_ARCHIVE または gzip）")
+    args = parser.parse_args()
+
+    result = archive_ended_sessions(Path(args.data_dir), args.backend, Path(args.db), args.compression)
+    print(f"Archived {result['archived']} session(s) ({result['skipped']} skipped: nothing to archive)")
+    if result["bytes_before"]:
+        print(f"Message logs: {result['bytes_before'] / 1024:,.1f} KB -> {result['bytes_after'] / 1024:,.1f} KB")
+
+
+if __name__ == "__main__":
+    main()
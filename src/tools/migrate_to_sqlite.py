@@ -0,0 +1,73 @@
+"""既存のJSONデータ（data/sessions, data/messages）をSQLiteにインポートする
+
+使い方:
+    python -m src.tools.migrate_to_sqlite [--data-dir data] [--db data/chat.db]
+
+既にSQLiteに存在するセッション・メッセージはスキップするため、何度実行しても安全。
+"""
+import argparse
+import json
+from pathlib import Path
+
+from ..models.session import Session
+from ..managers.message_log import JsonArrayMessageLog, JsonlMessageLog
+from ..managers.message_archive import MessageArchive, TieredMessageLog
+from ..managers.sqlite_store import SQLiteMessageLog, SQLiteSessionManager
+
+
+def migrate(data_dir: Path, db_path: Path) -> dict:
+    """JSONファイルのセッションとメッセージをSQLiteにコピー"""
+    sessions_dir = data_dir / "sessions"
+    messages_dir = data_dir / "messages"
+    session_manager = SQLiteSessionManager(db_path=str(db_path), data_dir=str(sessions_dir))
+    message_log = SQLiteMessageLog(db_path)
+    result = {"sessions": 0, "sessions_skipped": 0, "messages": 0, "message_sessions_skipped": 0}
+
+    # セッション
+    for session_file in sorted(sessions_dir.glob("*.json")):
+        if session_file.name.startswith("_"):
+            continue
+        try:
+            with open(session_file, 'r', encoding='utf-8') as f:
+                session = Session.from_dict(json.load(f))
+        except Exception as e:
+            print(f"Skipping {session_file}: {e}")
+            continue
+        if session_manager.load_session(session.session_id):
+            result["sessions_skipped"] += 1
+            continue
+        session_manager.update_session(session)
+        result["sessions"] += 1
+
+    # メッセージ（JSON Lines と圧縮アーカイブ、旧形式のJSON配列）
+    jsonl_log = TieredMessageLog(JsonlMessageLog(messages_dir), MessageArchive(messages_dir / "archive"))
+    for source_log in (jsonl_log, JsonArrayMessageLog(messages_dir)):
+        for session_id in sorted(source_log.session_ids()):
+            # セッションごとに1つのトランザクションで書き込む（途中で止まっても一部だけ残らず、再実行で取り込み直す）
+            if message_log.import_records(session_id, source_log.iter_records(session_id)):
+                result["messages"] += message_log.count(session_id)
+            else:
+                result["message_sessions_skipped"] += 1
+        source_log.close()
+
+    session_manager.close()
+    message_log.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSONデータをSQLiteにインポート")
+    parser.add_argument("--data-dir", default="data", help="JSONデータのディレクトリ（既定: data）")
+    parser.add_argument("--db", default="data/chat.db", help="SQLiteデータベースのパス（既定: data/chat.db）")
+    args = parser.parse_args()
+
+    result = migrate(Path(args.data_dir), Path(args.db))
+    print(f"Imported {result['sessions']} session(s) "
+          f"({result['sessions_skipped']} already present)")
+    print(f"Imported {result['messages']} message(s) "
+          f"({result['message_sessions_skipped']} session log(s) already present)")
+    print(f"Start the server with STORAGE_BACKEND=sqlite SQLITE_PATH={args.db} to use it.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+"""複数ワーカーで起動する場合のpub/subブローカー
+
+使い方:
+    python -m src.tools.pubsub_broker [--socket data/pubsub.sock]
+
+uvicorn を --workers 2 以上で起動するときは、先にこのブローカーを起動し、
+各ワーカーを PUBSUB_BACKEND=unix で起動する（deployment/start_server.sh が自動で行う）。
+"""
+import argparse
+import asyncio
+
+from .. import config
+from ..managers.pubsub import PubSubBroker
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ワーカー間のpub/subブローカー")
+    parser.add_argument("--socket", default=config.PUBSUB_SOCKET,
+                        help=f"Unixソケットのパス（既定: {config.PUBSUB_SOCKET}）")
+    args = parser.parse_args()
+
+    broker = PubSubBroker(args.socket)
+    try:
+        asyncio.run(broker.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+"""管理者パスワードを設定する
+
+使い方:
+    python -m src.tools.set_admin_password
+
+サーバーは起動時にパスワードの入力を求めないため、初回の起動前（または稼働中）に実行する。
+環境変数 ADMIN_PASSWORD を指定して起動した場合はそちらが使われる。
+"""
+import getpass
+import sys
+
+from ..admin_auth import MIN_PASSWORD_LENGTH, set_admin_password
+
+
+def main():
+    if not sys.stdin.isatty():
+        # パイプで渡された場合は1行目をパスワードとして使う
+        password = sys.stdin.readline().rstrip("\n")
+        if len(password) < MIN_PASSWORD_LENGTH:
+            sys.exit(f"Password must be at least {MIN_PASSWORD_LENGTH} characters long.")
+        set_admin_password(password)
+        return
+    while True:
+        password = getpass.getpass("Enter admin password: ")
+        if len(password) < MIN_PASSWORD_LENGTH:
+            print(f"Password must be at least {MIN_PASSWORD_LENGTH} characters long.")
+            continue
+        confirm = getpass.getpass("Confirm admin password: ")
+        if password != confirm:
+            print("Passwords do not match. Please try again.")
+            continue
+        set_admin_password(password)
+        break
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+import pytest
+
+from src.exporters import data_exporter
+from src.exporters.data_exporter import DataExporter
+from src.managers.message_store import MessageStore
+
+
+def test_columnar_export_without_pyarrow_names_the_package(tmp_path, monkeypatch):
+    monkeypatch.setattr(data_exporter, "pa", None)
+    exporter = DataExporter(str(tmp_path / "exports"))
+    store = MessageStore(str(tmp_path / "messages"), fsync_policy="never")
+    try:
+        assert not exporter.columnar_available()
+        with pytest.raises(RuntimeError, match="pip install pyarrow"):
+            exporter.export_messages_columnar("s", store, "parquet")
+    finally:
+        store.close()
@@ -0,0 +1,85 @@
+import pytest
+
+from src.managers.message_log import JsonlMessageLog, OffsetIndex
+
+
+def make_records(n, start=0):
+    return [
+        {"client_id": "alice", "content": f"message {i}", "timestamp": f"2024-01-01T00:00:{i:02d}"}
+        for i in range(start, start + n)
+    ]
+
+
+@pytest.fixture
+def log(tmp_path):
+    log = JsonlMessageLog(tmp_path, fsync_policy="never")
+    yield log
+    log.close()
+
+
+def test_append_returns_first_seq_and_reads_back(log):
+    assert log.append("s", make_records(3)) == 1
+    assert log.append("s", make_records(2, start=3)) == 4
+    assert log.count("s") == 5
+    assert [r["content"] for r in log.iter_records("s")] == [f"message {i}" for i in range(5)]
+    assert [r["content"] for r in log.read_range("s", 1, 3)] == ["message 1", "message 2"]
+    assert log.timestamp_at("s", 4) == "2024-01-01T00:00:04"
+
+
+def test_repair_tail_truncates_incomplete_record(log):
+    log.append("s", make_records(2))
+    with open(log.path("s"), "ab") as f:
+        f.write(b'{"content": "broken')
+    assert log.repair_tail("s").startswith("truncated")
+    assert log.repair_tail("s") is None
+    # 修復後の追記は壊れた行に続かない
+    assert log.append("s", make_records(1, start=2)) == 3
+    assert [r["content"] for r in log.iter_records("s")] == ["message 0", "message 1", "message 2"]
+
+
+def test_repair_tail_adds_missing_newline(log):
+    log.append("s", make_records(1))
+    with open(log.path("s"), "ab") as f:
+        f.write(log.encode(make_records(1, start=1)[0]).rstrip(b"\n"))
+    assert log.repair_tail("s") == "added missing newline after the last record"
+    assert log.path("s").read_bytes().endswith(b"\n")
+
+
+def test_append_after_torn_tail_without_repair(log):
+    log.append("s", make_records(2))
+    with open(log.path("s"), "ab") as f:
+        f.write(b'{"content": "torn')
+    assert log.append("s", make_records(1, start=2)) == 3
+    assert log.read_range("s", 2, 3)[0]["content"] == "message 2"
+
+
+def test_offset_index_rebuilt_when_missing(tmp_path):
+    log = JsonlMessageLog(tmp_path, fsync_policy="never")
+    log.append("s", make_records(5))
+    log.close()
+    log.index_path("s").unlink()
+
+    log = JsonlMessageLog(tmp_path, fsync_policy="never")
+    try:
+        assert log.count("s") == 5
+        assert log.read_range("s", 3, 5)[1]["content"] == "message 4"
+        assert log.index_path("s").stat().st_size == 5 * OffsetIndex.ENTRY.size
+    finally:
+        log.close()
+
+
+def test_offset_index_catches_up_with_lagging_index(tmp_path):
+    log = JsonlMessageLog(tmp_path, fsync_policy="never")
+    log.append("s", make_records(5))
+    log.close()
+    # 最後の2件分のエントリを失ったインデックス
+    index_file = log.index_path("s")
+    index_file.write_bytes(index_file.read_bytes()[:3 * OffsetIndex.ENTRY.size])
+
+    log = JsonlMessageLog(tmp_path, fsync_policy="never")
+    try:
+        assert log.count("s") == 5
+        assert [r["content"] for r in log.read_range("s", 2, 5)] == ["message 2", "message 3", "message 4"]
+        assert log.append("s", make_records(1, start=5)) == 6
+    finally:
+        log.close()
@@ -0,0 +1,121 @@
+import pytest
+
+from src.managers.message_store import MessageStore
+from src.models.message import Message
+
+
+def message(session_id, client_id, content, second, message_type="message"):
+    return Message(session_id=session_id, client_id=client_id, content=content,
+                   message_type=message_type, timestamp=f"2024-01-01T00:00:{second:02d}")
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = MessageStore(str(tmp_path / "messages"), fsync_policy="never")
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def filled(store):
+    store.save_messages([message("s", "alice", f"m{i}", i) for i in range(10)])
+    return store
+
+
+def seqs(page):
+    return [m["seq"] for m in page["messages"]]
+
+
+def test_page_defaults_to_newest(filled):
+    page = filled.get_message_page("s", limit=3)
+    assert seqs(page) == [8, 9, 10]
+    assert page["has_more"] and page["total"] == 10
+    assert (page["first_seq"], page["last_seq"]) == (8, 10)
+
+
+def test_page_cursors(filled):
+    assert seqs(filled.get_message_page("s", limit=3, before=8)) == [5, 6, 7]
+    assert seqs(filled.get_message_page("s", limit=3, after=2)) == [3, 4, 5]
+    assert seqs(filled.get_message_page("s", after=7)) == [8, 9, 10]
+    assert not filled.get_message_page("s", after=7)["has_more"]
+
+
+@pytest.mark.parametrize("kwargs", [{"limit": -1}, {"before": -1}, {"after": -5}])
+def test_page_rejects_negative_values(filled, kwargs):
+    with pytest.raises(ValueError):
+        filled.get_message_page("s", **kwargs)
+
+
+@pytest.mark.parametrize("kwargs, expected", [
+    ({"before": 100}, list(range(1, 11))),
+    ({"after": 100}, []),
+    ({"after": 10}, []),
+    ({"before": 1}, []),
+    ({"before": 0}, []),
+    ({"limit": 0}, []),
+    ({"after": 3, "before": 3}, []),
+])
+def test_page_out_of_range(filled, kwargs, expected):
+    page = filled.get_message_page("s", **kwargs)
+    assert seqs(page) == expected
+    if not expected:
+        assert page["first_seq"] is None and page["last_seq"] is None
+
+
+def test_page_of_unknown_session(store):
+    page = store.get_message_page("missing", limit=5)
+    assert page["messages"] == [] and page["total"] == 0 and not page["has_more"]
+
+
+def test_page_since_join(store):
+    store.save_messages([
+        message("s", "alice", "before", 0),
+        message("s", "bob", "Client bob has joined the room", 1, message_type="system"),
+        message("s", "alice", "after", 2),
+    ])
+    assert seqs(store.get_message_page("s", since_join="bob")) == [3]
+    assert seqs(store.get_message_page("s", since_join="carol")) == []
+
+
+def test_incremental_stats_match_full_recount(tmp_path):
+    data_dir = str(tmp_path / "messages")
+    store = MessageStore(data_dir, fsync_policy="never")
+    for i in range(20):
+        sender = ("alice", "bob", "carol")[i % 3]
+        store.save_message(message("s", sender, "hello world " * (i % 4 + 1), i))
+    store.save_message(message("s", "alice", "Client alice has joined the room", 20, message_type="system"))
+    incremental = store.get_session_statistics("s")
+    store.close()
+
+    # 保存済みの統計情報を消してログから集計し直す
+    for stats_file in (tmp_path / "messages" / "stats").iterdir():
+        stats_file.unlink()
+    store = MessageStore(data_dir, fsync_policy="never")
+    try:
+        assert store.get_session_statistics("s") == incremental
+        assert incremental["total_messages"] == 20
+        assert sorted(incremental["participants"]) == ["alice", "bob", "carol"]
+    finally:
+        store.close()
+
+
+def test_archive_round_trip_and_appends_after_archive(tmp_path):
+    store = MessageStore(str(tmp_path / "messages"), fsync_policy="never", archive="gzip", archive_segment_size=4)
+    try:
+        store.save_messages([message("s", "alice", f"m{i}", i) for i in range(10)])
+        assert store.archive_session("s")
+        assert store.unarchived_count("s") == 0
+        assert [m.content for m in store.get_messages_by_session("s")] == [f"m{i}" for i in range(10)]
+
+        # アーカイブ後に追記した分は続きの番号になり、次のアーカイブで後ろに足される
+        first_seqs = store.save_messages([message("s", "bob", f"late{i}", 20 + i) for i in range(3)])
+        assert first_seqs == {"s": 11}
+        assert store.unarchived_count("s") == 3
+        assert seqs(store.get_message_page("s", after=9)) == [10, 11, 12, 13]
+        assert store.archive_session("s")
+        assert store.unarchived_count("s") == 0
+        contents = [m.content for m in store.get_messages_by_session("s")]
+        assert contents == [f"m{i}" for i in range(10)] + ["late0", "late1", "late2"]
+        assert store.get_messages_count("s") == 13
+    finally:
+        store.close()
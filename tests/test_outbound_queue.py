@@ -0,0 +1,104 @@
+import asyncio
+
+from src.managers.outbound_queue import OutboundQueue
+
+
+class FakeWebSocket:
+    def __init__(self, delay=0.0, fail=False):
+        self.delay = delay
+        self.fail = fail
+        self.sent = []
+
+    async def send_text(self, text):
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("connection closed")
+        self.sent.append(text)
+
+
+def test_drop_oldest_keeps_newest_frames():
+    async def run():
+        websocket = FakeWebSocket()
+        queue = OutboundQueue("c", websocket, max_size=3, policy="drop_oldest")
+        for i in range(5):
+            assert queue.put(f"f{i}")
+        assert queue.dropped == 2
+        queue.start()
+        await asyncio.sleep(0.01)
+        await queue.stop()
+        return websocket.sent
+
+    assert asyncio.run(run()) == ["f2", "f3", "f4"]
+
+
+def test_coalesce_replaces_frames_with_same_key():
+    async def run():
+        websocket = FakeWebSocket()
+        queue = OutboundQueue("c", websocket, max_size=3, policy="coalesce")
+        queue.put("stats 1", key="stats")
+        queue.put("other")
+        queue.put("stats 2", key="stats")
+        assert queue.coalesced == 1
+        queue.start()
+        await asyncio.sleep(0.01)
+        await queue.stop()
+        return websocket.sent
+
+    assert asyncio.run(run()) == ["stats 2", "other"]
+
+
+def test_disconnect_policy_rejects_overflow():
+    async def run():
+        queue = OutboundQueue("c", FakeWebSocket(), max_size=2, policy="disconnect")
+        assert queue.put("f0") and queue.put("f1")
+        assert not queue.put("f2")
+        assert queue.dropped == 1
+
+    asyncio.run(run())
+
+
+def test_send_failure_calls_on_failure():
+    async def run():
+        failed = []
+
+        async def on_failure(queue):
+            failed.append(queue.client_id)
+
+        queue = OutboundQueue("c", FakeWebSocket(fail=True), on_failure=on_failure)
+        queue.start()
+        queue.put("f0")
+        await asyncio.sleep(0.01)
+        await queue.stop()
+        return failed
+
+    assert asyncio.run(run()) == ["c"]
+
+
+def test_send_timeout_calls_on_failure():
+    async def run():
+        failed = []
+
+        async def on_failure(queue):
+            failed.append(queue.client_id)
+
+        queue = OutboundQueue("c", FakeWebSocket(delay=1), send_timeout=0.05, on_failure=on_failure)
+        queue.start()
+        queue.put("f0")
+        await asyncio.sleep(0.2)
+        await queue.stop()
+        return failed
+
+    assert asyncio.run(run()) == ["c"]
+
+
+def test_stop_waits_for_send_task():
+    async def run():
+        queue = OutboundQueue("c", FakeWebSocket(delay=1))
+        queue.start()
+        queue.put("f0")
+        await asyncio.sleep(0.01)
+        task = queue._task
+        await queue.stop()
+        return task.done()
+
+    assert asyncio.run(run())
@@ -0,0 +1,37 @@
+from src.managers.replay_buffer import ReplayBuffer
+
+
+def test_since_returns_frames_after_last_seq():
+    buffer = ReplayBuffer(size=10)
+    for seq in range(1, 6):
+        buffer.append("s", seq, f"p{seq}")
+    assert buffer.since("s", 3) == ["p4", "p5"]
+    assert buffer.since("s", 5) == []
+    assert buffer.since("s", 0) == ["p1", "p2", "p3", "p4", "p5"]
+
+
+def test_since_returns_none_when_gap_is_not_buffered():
+    buffer = ReplayBuffer(size=3)
+    for seq in range(1, 7):
+        buffer.append("s", seq, f"p{seq}")
+    # 1〜3 は捨てられている
+    assert buffer.since("s", 2) is None
+    assert buffer.since("s", 3) == ["p4", "p5", "p6"]
+    assert buffer.since("other", 0) is None
+
+
+def test_out_of_order_appends_are_kept_in_seq_order():
+    buffer = ReplayBuffer(size=10)
+    for seq in (1, 3, 2, 5, 4, 3):
+        buffer.append("s", seq, f"p{seq}")
+    assert buffer.since("s", 0) == ["p1", "p2", "p3", "p4", "p5"]
+
+
+def test_least_recently_used_session_is_dropped():
+    buffer = ReplayBuffer(size=10, max_sessions=2)
+    buffer.append("a", 1, "a1")
+    buffer.append("b", 1, "b1")
+    buffer.append("a", 2, "a2")
+    buffer.append("c", 1, "c1")
+    assert buffer.since("b", 0) is None
+    assert buffer.since("a", 0) == ["a1", "a2"]
@@ -0,0 +1,30 @@
+from src.managers.message_log import JsonlMessageLog
+from src.managers.search_index import SearchIndex, tokenize
+
+
+def test_tokenize_ascii_words_are_lowercased():
+    assert tokenize("Hello, World! foo_bar 42") == ["hello", "world", "foo_bar", "42"]
+
+
+def test_tokenize_cjk_bigrams():
+    assert tokenize("日本語") == ["日本", "本語"]
+    assert tokenize("カタカナ") == ["カタ", "タカ", "カナ"]
+    # 1文字だけの並びはそのまま
+    assert tokenize("猫") == ["猫"]
+
+
+def test_tokenize_mixed_text():
+    assert tokenize("Pythonで検索 test") == ["python", "で検", "検索", "test"]
+
+
+def test_search_prefix_and_cjk(tmp_path):
+    log = JsonlMessageLog(tmp_path / "messages", fsync_policy="never")
+    try:
+        log.append("s", [{"content": c} for c in ["hello world", "shell", "日本語です", "本日は晴天"]])
+        index = SearchIndex(tmp_path / "search", log)
+        assert sorted(seq for _, seq in index.search("s", "hel")) == [1]
+        assert sorted(seq for _, seq in index.search("s", "日本")) == [3]
+        assert sorted(seq for _, seq in index.search("s", "本")) == [3, 4]
+        assert index.search("s", "missing") == []
+    finally:
+        log.close()